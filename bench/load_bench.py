@@ -0,0 +1,340 @@
+"""
+Load generator: starts a chat server on loopback in a child process and
+drives it with simulated clients speaking the framed protocol, the same
+way client/core/network.py does (HELLO, RENAME, TYPING, CHAT).
+
+Some clients send message storms with typing bursts and renames, the rest
+only listen; a fraction of the listeners are slow readers. Every chat
+message carries its send time, so each delivery yields one end-to-end
+latency sample.
+
+    python3 bench/load_bench.py --clients 500 --senders 50 --messages 40
+    python3 bench/load_bench.py --engine asyncio --output run.json
+    python3 bench/load_bench.py --output new.json --baseline run.json
+    python3 bench/load_bench.py --compress --size 2000
+
+The load generator is a single asyncio process, so at high rates the
+latencies include its own scheduling delay; compare runs made with the
+same settings on the same machine.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import time
+from array import array
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+
+from core import ENGINES, create_server
+from core.async_network import new_event_loop, raise_open_file_limit
+from common.protocol import MsgType, FrameDecoder, FrameCodec, DeflateCodec, DEFLATE
+
+MARKER = "bench"
+SLOW_READ_SIZE = 1024
+SLOW_READ_DELAY = 0.05
+SLOW_RCVBUF = 4096
+DRAIN_TIMEOUT = 5.0
+# message padding looks like a pasted log, so --compress sees realistic ratios
+FILLER = "2025-01-01 12:00:00,123 INFO [worker-3] GET /api/v1/items?page=2 200 in 14 ms\n"
+
+# metrics compared against a baseline, and whether higher is better
+COMPARED = {
+    "messages_per_sec": True,
+    "deliveries_per_sec": True,
+    "delivered_ratio": True,
+    "latency_p50_ms": False,
+    "latency_p99_ms": False,
+    "latency_p999_ms": False,
+}
+
+
+def serve(engine, options, conn):
+    """Child process: runs the server until the parent asks for its stats."""
+    raise_open_file_limit()
+    server = create_server(engine, host="127.0.0.1", port=0, backlog=4096, **options)
+    server.set_callbacks(None, None, None)
+    server.start_listening(lambda client, addr: None)
+    conn.send(server.server_socket.getsockname()[1])
+    conn.recv()
+    stats = server.stats.snapshot()
+    stats.update(server.stats.per_broadcast())
+    server.shutdown()
+    server.wait_closed(timeout=5)
+    conn.send(stats)
+
+
+class BenchClient:
+    def __init__(self, index, port, run, slow=False, compress=False):
+        self.index = index
+        self.name = f"bench-{index}"
+        self.port = port
+        self.run = run
+        self.slow = slow
+        self.compress = compress
+        self.codec = DeflateCodec() if compress else FrameCodec()
+        self.latencies = run.slow_latencies if slow else run.latencies
+        self.reader = None
+        self.writer = None
+        self.received = 0
+        self.ready = asyncio.Event()
+        self.closed = False
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        if self.slow:
+            sock = self.writer.get_extra_info("socket")
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SLOW_RCVBUF)
+        if self.compress:
+            self.send(MsgType.HELLO, DEFLATE)
+        else:
+            self.send(MsgType.HELLO)
+        self.send(MsgType.RENAME, self.name)
+
+    def send(self, msg_type, *fields):
+        self.writer.write(self.codec.encode(msg_type, fields))
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        read_size = SLOW_READ_SIZE if self.slow else 65536
+        clock = time.perf_counter
+        run = self.run
+        try:
+            while True:
+                data = await self.reader.read(read_size)
+                if not data:
+                    break
+                now = clock()
+                for frame in decoder.feed(data):
+                    if frame.type == MsgType.PING:
+                        self.send(MsgType.PONG, *frame.fields())
+                    if frame.type != MsgType.CHAT:
+                        # the echo of our own rename means the server has registered us
+                        if frame.type == MsgType.RENAME and frame.fields()[-1] == self.name:
+                            self.ready.set()
+                        continue
+                    text = frame.fields()[1]
+                    if not text.startswith(MARKER):
+                        continue
+                    self.latencies.append(now - float(text.split(" ", 2)[1]))
+                    self.received += 1
+                    run.delivered += 1
+                    run.last_delivery = now
+                if self.slow:
+                    await asyncio.sleep(SLOW_READ_DELAY)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.closed = True
+            self.ready.set()
+            run.disconnected += not run.stopping
+
+    async def storm(self, args):
+        """Sends args.messages chat messages, with typing bursts and renames in between."""
+        interval = 1.0 / args.rate if args.rate else 0
+        padding = (FILLER * (args.size // len(FILLER) + 1))[:args.size]
+        for i in range(args.messages):
+            if self.closed:
+                return
+            if args.typing_burst and i % 2 == 0:
+                for _ in range(args.typing_burst):
+                    self.send(MsgType.TYPING)
+            if args.rename_every and i and i % args.rename_every == 0:
+                self.send(MsgType.RENAME, f"{self.name}-{i}")
+            self.send(MsgType.CHAT, f"{MARKER} {time.perf_counter()!r} {padding}")
+            self.run.sent += 1
+            try:
+                await self.writer.drain()
+            except ConnectionError:
+                return
+            if interval:
+                await asyncio.sleep(interval)
+            elif i % 16 == 15:
+                await asyncio.sleep(0)
+        self.send(MsgType.STOP_TYPING)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Run:
+    def __init__(self):
+        self.latencies = array("d")
+        self.slow_latencies = array("d")
+        self.sent = 0
+        self.delivered = 0
+        self.disconnected = 0
+        self.stopping = False
+        self.last_delivery = 0.0
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    out = {}
+    for label, fraction in (("p50", 0.50), ("p99", 0.99), ("p999", 0.999)):
+        value = percentile(ordered, fraction)
+        out[f"latency_{label}_ms"] = None if value is None else round(value * 1000, 3)
+    out["latency_max_ms"] = round(ordered[-1] * 1000, 3) if ordered else None
+    return out
+
+
+async def drive(port, args):
+    run = Run()
+    slow_count = int(args.clients * args.slow_readers)
+    clients = [
+        BenchClient(i, port, run, slow=i >= args.clients - slow_count, compress=args.compress)
+        for i in range(args.clients)
+    ]
+
+    started = time.perf_counter()
+    for i in range(0, len(clients), 100):
+        await asyncio.gather(*(client.connect() for client in clients[i:i + 100]))
+    readers = [asyncio.ensure_future(client.read_loop()) for client in clients]
+    # every client must be registered before the storm, or expected counts are off
+    await asyncio.gather(*(client.ready.wait() for client in clients))
+    connect_time = time.perf_counter() - started
+
+    senders = clients[:min(args.senders, args.clients)]
+    started = time.perf_counter()
+    await asyncio.gather(*(client.storm(args) for client in senders))
+    send_time = time.perf_counter() - started
+
+    # wait until every fast client still connected has everything, or they stall;
+    # slow readers may trickle on for much longer and are not waited for
+    fast = [client for client in clients if not client.slow]
+
+    def pending():
+        return [client for client in fast if not client.closed and client.received < run.sent]
+
+    last, idle = -1, 0.0
+    while pending() and idle < DRAIN_TIMEOUT:
+        await asyncio.sleep(0.1)
+        received = sum(client.received for client in fast)
+        idle = idle + 0.1 if received == last else 0.0
+        last = received
+    fast_received = sum(client.received for client in fast)
+    slow_received = run.delivered - fast_received
+    expected = run.sent * len(fast)
+
+    run.stopping = True
+    for client in clients:
+        client.close()
+    for reader in readers:
+        reader.cancel()
+    await asyncio.gather(*readers, return_exceptions=True)
+
+    total_time = max(run.last_delivery - started, send_time)
+    results = {
+        "connect_seconds": round(connect_time, 3),
+        "send_seconds": round(send_time, 3),
+        "messages_sent": run.sent,
+        "messages_per_sec": round(run.sent / send_time, 1) if send_time else None,
+        "deliveries": run.delivered,
+        "deliveries_per_sec": round(run.delivered / total_time, 1) if total_time else None,
+        "delivered_ratio": round(fast_received / expected, 4) if expected else None,
+        "slow_reader_deliveries": slow_received,
+        "disconnected_clients": run.disconnected,
+    }
+    results.update(summarize(run.latencies))
+    results.update({f"slow_{k}": v for k, v in summarize(run.slow_latencies).items()})
+    return results
+
+
+def compare(results, baseline):
+    print(f"\n{'metric':<22}{'baseline':>14}{'this run':>14}{'change':>10}")
+    for key, higher_is_better in COMPARED.items():
+        old = baseline["results"].get(key)
+        new = results.get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = change < 0 if higher_is_better else change > 0
+        flag = "  worse" if worse and abs(change) >= 5 else ""
+        print(f"{key:<22}{old:>14}{new:>14}{change:>+9.1f}%{flag}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat server load and latency benchmark")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="thread")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--clients", type=int, default=200, help="connected clients")
+    parser.add_argument("--senders", type=int, default=20, help="clients that send messages")
+    parser.add_argument("--messages", type=int, default=50, help="messages per sender")
+    parser.add_argument("--rate", type=float, default=0, help="messages/sec per sender, 0 for as fast as possible")
+    parser.add_argument("--size", type=int, default=32, help="padding bytes per message")
+    parser.add_argument("--compress", action="store_true", help="clients negotiate deflate compression")
+    parser.add_argument("--typing-burst", type=int, default=5, help="TYPING frames before every other message")
+    parser.add_argument("--rename-every", type=int, default=10, help="rename a sender every N messages, 0 to never")
+    parser.add_argument("--slow-readers", type=float, default=0.0, help="fraction of clients that read slowly")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the server's flood protection on; off by default so senders run unthrottled")
+    parser.add_argument("--queue-limit", type=int)
+    parser.add_argument("--overflow-policy")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+
+    raise_open_file_limit()
+    options = {"workers": args.workers}
+    if not args.rate_limits:
+        options["rate_limits"] = None
+    if args.queue_limit is not None:
+        options["queue_limit"] = args.queue_limit
+    if args.overflow_policy is not None:
+        options["overflow_policy"] = args.overflow_policy
+
+    conn, child_conn = multiprocessing.Pipe()
+    # not a daemon: with --workers the server starts processes of its own
+    server = multiprocessing.Process(target=serve, args=(args.engine, options, child_conn))
+    server.start()
+    port = conn.recv()
+
+    loop = new_event_loop()
+    try:
+        results = loop.run_until_complete(drive(port, args))
+    finally:
+        loop.close()
+        conn.send("stop")
+        server_stats = conn.recv() if conn.poll(10) else None
+        server.join(timeout=5)
+
+    if server_stats is not None:
+        results["server_bytes_written"] = server_stats["bytes_written"]
+        results["compression_saved_bytes"] = server_stats["compression_bytes_saved"]
+        results["compression_cpu_ms"] = round(server_stats["compression_seconds"] * 1000, 1)
+        results["throttled_messages"] = server_stats["throttled_messages"]
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": vars(args),
+        "results": results,
+        "server": server_stats,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Microbenchmarks for the wire protocol: frames/sec through the streaming
+FrameDecoder versus the legacy substring + regex classification.
+
+    python3 bench/protocol_bench.py [--messages N] [--read-size BYTES]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common.protocol import MsgType, FrameDecoder, encode_frame, parse_legacy
+
+SAMPLE = [
+    (MsgType.CHAT, "hello everyone, how is it going?"),
+    (MsgType.TYPING, "alice"),
+    (MsgType.CHAT, "a somewhat longer message " * 8),
+    (MsgType.STOP_TYPING, ""),
+    (MsgType.RENAME, "bob"),
+]
+
+LEGACY = {
+    MsgType.CHAT: "#alice#{}\n",
+    MsgType.TYPING: "#writing#{}",
+    MsgType.STOP_TYPING: "#nowriting#",
+    MsgType.RENAME: "#usern#{}",
+}
+
+
+def bench(label, count, func, repeat=3):
+    elapsed = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = min(elapsed, time.perf_counter() - start)
+    print(f"{label:<34} {count / elapsed:>14,.0f} frames/s")
+    return count / elapsed
+
+
+def legacy_path(chunks):
+    for chunk in chunks:
+        frame = parse_legacy(chunk.decode())
+        frame.fields()
+
+
+def framed_path(stream, read_size):
+    decoder = FrameDecoder()
+    view = memoryview(stream)
+    for pos in range(0, len(stream), read_size):
+        for frame in decoder.feed(bytes(view[pos:pos + read_size])):
+            frame.fields()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--read-size", type=int, default=65536)
+    args = parser.parse_args()
+
+    n = args.messages
+    picks = [SAMPLE[i % len(SAMPLE)] for i in range(n)]
+    chunks = [LEGACY[t].format(text).encode() for t, text in picks]
+    stream = b"".join(encode_frame(t, (text,) if text else (), seq=i) for i, (t, text) in enumerate(picks))
+
+    legacy = bench("legacy #tag# + regex", n, lambda: legacy_path(chunks))
+    framed = bench(f"framed, {args.read_size} B reads", n, lambda: framed_path(stream, args.read_size))
+    bench("framed, 7 B reads (worst case)", n // 10,
+          lambda: framed_path(stream[:len(stream) // 10], 7))
+    print(f"speedup: {framed / legacy:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+"""
+Replays traffic recorded with the server's --capture option against a
+fresh server on loopback, so a bad evening in production can be rerun
+against a new build.
+
+Every captured connection is opened again, and the bytes it sent are
+written at the recorded times, scaled by --speed (2 replays twice as
+fast, 0 as fast as possible). Chat messages are matched to their
+deliveries by text, so every delivery of a replayed message yields one
+latency sample; messages with the same text are matched to the latest
+send.
+
+    python3 server/headless.py --capture evening.cap
+    python3 bench/replay.py evening.cap --output before.json
+    python3 bench/replay.py evening.cap --speed 10 --output after.json --baseline before.json
+    python3 bench/replay.py evening.cap.0 evening.cap.1 --speed 0 --workers 2
+
+Captures from a server run with --workers are one file per worker; pass
+them all and they are merged by time. Like load_bench.py, the server's
+flood protection is off unless --rate-limits is given, since a sped-up
+replay would otherwise mostly measure the throttling.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import time
+from array import array
+from datetime import datetime
+
+from load_bench import serve, summarize, compare
+
+from core import ENGINES
+from core.async_network import new_event_loop, raise_open_file_limit
+from core.capture import DATA, CLOSE, merge_captures
+from common.protocol import MsgType, FrameDecoder, ProtocolError, MAGIC
+
+SETTLE_TIME = 1.0
+DRAIN_TIMEOUT = 30.0
+# a replayed connection stops to drain once this much is waiting in its write buffer
+WRITE_HIGH_WATER = 256 * 1024
+
+
+class ReplayConnection:
+    """One captured connection, replayed: writes what the client sent and reads what the server sends back."""
+
+    def __init__(self, port, run):
+        self.port = port
+        self.run = run
+        self.reader = None
+        self.writer = None
+        # the bytes we send are parsed too, to learn when each chat message left
+        self.sent_frames = FrameDecoder()
+        self.parse_sent = None
+        self.closed = False
+        # set when the capture says the client hung up, which is no server disconnect
+        self.hung_up = False
+        self.task = None
+
+    async def open(self):
+        try:
+            self.reader, self.writer = await asyncio.open_connection("127.0.0.1", self.port)
+        except OSError:
+            self.closed = True
+            self.run.failed_connections += 1
+            return
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    async def send(self, data):
+        if self.closed:
+            return
+        run = self.run
+        if self.parse_sent is None:
+            # legacy clients' text chunks are replayed as they are, without timing
+            self.parse_sent = data[:1] == bytes([MAGIC])
+        if self.parse_sent:
+            now = time.perf_counter()
+            try:
+                frames = self.sent_frames.feed(data)
+            except ProtocolError:
+                frames = []
+                self.parse_sent = False
+            run.frames_sent += len(frames)
+            for frame in frames:
+                if frame.type == MsgType.CHAT:
+                    fields = frame.fields()
+                    if fields:
+                        run.sent_at[fields[0].strip()] = now
+                        run.chats_sent += 1
+        run.bytes_sent += len(data)
+        try:
+            self.writer.write(data)
+            if self.writer.transport.get_write_buffer_size() > WRITE_HIGH_WATER:
+                await self.writer.drain()
+        except (ConnectionError, OSError):
+            self.closed = True
+
+    async def read_loop(self):
+        decoder = FrameDecoder()
+        framed = None
+        clock = time.perf_counter
+        run = self.run
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                if framed is None:
+                    framed = data[:1] == bytes([MAGIC])
+                if not framed:
+                    continue
+                now = clock()
+                for frame in decoder.feed(data):
+                    if frame.type != MsgType.CHAT:
+                        continue
+                    fields = frame.fields()
+                    sent = run.sent_at.get(fields[1]) if len(fields) > 1 else None
+                    if sent is not None:
+                        run.latencies.append(now - sent)
+                        run.deliveries += 1
+                        run.last_delivery = now
+        except (ConnectionError, OSError, ProtocolError):
+            pass
+        finally:
+            self.closed = True
+            run.disconnected += not (run.stopping or self.hung_up)
+
+    def close(self):
+        self.closed = self.hung_up = True
+        if self.writer is not None:
+            self.writer.close()
+
+
+class Run:
+    def __init__(self):
+        self.latencies = array("d")
+        self.sent_at = {}
+        self.records = 0
+        self.connections = 0
+        self.failed_connections = 0
+        self.bytes_sent = 0
+        self.frames_sent = 0
+        self.chats_sent = 0
+        self.deliveries = 0
+        self.disconnected = 0
+        self.schedule_lag = 0.0
+        self.stopping = False
+        self.last_delivery = 0.0
+
+
+async def replay(port, records, speed):
+    run = Run()
+    connections = {}
+    clock = time.perf_counter
+    started = clock()
+    captured = 0.0
+    for at, conn, kind, payload in records:
+        captured = at
+        run.records += 1
+        if speed:
+            delay = started + at / speed - clock()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                run.schedule_lag = max(run.schedule_lag, -delay)
+        elif run.records % 256 == 0:
+            # at full speed, give the readers a turn now and then
+            await asyncio.sleep(0)
+        connection = connections.get(conn)
+        if kind == CLOSE:
+            if connection is not None:
+                connection.close()
+                del connections[conn]
+            continue
+        if connection is None:
+            # connections open before the capture started show up with their first data
+            connection = connections[conn] = ReplayConnection(port, run)
+            run.connections += 1
+            await connection.open()
+        if kind == DATA:
+            await connection.send(payload)
+    send_time = clock() - started
+
+    # wait until deliveries have stopped coming in for SETTLE_TIME
+    last, idle, waited = run.deliveries, 0.0, 0.0
+    while idle < SETTLE_TIME and waited < DRAIN_TIMEOUT:
+        await asyncio.sleep(0.1)
+        waited += 0.1
+        idle = idle + 0.1 if run.deliveries == last else 0.0
+        last = run.deliveries
+
+    run.stopping = True
+    tasks = [connection.task for connection in connections.values() if connection.task is not None]
+    for connection in connections.values():
+        connection.close()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    total_time = max(run.last_delivery - started, send_time)
+    results = {
+        "capture_seconds": round(captured, 3),
+        "replay_seconds": round(send_time, 3),
+        "effective_speed": round(captured / send_time, 2) if send_time else None,
+        "schedule_lag_max_ms": round(run.schedule_lag * 1000, 3),
+        "records": run.records,
+        "connections": run.connections,
+        "failed_connections": run.failed_connections,
+        "disconnected_clients": run.disconnected,
+        "bytes_sent": run.bytes_sent,
+        "frames_sent": run.frames_sent,
+        "messages_sent": run.chats_sent,
+        "messages_per_sec": round(run.frames_sent / send_time, 1) if send_time else None,
+        "deliveries": run.deliveries,
+        "deliveries_per_sec": round(run.deliveries / total_time, 1) if total_time else None,
+    }
+    results.update(summarize(run.latencies))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured chat traffic against a fresh server")
+    parser.add_argument("captures", nargs="+", help="capture files; a cluster's per-worker files are merged")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed relative to the capture, 0 for as fast as possible")
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="thread")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the server's flood protection on; off by default so sped-up replays are not throttled")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare against")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must be 0 or more")
+
+    try:
+        records = merge_captures(args.captures)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    raise_open_file_limit()
+    options = {"workers": args.workers}
+    if not args.rate_limits:
+        options["rate_limits"] = None
+
+    conn, child_conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(args.engine, options, child_conn))
+    server.start()
+    port = conn.recv()
+
+    loop = new_event_loop()
+    try:
+        results = loop.run_until_complete(replay(port, records, args.speed))
+    finally:
+        loop.close()
+        conn.send("stop")
+        server_stats = conn.recv() if conn.poll(10) else None
+        server.join(timeout=5)
+
+    if server_stats is not None:
+        results["server_messages_in"] = server_stats["messages_in"]
+        results["server_bytes_written"] = server_stats["bytes_written"]
+        results["throttled_messages"] = server_stats["throttled_messages"]
+        results["flood_disconnects"] = server_stats["flood_disconnects"]
+
+    report = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+        },
+        "config": vars(args),
+        "results": results,
+        "server": server_stats,
+    }
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
 # client/core/__init__.py
 
-from .network import create_connection, send_data, start_receiving
+import os
+import sys
 
-__all__ = ["create_connection", "send_data", "start_receiving"]
\ No newline at end of file
+# the wire protocol lives in common/ at the repository root, shared by the server and the client
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
+from .network import ClientStream, AckTracker, AsyncConnection
+
+__all__ = ["ClientStream", "AckTracker", "AsyncConnection"]
\ No newline at end of file
@@ -1,35 +1,267 @@
+import asyncio
+import os
+import random
 import socket
-import threading
+import time
 
-def create_connection(ip, port=5000):
-    conn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    conn.connect((ip, port))
-    conn.timeout(3)
-    return conn
+from common.protocol import (
+    MsgType, StreamOp, FrameDecoder, DeflateCodec, DEFLATE, RESUMABLE, FILES, CHUNK_SIZE, UPLOAD_WINDOW,
+    encode_frame,
+)
 
-def send_data(connection, message):
-    try:
-        connection.send(message.encode("utf-8"))
-    except Exception as e:
-        print(f"Error sending message: {e}")
-
-def start_receiving(connection, message_handler):
-    def listen():
-        while True:
-            try:
-                data = connection.recv(1024).decode("utf-8")
-                if not data:
-                    break
-                message_handler(data)
-            except Exception as e:
-                print(f"Error receiving data: {e}")
-                break
-    thread = threading.Thread(target=listen, daemon=True)
-    thread.start()
-    return thread
+# a dropped data connection is retried this many times, picking up where it stopped
+TRANSFER_ATTEMPTS = 8
+TRANSFER_TIMEOUT = 30.0
+CONNECT_TIMEOUT = 3.0
+# offer compression, sessions and files; the server's HELLO reply says what it accepted
+OFFERS = (DEFLATE, RESUMABLE, FILES)
 
 def close_connection(connection):
+    try:
+        # shutdown() also wakes a thread blocked in recv() on it
+        connection.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
     try:
         connection.close()
     except:
-        pass
\ No newline at end of file
+        pass
+
+class ClientStream:
+    """
+    The transport-free half of a chat connection, shared by the Qt and the
+    asyncio clients: turns received bytes into frames, answers PINGs and
+    remembers whether the server's HELLO accepted compression.
+    """
+
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.codec = None
+
+    @staticmethod
+    def hello():
+        return encode_frame(MsgType.HELLO, OFFERS)
+
+    def feed(self, data):
+        """Returns the frames completed by data and the bytes to send back right away."""
+        frames = self.decoder.feed(data)
+        replies = b""
+        for frame in frames:
+            if frame.type == MsgType.PING:
+                replies += encode_frame(MsgType.PONG, frame.fields())
+            elif frame.type == MsgType.HELLO:
+                self.codec = DeflateCodec() if DEFLATE in frame.fields() else None
+        return frames, replies
+
+    def encode(self, msg_type, fields, compress=False):
+        """compress is for chat text; it only applies once the server accepted deflate."""
+        if compress and self.codec is not None:
+            return self.codec.encode(msg_type, fields)
+        return encode_frame(msg_type, fields)
+
+class AckTracker:
+    """
+    What this client has received and read in each room, as cumulative
+    seq watermarks. seen() and read() only move them; pending() gives the
+    fields of one ACK covering every room that moved since the last one,
+    so acks go out in batches however many messages arrive.
+    """
+
+    def __init__(self, default_room):
+        self.default_room = default_room
+        self.delivered = {}
+        self.read_to = {}
+        self.sent = {}
+
+    def seen(self, frame):
+        """Notes a received frame; only sequenced room messages count."""
+        if frame.seq is None or frame.type not in (MsgType.CHAT, MsgType.SERVER_CHAT):
+            return
+        fields = frame.fields()
+        room = fields[2] if frame.type == MsgType.CHAT and len(fields) > 2 else self.default_room
+        if frame.seq > self.delivered.get(room, 0):
+            self.delivered[room] = frame.seq
+
+    def read(self, room):
+        """Everything received in room so far has been shown to the user."""
+        self.read_to[room] = self.delivered.get(room, 0)
+
+    def pending(self):
+        fields = []
+        for room, delivered in self.delivered.items():
+            marks = (delivered, self.read_to.get(room, 0))
+            if marks != self.sent.get(room):
+                self.sent[room] = marks
+                fields += [room, str(marks[0]), str(marks[1])]
+        return fields
+
+    def forget(self, room):
+        for marks in (self.delivered, self.read_to, self.sent):
+            marks.pop(room, None)
+
+class AsyncConnection:
+    """
+    Chat connection for asyncio programs, with no GUI or threads involved.
+
+        async with await AsyncConnection.open("127.0.0.1") as connection:
+            await connection.send(MsgType.CHAT, "hi", "general", compress=True)
+            async for frame in connection:
+                ...
+
+    PINGs are answered while frames are read, so a connection that is read
+    regularly stays alive; they are not handed to the caller.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.stream = ClientStream()
+        self.pending = []
+        self.last_seq = 0
+
+    @classmethod
+    async def open(cls, ip, port=5000, timeout=CONNECT_TIMEOUT):
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        connection = cls(reader, writer)
+        writer.write(connection.stream.hello())
+        return connection
+
+    async def send(self, msg_type, *fields, compress=False):
+        self.writer.write(self.stream.encode(msg_type, fields, compress))
+        await self.writer.drain()
+
+    async def recv_batch(self):
+        """Every frame received so far, at least one. Raises ConnectionError once the server closed."""
+        while not self.pending:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("the server closed the connection")
+            frames, replies = self.stream.feed(data)
+            if replies:
+                self.writer.write(replies)
+            for frame in frames:
+                if frame.seq is not None and frame.seq > self.last_seq:
+                    self.last_seq = frame.seq
+                if frame.type != MsgType.PING:
+                    self.pending.append(frame)
+        batch, self.pending = self.pending, []
+        return batch
+
+    async def recv(self):
+        if not self.pending:
+            self.pending = await self.recv_batch()
+        return self.pending.pop(0)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.recv()
+        except (ConnectionError, OSError):
+            raise StopAsyncIteration
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+class TransferError(Exception):
+    pass
+
+def stream_frames(connection):
+    """Yields the frames of a data connection as they arrive."""
+    decoder = FrameDecoder()
+    while True:
+        data = connection.recv(65536)
+        if not data:
+            raise ConnectionError("the data connection closed")
+        for frame in decoder.feed(data):
+            if frame.type == StreamOp.FAIL:
+                raise TransferError(frame.text())
+            yield frame
+
+def open_stream(ip, port, kind, transfer_id, token, offset=0):
+    """Opens a data connection for one transfer; returns it, its frames and the offset the server continues from."""
+    connection = socket.create_connection((ip, port), timeout=TRANSFER_TIMEOUT)
+    connection.sendall(encode_frame(StreamOp.OPEN, [kind, transfer_id, token, str(offset)]))
+    frames = stream_frames(connection)
+    reply = next(frames)
+    if reply.type != StreamOp.OPEN:
+        close_connection(connection)
+        raise TransferError("unexpected reply to OPEN")
+    return connection, frames, int(reply.text())
+
+def retrying(attempt):
+    """Runs attempt() until it returns, retrying dropped connections with jittered backoff."""
+    delay = 0.5
+    for tries in range(TRANSFER_ATTEMPTS):
+        try:
+            return attempt()
+        except (OSError, ConnectionError, StopIteration):
+            if tries == TRANSFER_ATTEMPTS - 1:
+                raise
+        time.sleep(random.uniform(0, delay))
+        delay = min(delay * 2, 10.0)
+
+def upload_file(ip, port, transfer_id, token, path):
+    """
+    Sends a file in CHUNK_SIZE frames on its own connection. At most
+    UPLOAD_WINDOW bytes run ahead of the server's last ACK, and after a
+    dropped connection the upload continues from what the server stored.
+    """
+    size = os.path.getsize(path)
+
+    def attempt():
+        connection, frames, offset = open_stream(ip, port, "upload", transfer_id, token)
+        try:
+            acked = offset
+            with open(path, "rb") as f:
+                f.seek(offset)
+                while offset < size:
+                    chunk = f.read(CHUNK_SIZE)
+                    if not chunk:
+                        raise TransferError(f"{path} shrank while it was being sent")
+                    connection.sendall(encode_frame(StreamOp.CHUNK, payload=chunk))
+                    offset += len(chunk)
+                    while offset - acked > UPLOAD_WINDOW:
+                        frame = next(frames)
+                        if frame.type == StreamOp.ACK:
+                            acked = int(frame.text())
+            connection.sendall(encode_frame(StreamOp.DONE))
+            for frame in frames:
+                if frame.type == StreamOp.DONE:
+                    return
+        finally:
+            close_connection(connection)
+
+    retrying(attempt)
+
+def download_file(ip, port, transfer_id, token, path, size):
+    """Fetches a file into path; a partial file left by a dropped connection is continued, not restarted."""
+    def attempt():
+        offset = os.path.getsize(path) if os.path.exists(path) else 0
+        connection, frames, offset = open_stream(ip, port, "download", transfer_id, token, offset)
+        try:
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                for frame in frames:
+                    if frame.type == StreamOp.CHUNK:
+                        f.write(frame.payload)
+                    elif frame.type == StreamOp.DONE:
+                        break
+            if os.path.getsize(path) != size:
+                raise TransferError(f"got {os.path.getsize(path)} of {size} bytes")
+        finally:
+            close_connection(connection)
+
+    retrying(attempt)
@@ -0,0 +1,92 @@
+from PySide6.QtCore import QObject, QTimer, Signal
+from PySide6.QtNetwork import QAbstractSocket, QTcpSocket
+
+from .network import ClientStream, CONNECT_TIMEOUT
+from common.protocol import ProtocolError
+
+
+class QtConnection(QObject):
+    """
+    Chat connection driven by the Qt event loop through a QTcpSocket, so
+    receiving never needs a thread and every signal is delivered on the GUI
+    thread. Each readyRead drains the socket and hands all the frames it
+    completed to frames_received as one list; PINGs are answered there and
+    then. send() only appends to the socket's write buffer, so it never
+    blocks the window.
+
+    failed(connection, reason) is emitted when connecting does not succeed,
+    closed(connection) once an established connection ends for any reason.
+    """
+
+    connected = Signal(object)
+    failed = Signal(object, str)
+    frames_received = Signal(list)
+    closed = Signal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.stream = ClientStream()
+        self.is_open = False
+        self.done = False
+        self.socket = QTcpSocket(self)
+        self.socket.connected.connect(self.on_connected)
+        self.socket.readyRead.connect(self.on_ready_read)
+        self.socket.disconnected.connect(self.finish)
+        self.socket.errorOccurred.connect(self.on_error)
+        self.connect_timer = QTimer(self)
+        self.connect_timer.setSingleShot(True)
+        self.connect_timer.timeout.connect(lambda: self.fail("Timed out."))
+
+    def open(self, ip, port=5000, timeout=CONNECT_TIMEOUT):
+        self.socket.connectToHost(ip, port)
+        self.connect_timer.start(int(timeout * 1000))
+
+    def send(self, msg_type, *fields, compress=False):
+        if self.is_open:
+            self.socket.write(self.stream.encode(msg_type, fields, compress))
+
+    def close(self):
+        self.connect_timer.stop()
+        self.socket.abort()
+        self.finish()
+
+    def on_connected(self):
+        self.connect_timer.stop()
+        self.is_open = True
+        self.socket.setSocketOption(QAbstractSocket.LowDelayOption, 1)
+        self.socket.write(self.stream.hello())
+        self.connected.emit(self)
+
+    def on_ready_read(self):
+        try:
+            frames, replies = self.stream.feed(self.socket.readAll().data())
+        except ProtocolError as e:
+            print(f"Error receiving data: {e}")
+            self.close()
+            return
+        if replies:
+            self.socket.write(replies)
+        if frames:
+            self.frames_received.emit(frames)
+
+    def on_error(self, error):
+        if not self.is_open:
+            self.fail(self.socket.errorString())
+        elif error != QAbstractSocket.RemoteHostClosedError:
+            print(f"Error receiving data: {self.socket.errorString()}")
+            self.close()
+
+    def fail(self, reason):
+        if self.is_open or self.done:
+            return
+        self.done = True
+        self.connect_timer.stop()
+        self.socket.abort()
+        self.failed.emit(self, reason)
+
+    def finish(self):
+        if not self.is_open or self.done:
+            return
+        self.done = True
+        self.is_open = False
+        self.closed.emit(self)
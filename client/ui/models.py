@@ -0,0 +1,68 @@
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+
+SCROLLBACK_LINES = 5000
+
+
+class RingBuffer:
+    """Fixed-capacity FIFO with O(1) append and O(1) access by row; the oldest items fall off."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = [None] * capacity
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, row):
+        return self.items[(self.start + row) % self.capacity]
+
+    def drop_oldest(self, n):
+        n = min(n, self.count)
+        for _ in range(n):
+            self.items[self.start] = None
+            self.start = (self.start + 1) % self.capacity
+        self.count -= n
+
+    def extend(self, values):
+        for value in values:
+            self.items[(self.start + self.count) % self.capacity] = value
+            self.count += 1
+
+
+class MessageListModel(QAbstractListModel):
+    """
+    Chat scrollback for a QListView. Lines live in a RingBuffer capped at
+    SCROLLBACK_LINES, so memory stays flat however long the session runs,
+    and the view only asks for the rows it is actually painting.
+    """
+
+    def __init__(self, capacity=SCROLLBACK_LINES, parent=None):
+        super().__init__(parent)
+        self.lines = RingBuffer(capacity)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.lines)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and index.isValid():
+            return self.lines[index.row()]
+        return None
+
+    def append_lines(self, lines):
+        """Appends a batch with one remove and one insert notification."""
+        capacity = self.lines.capacity
+        if len(lines) > capacity:
+            lines = lines[-capacity:]
+        if not lines:
+            return
+        overflow = len(self.lines) + len(lines) - capacity
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            self.lines.drop_oldest(overflow)
+            self.endRemoveRows()
+        first = len(self.lines)
+        self.beginInsertRows(QModelIndex(), first, first + len(lines) - 1)
+        self.lines.extend(lines)
+        self.endInsertRows()
@@ -1,17 +1,49 @@
 from PySide6.QtWidgets import (
     QWidget, QMainWindow, QVBoxLayout, QHBoxLayout,
-    QTextEdit, QLineEdit, QPushButton, QLabel, QMessageBox
+    QListView, QLineEdit, QPushButton, QLabel, QMessageBox
 )
-from PySide6.QtGui import QTextCursor
+from PySide6.QtCore import Signal, QObject, QTimer, QEvent
 from utils.styles import load_custom_css
-from core.network import create_connection, send_data, start_receiving
+from core.network import AckTracker, upload_file, download_file
+from core.qt_network import QtConnection
+from common.protocol import MsgType, typing_text
+from .models import MessageListModel
+from collections import deque
+import itertools
+import os
+import random
+import threading
+import time
+
+# the server expires typing state on its own, so re-announce well within its TTL
+TYPING_RESEND = 2.0
+HISTORY_ON_CONNECT = 50
+# ping the server after this much silence, give up on it after HEARTBEAT_TIMEOUT
+HEARTBEAT_INTERVAL = 15.0
+HEARTBEAT_TIMEOUT = 45.0
+# reconnect delays grow from RECONNECT_MIN to RECONNECT_MAX, jittered so clients spread out
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+DEFAULT_ROOM = "general"
+# received frames are rendered in batches at most this often
+FRAME_INTERVAL_MS = 33
+MAX_FRAMES_PER_FLUSH = 2000
+# delivery and read marks are batched into one ACK at most this often
+ACK_INTERVAL = 1.0
+# accepted files are saved here
+DOWNLOAD_DIR = os.path.join(os.path.expanduser("~"), "Downloads")
+
+class Communicator(QObject):
+    transfer_event = Signal(str)
+    # transfer id and the line to show; emitted from the upload's thread, handled on the GUI thread
+    upload_finished = Signal(str, str)
 
 class ServerConnectionDialog(QWidget):
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Connect to Server")
         self.setFixedSize(300, 150)
-        self.client_socket = None
+        self.connection = None
 
         layout = QVBoxLayout()
         self.title = QLabel("Enter the server IP address:")
@@ -32,33 +64,74 @@ class ServerConnectionDialog(QWidget):
 
     def create_connection(self):
         ip = self.address_input.text().strip()
-        if ip:
-            try:
-                self.client_socket = create_connection(ip)
-                self.hide()
-                self.chat_window = ChatClient(ip, self.client_socket)
-                self.chat_window.show()
-            except Exception as e:
-                QMessageBox.critical(
-                    self,
-                    "Connection Error",
-                    f"Could not connect to the server at {ip}:\n{e}",
-                )
+        if ip and self.connection is None:
+            # connecting runs on the event loop, so the dialog stays responsive meanwhile
+            self.connect_button.setEnabled(False)
+            self.connection = QtConnection()
+            self.connection.connected.connect(lambda connection: self.connected(ip, connection))
+            self.connection.failed.connect(lambda connection, reason: self.connect_failed(ip, reason))
+            self.connection.open(ip)
+
+    def connected(self, ip, connection):
+        self.hide()
+        self.chat_window = ChatClient(ip, connection)
+        self.chat_window.show()
+
+    def connect_failed(self, ip, reason):
+        self.connection = None
+        self.connect_button.setEnabled(True)
+        QMessageBox.critical(
+            self,
+            "Connection Error",
+            f"Could not connect to the server at {ip}:\n{reason}",
+        )
 
 
 class ChatClient(QMainWindow):
-    def __init__(self, server_ip, client_socket):
+    def __init__(self, server_ip, connection):
         super().__init__()
         self.setWindowTitle("Chat Client")
         self.resize(420, 380)
 
         self.server_ip = server_ip
         self.username = "Client"
+        self.requested_username = None
         self.server_username = "Server"
-        self.client_socket = client_socket
-
-        self.chat_area = QTextEdit()
-        self.chat_area.setReadOnly(True)
+        self.room = DEFAULT_ROOM
+        self.rooms = {DEFAULT_ROOM}
+        self.last_typing_sent = 0.0
+        self.connection = connection
+        # what a reconnect needs to pick up where the connection dropped
+        self.session_token = None
+        self.last_seq = 0
+        self.reconnecting = False
+        self.reconnect_delay = RECONNECT_MIN
+        # set when the server or the user ended the chat; no reconnecting then
+        self.stopped = False
+        # file transfers: offers we made (by ref until the server numbers them), offers we got
+        self.pending_files = {}
+        self.uploads = {}
+        self.uploading = set()
+        self.file_offers = {}
+        # receipts: what we acked, and the state of our latest message in each room
+        self.acks = AckTracker(DEFAULT_ROOM)
+        self.own_seq = {}
+        self.receipt_text = {}
+
+        # frames arrive in batches per socket read and are rendered in batches per FRAME_INTERVAL_MS
+        self.inbox = deque()
+        self.last_received = time.monotonic()
+        self.flush_scheduled = False
+        self.comm = Communicator()
+        self.comm.transfer_event.connect(lambda line: self.show_lines([line]))
+        self.comm.upload_finished.connect(self.finish_upload)
+
+        self.chat_model = MessageListModel(parent=self)
+        self.chat_area = QListView()
+        self.chat_area.setModel(self.chat_model)
+        self.chat_area.setWordWrap(True)
+        self.chat_area.setLayoutMode(QListView.Batched)
+        self.chat_area.setSelectionMode(QListView.NoSelection)
 
         self.username_input = QLineEdit()
         self.username_input.setPlaceholderText("Username")
@@ -71,12 +144,15 @@ class ChatClient(QMainWindow):
         username_layout.addWidget(self.username_input)
         username_layout.addWidget(self.username_button)
 
-        self.current_user_label = QLabel(f"Connected as: {self.username}")
+        self.current_user_label = QLabel()
+        self.update_user_label()
         self.server_writing = QLabel("")
         self.server_writing.setStyleSheet("font-style: italic; color: #4e88ff;")
+        self.receipt_label = QLabel("")
+        self.receipt_label.setStyleSheet("color: #888888;")
 
         self.input_line = QLineEdit()
-        self.input_line.setPlaceholderText("Message")
+        self.input_line.setPlaceholderText("Message, or /join room, /leave room, /rooms, /msg user text, /send user file, /search words")
         self.input_line.textEdited.connect(self.notify_writing)
         self.input_line.returnPressed.connect(self.send_message)
 
@@ -95,6 +171,7 @@ class ChatClient(QMainWindow):
         layout.addLayout(username_layout)
         layout.addWidget(self.chat_area)
         layout.addWidget(self.server_writing)
+        layout.addWidget(self.receipt_label)
         layout.addLayout(input_layout)
 
         container = QWidget()
@@ -104,91 +181,450 @@ class ChatClient(QMainWindow):
         self.setStyleSheet(load_custom_css())
         self.setup_connection()
 
+        self.heartbeat_timer = QTimer()
+        self.heartbeat_timer.timeout.connect(self.check_heartbeat)
+        self.heartbeat_timer.start(int(HEARTBEAT_INTERVAL * 1000))
+
+        self.ack_timer = QTimer()
+        self.ack_timer.timeout.connect(self.send_acks)
+        self.ack_timer.start(int(ACK_INTERVAL * 1000))
+
     def setup_connection(self):
-        self.chat_area.append(f"✅ Connected to server {self.server_ip}.")
-        self.listen_thread = start_receiving(self.client_socket, self.process_server_message)
+        self.show_lines([f"✅ Connected to server {self.server_ip}."])
+        self.attach(self.connection)
+        self.connection.send(MsgType.HISTORY, "last", str(HISTORY_ON_CONNECT), self.room)
+
+    def update_user_label(self):
+        self.current_user_label.setText(f"Connected as: {self.username} in #{self.room}")
 
     def change_username(self):
         new_username = self.username_input.text().strip()
         if new_username:
-            self.username = new_username
+            # names are unique, so the change only takes effect once the server echoes it
+            self.requested_username = new_username
             try:
-                send_data(self.client_socket, "#usern#" + self.username)
-                self.chat_area.append(f"🔄 Username changed to: {self.username}")
+                self.connection.send(MsgType.RENAME, new_username)
             except Exception as e:
-                self.chat_area.append(f"Error sending username change: {e}")
-            self.current_user_label.setText(f"Connected as: {self.username}")
-        self.username_input.setPlaceholderText(self.username)
+                self.show_lines([f"Error sending username change: {e}"])
         self.username_input.clear()
 
     def notify_writing(self):
+        now = time.monotonic()
+        if now - self.last_typing_sent < TYPING_RESEND:
+            return
+        self.last_typing_sent = now
         try:
-            send_data(self.client_socket, "#writing#" + self.username)
+            self.connection.send(MsgType.TYPING, self.username)
         except Exception as e:
             print(f"Error sending writing status: {e}")
 
     def send_message(self):
         msg = self.input_line.text()
 
-        try:
-            send_data(self.client_socket, "#nowriting#")
-        except Exception as e:
-            self.chat_area.append(f"Error: could not send '#nowriting#'. {e}")
-            return
+        if self.last_typing_sent:
+            self.last_typing_sent = 0.0
+            try:
+                self.connection.send(MsgType.STOP_TYPING)
+            except Exception as e:
+                self.show_lines([f"Error: could not send the stop-typing notice. {e}"])
+                return
 
-        if msg:
-            clean_msg = (
-                msg.replace("#usern#", "")
-                .replace("#writing#", "")
-                .replace("#nowriting#", "")
-                .replace("#other#", "")
-                .replace("#", "")
-            )
+        if msg.startswith("/"):
             try:
-                send_data(self.client_socket, f"#{self.username}#{clean_msg}\n")
-                if clean_msg.upper() == "STOP":
+                self.run_command(msg)
+            except Exception as e:
+                self.show_lines([f"Error: could not send the command. {e}"])
+        elif msg:
+            try:
+                self.connection.send(MsgType.CHAT, msg, self.room, compress=True)
+                if msg.strip().upper() == "STOP":
                     self.close()
             except Exception as e:
-                self.chat_area.append(f"Error: could not send the message. {e}")
+                self.show_lines([f"Error: could not send the message. {e}"])
 
         self.input_line.clear()
 
-    def process_server_message(self, data):
-        data_stripped = data.strip()
-
-        if "#usern#" in data_stripped:
-            new_server_name = data_stripped.replace("#usern#", "")
-            if new_server_name != self.server_username:
-                self.chat_area.append(f"🗣️ The {self.server_username} changed their name to {new_server_name}")
-            self.server_username = new_server_name
-        elif "#writing#" in data_stripped:
-            writing_user = data_stripped.replace("#writing#", "")
-            self.server_writing.setText(f"{writing_user} is typing...")
-        elif "#nowriting#" in data_stripped:
+    def run_command(self, text):
+        command, _, room = text.partition(" ")
+        room = room.strip().lstrip("#")
+        if command == "/msg":
+            user, _, message = room.partition(" ")
+            if user and message.strip():
+                self.connection.send(MsgType.DIRECT, user, message, compress=True)
+        elif command == "/join" and room:
+            self.connection.send(MsgType.JOIN, room)
+            if room not in self.rooms:
+                self.connection.send(MsgType.HISTORY, "last", str(HISTORY_ON_CONNECT), room)
+            self.rooms.add(room)
+            self.room = room
             self.server_writing.setText("")
-        elif "#other#" in data_stripped:
-            message_content = data_stripped.replace("#other#", "")
-            self.chat_area.append(f"{message_content}")
+            self.update_user_label()
+            self.show_receipt()
+        elif command == "/leave":
+            room = room or self.room
+            self.connection.send(MsgType.LEAVE, room)
+            self.rooms.discard(room)
+            self.acks.forget(room)
+            self.own_seq.pop(room, None)
+            self.receipt_text.pop(room, None)
+            if self.room == room:
+                self.room = next(iter(self.rooms), DEFAULT_ROOM)
+                self.update_user_label()
+                self.show_receipt()
+        elif command == "/rooms":
+            self.connection.send(MsgType.ROOMS)
+        elif command == "/send":
+            user, _, path = text.partition(" ")[2].strip().partition(" ")
+            if user and path.strip():
+                self.offer_file(user, path.strip())
+        elif command == "/share":
+            path = text.partition(" ")[2].strip()
+            if path:
+                self.offer_file(f"#{self.room}", path)
+        elif command == "/search":
+            self.search(text.partition(" ")[2])
+        elif command in ("/accept", "/decline", "/cancel") and room:
+            if command == "/accept":
+                self.connection.send(MsgType.FILE_ACCEPT, room)
+            else:
+                self.connection.send(MsgType.FILE_CANCEL, room)
+                self.file_offers.pop(room, None)
         else:
-            self.chat_area.append(f"{self.server_username}: {data_stripped}")
+            self.show_lines([
+                "Commands: /join room, /leave [room], /rooms, /msg user text, "
+                "/send user path, /share path, /accept id, /decline id, /cancel id, "
+                "/search words [#room] [@user] [since:YYYY-MM-DD] [until:YYYY-MM-DD]"
+            ])
+
+    def search(self, text):
+        words, room, user, since, until = [], "", "", "", ""
+        for token in text.split():
+            key, _, value = token.partition(":")
+            if token.startswith("#") and len(token) > 1:
+                room = token[1:]
+            elif token.startswith("@") and len(token) > 1:
+                user = token[1:]
+            elif key in ("from", "since", "until") and value:
+                if key == "from":
+                    user = value
+                    continue
+                try:
+                    moment = time.mktime(time.strptime(value, "%Y-%m-%d"))
+                except ValueError:
+                    self.show_lines([f"🔎 {value} is not a date; use YYYY-MM-DD."])
+                    return
+                # an until date includes the whole of that day
+                if key == "since":
+                    since = str(moment)
+                else:
+                    until = str(moment + 86400)
+            else:
+                words.append(token)
+        if not words and not user:
+            self.show_lines(["🔎 Usage: /search words [#room] [@user] [since:YYYY-MM-DD] [until:YYYY-MM-DD]"])
+            return
+        self.connection.send(MsgType.SEARCH, " ".join(words), room, user, since, until)
 
-        self.chat_area.moveCursor(QTextCursor.End)
+    def offer_file(self, recipient, path):
+        path = os.path.expanduser(path)
+        if not os.path.isfile(path):
+            self.show_lines([f"⚠️ No file at {path}."])
+            return
+        # random, so an offer from someone else is never mistaken for ours
+        ref = os.urandom(6).hex()
+        self.pending_files[ref] = path
+        self.connection.send(
+            MsgType.FILE_OFFER, ref, recipient, os.path.basename(path), str(os.path.getsize(path))
+        )
+
+    def start_upload(self, transfer_id, token, port):
+        """Runs the upload on its own thread and connection, so chat traffic is never stuck behind it."""
+        path = self.uploads.get(transfer_id)
+        if path is None or transfer_id in self.uploading:
+            return
+        self.uploading.add(transfer_id)
 
-        if (not data_stripped.startswith("#other#") and data_stripped.upper() == "STOP"):
-            self.chat_area.append("🛑 The server has ended the connection.")
-            self.input_line.setEnabled(False)
-            self.send_button.setEnabled(False)
-            self.username_input.setEnabled(False)
-            self.username_button.setEnabled(False)
+        def run():
+            try:
+                upload_file(self.server_ip, port, transfer_id, token, path)
+                line = f"📎 Sent {os.path.basename(path)}."
+            except Exception as e:
+                line = f"⚠️ Could not send {os.path.basename(path)}: {e}"
+            self.comm.upload_finished.emit(transfer_id, line)
+        threading.Thread(target=run, daemon=True).start()
+
+    def finish_upload(self, transfer_id, line):
+        self.uploading.discard(transfer_id)
+        self.show_lines([line])
+
+    def start_download(self, transfer_id, token, port, name, size):
+        os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+        base, ext = os.path.splitext(os.path.basename(name))
+        path = os.path.join(DOWNLOAD_DIR, name)
+        for n in itertools.count(1):
+            if not os.path.exists(path):
+                break
+            path = os.path.join(DOWNLOAD_DIR, f"{base} ({n}){ext}")
+
+        def run():
+            try:
+                download_file(self.server_ip, port, transfer_id, token, path, size)
+                self.comm.transfer_event.emit(f"📥 Saved {name} to {path}.")
+            except Exception as e:
+                self.comm.transfer_event.emit(f"⚠️ Could not download {name}: {e}")
+        threading.Thread(target=run, daemon=True).start()
+
+    def send_acks(self):
+        """Timer: one cumulative ACK for every room whose marks moved since the last one."""
+        if self.reconnecting or not self.connection.is_open:
+            return
+        fields = self.acks.pending()
+        if fields:
+            self.connection.send(MsgType.ACK, *fields)
+
+    def changeEvent(self, event):
+        # messages only count as read once the window is in front
+        if event.type() == QEvent.ActivationChange and self.isActiveWindow():
+            self.acks.read(self.room)
+        super().changeEvent(event)
+
+    def show_receipt(self):
+        self.receipt_label.setText(self.receipt_text.get(self.room, ""))
+
+    def check_heartbeat(self):
+        idle = time.monotonic() - self.last_received
+        if idle >= HEARTBEAT_TIMEOUT:
+            self.show_lines(["⚠️ The server stopped responding."])
+            # closing emits closed, which starts the reconnect
+            self.connection.close()
+        elif idle >= HEARTBEAT_INTERVAL:
+            self.connection.send(MsgType.PING)
+
+    def attach(self, connection):
+        connection.setParent(self)
+        connection.frames_received.connect(self.queue_frames)
+        connection.closed.connect(self.connection_lost)
+
+    def connection_lost(self, connection):
+        if connection is not self.connection or self.stopped or self.reconnecting:
+            return
+        self.reconnecting = True
+        self.reconnect_delay = RECONNECT_MIN
+        self.heartbeat_timer.stop()
+        self.set_input_enabled(False)
+        self.show_lines(["⚠️ Connection lost, reconnecting..."])
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        # full jitter, so clients dropped together do not come back together
+        QTimer.singleShot(int(random.uniform(0, self.reconnect_delay) * 1000), self.reconnect)
+        self.reconnect_delay = min(self.reconnect_delay * 2, RECONNECT_MAX)
+
+    def reconnect(self):
+        if self.stopped:
+            return
+        connection = QtConnection(self)
+        connection.connected.connect(self.reconnected)
+        connection.failed.connect(self.reconnect_failed)
+        connection.open(self.server_ip)
+
+    def reconnect_failed(self, connection, reason):
+        connection.deleteLater()
+        self.schedule_reconnect()
+
+    def reconnected(self, connection):
+        old = self.connection
+        self.connection = connection
+        self.reconnecting = False
+        old.close()
+        old.deleteLater()
+        if self.stopped:
+            connection.close()
+            return
+        self.last_received = time.monotonic()
+        self.attach(connection)
+        self.heartbeat_timer.start(int(HEARTBEAT_INTERVAL * 1000))
+        self.set_input_enabled(True)
+        if self.session_token:
+            connection.send(MsgType.RESUME, self.session_token, str(self.last_seq))
+        else:
+            self.rejoin()
+
+    def rejoin(self):
+        """Without a session to resume, join the rooms again and fetch what was missed."""
+        for room in sorted(self.rooms):
+            if room != DEFAULT_ROOM:
+                self.connection.send(MsgType.JOIN, room)
+            self.connection.send(MsgType.HISTORY, "since", str(self.last_seq), room)
+        if self.username != "Client":
+            self.requested_username = self.username
+            self.connection.send(MsgType.RENAME, self.username)
+
+    def queue_frames(self, frames):
+        """Queues one socket read's worth of frames; they are rendered on the next flush."""
+        self.last_received = time.monotonic()
+        for frame in frames:
+            if frame.seq is not None and frame.seq > self.last_seq:
+                self.last_seq = frame.seq
+            self.acks.seen(frame)
+            # the close usually follows in the same read, well before the flush; it must not reconnect
+            if frame.type == MsgType.BYE or (
+                frame.type == MsgType.SERVER_CHAT and frame.fields()[0].strip().upper() == "STOP"
+            ):
+                self.stopped = True
+            if frame.type not in (MsgType.PING, MsgType.PONG):
+                self.inbox.append(frame)
+        if self.inbox and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.schedule_flush()
+
+    def schedule_flush(self):
+        QTimer.singleShot(FRAME_INTERVAL_MS, self.flush_inbox)
+
+    def flush_inbox(self):
+        self.flush_scheduled = False
+        lines = []
+        for _ in range(min(len(self.inbox), MAX_FRAMES_PER_FLUSH)):
+            self.process_server_message(self.inbox.popleft(), lines)
+        self.show_lines(lines)
+        if self.isActiveWindow():
+            self.acks.read(self.room)
+        if self.inbox and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.schedule_flush()
+
+    def show_lines(self, lines):
+        scrollbar = self.chat_area.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum()
+        self.chat_model.append_lines(lines)
+        if lines and at_bottom:
+            self.chat_area.scrollToBottom()
+
+    def process_server_message(self, frame, lines):
+        fields = frame.fields()
+
+        if frame.type == MsgType.SESSION:
+            self.session_token = fields[0]
+        elif frame.type == MsgType.RESUME:
+            if fields[0] == "expired":
+                lines.append("🔌 Reconnected, but the old session had expired.")
+                self.rejoin()
+            elif fields[0] == "partial":
+                lines.append(f"🔌 Reconnected; the latest {fields[1]} missed message(s) caught up, older ones were skipped.")
+            else:
+                lines.append(f"🔌 Reconnected; {fields[1]} missed message(s) caught up.")
+        elif frame.type == MsgType.BYE:
+            lines.append(f"⛔ {fields[0]}")
+            self.stopped = True
+            self.set_input_enabled(False)
+        elif frame.type == MsgType.SERVER_NAME:
+            new_server_name = fields[0]
+            if new_server_name != self.server_username:
+                lines.append(f"🗣️ The {self.server_username} changed their name to {new_server_name}")
+            self.server_username = new_server_name
+        elif frame.type == MsgType.TYPING:
+            if fields[0] == self.room:
+                others = [name for name in fields[1:] if name != self.username]
+                self.server_writing.setText(typing_text(others))
+        elif frame.type == MsgType.STOP_TYPING:
+            if not fields or fields[0] == self.room:
+                self.server_writing.setText("")
+        elif frame.type == MsgType.CHAT:
+            room = fields[2] if len(fields) > 2 else self.room
+            prefix = "" if room == self.room else f"[#{room}] "
+            lines.append(f"{prefix}{fields[0]}: {fields[1]}")
+            if fields[0] == self.username and frame.seq is not None:
+                self.own_seq[room] = frame.seq
+                self.receipt_text[room] = "✓ Sent"
+                if room == self.room:
+                    self.show_receipt()
+        elif frame.type == MsgType.RENAME:
+            if fields[1] == self.requested_username:
+                self.username = fields[1]
+                self.requested_username = None
+                self.update_user_label()
+                self.username_input.setPlaceholderText(self.username)
+                lines.append(f"🔄 Username changed to: {self.username}")
+            else:
+                lines.append(f"🗣️ {fields[0]} changed their name to {fields[1]}")
+        elif frame.type == MsgType.DIRECT:
+            lines.append(f"🔒 {fields[0]} → {fields[1]}: {fields[2]}")
+        elif frame.type == MsgType.SYSTEM:
+            lines.append(fields[0])
+        elif frame.type == MsgType.SERVER_CHAT:
+            lines.append(f"{self.server_username}: {fields[0]}")
+        elif frame.type == MsgType.HISTORY:
+            if fields[0] != "0":
+                room = fields[1] if len(fields) > 1 else self.room
+                lines.append(f"📜 {fields[0]} earlier messages from #{room} above")
+        elif frame.type == MsgType.JOIN:
+            lines.append(f"➡️ {fields[1]} joined #{fields[0]}")
+        elif frame.type == MsgType.LEAVE:
+            lines.append(f"⬅️ {fields[1]} left #{fields[0]}")
+        elif frame.type == MsgType.FILE_OFFER:
+            transfer_id, ref, sender, recipient, name, size = fields[:6]
+            path = self.pending_files.pop(ref, None)
+            if path is not None:
+                self.uploads[transfer_id] = path
+                lines.append(f"📎 Offered {name} to {recipient}; it is sent once accepted. /cancel {transfer_id} withdraws it.")
+            else:
+                self.file_offers[transfer_id] = (sender, name)
+                lines.append(
+                    f"📎 {sender} offers {name} ({int(size) / 1024:.1f} KiB)"
+                    f"{'' if not recipient.startswith('#') else ' to ' + recipient}. "
+                    f"/accept {transfer_id} or /decline {transfer_id}"
+                )
+        elif frame.type == MsgType.FILE_ACCEPT:
+            transfer_id, name, token, port = fields[:4]
+            lines.append(f"📎 {name} accepted transfer {transfer_id}.")
+            self.start_upload(transfer_id, token, int(port))
+        elif frame.type == MsgType.FILE_READY:
+            transfer_id, token, port, name, size = fields[:5]
+            self.file_offers.pop(transfer_id, None)
+            lines.append(f"📥 Downloading {name}...")
+            self.start_download(transfer_id, token, int(port), name, int(size))
+        elif frame.type == MsgType.FILE_CANCEL:
+            self.uploads.pop(fields[0], None)
+            self.file_offers.pop(fields[0], None)
+            lines.append(f"📎 {fields[1]}")
+        elif frame.type == MsgType.SEARCH:
+            if fields[0] == "hit":
+                _, _, room, sender, sent, text = fields[:6]
+                when = time.strftime("%Y-%m-%d %H:%M", time.localtime(float(sent)))
+                lines.append(f"🔎 [#{room}] {when} {sender}: {text}")
+            else:
+                more = "" if fields[2] == "complete" else "; the search stopped early, narrow it down for more"
+                lines.append(f"🔎 {fields[1]} result(s){more}")
+        elif frame.type == MsgType.RECEIPT:
+            latest = {seq: room for room, seq in self.own_seq.items()}
+            for i in range(0, len(fields) - 3, 4):
+                room = latest.get(int(fields[i]))
+                if room is None:
+                    continue
+                delivered, read, recipients = (int(field) for field in fields[i + 1:i + 4])
+                if read and read >= recipients:
+                    self.receipt_text[room] = "✓✓ Read by everyone"
+                elif read:
+                    self.receipt_text[room] = f"✓✓ Read by {read} of {recipients}"
+                else:
+                    self.receipt_text[room] = f"✓ Delivered to {delivered} of {recipients}"
+            self.show_receipt()
+        elif frame.type == MsgType.ROOMS:
+            rooms = [f"#{fields[i]} ({fields[i + 1]})" for i in range(0, len(fields) - 1, 2)]
+            lines.append("🏠 Rooms: " + ", ".join(rooms))
+
+        if frame.type == MsgType.SERVER_CHAT and fields[0].strip().upper() == "STOP":
+            lines.append("🛑 The server has ended the connection.")
+            self.stopped = True
+            self.set_input_enabled(False)
+
+    def set_input_enabled(self, enabled):
+        self.input_line.setEnabled(enabled)
+        self.send_button.setEnabled(enabled)
+        self.username_input.setEnabled(enabled)
+        self.username_button.setEnabled(enabled)
 
     def closeEvent(self, event):
-        try:
-            send_data(self.client_socket, "Goodbye folks")
-        except:
-            pass
-        finally:
-            try:
-                self.client_socket.close()
-            except:
-                pass
+        self.stopped = True
+        self.connection.close()
         event.accept()
\ No newline at end of file
@@ -0,0 +1,5 @@
+# common/__init__.py
+
+from .protocol import MsgType, Frame, FrameDecoder, ProtocolError, FrameCodec, DeflateCodec, LegacyCodec, encode_frame
+
+__all__ = ["MsgType", "Frame", "FrameDecoder", "ProtocolError", "FrameCodec", "DeflateCodec", "LegacyCodec", "encode_frame"]
\ No newline at end of file
@@ -0,0 +1,375 @@
+import re
+import struct
+import time
+import zlib
+from collections import namedtuple
+from enum import IntEnum
+
+# Wire format (version 1), all integers big-endian:
+#
+#   magic:u8  version:u8  type:u8  flags:u8  length:u32  [seq:u32]  payload
+#
+# seq is present when FLAG_SEQ is set. With FLAG_DEFLATE the payload is raw
+# deflate against CHAT_DICTIONARY and length is its compressed size; a peer
+# only sends such frames after both sides listed DEFLATE in their HELLO.
+# Text payloads are UTF-8 fields joined by FIELD_SEP. MAGIC is a byte that
+# never occurs in UTF-8, so the first byte a client sends tells a framed
+# client from a legacy "#tag#" one.
+
+MAGIC = 0xFB
+VERSION = 1
+FLAG_SEQ = 0x01
+FLAG_DEFLATE = 0x02
+FIELD_SEP = "\x1f"
+MAX_PAYLOAD = 1 << 20
+
+HEADER = struct.Struct("!BBBBI")
+SEQ = struct.Struct("!I")
+
+LEGACY_TAGS = ("#usern#", "#writing#", "#nowriting#", "#other#")
+
+# HELLO capability for compressed frames; the suffix versions the dictionary
+DEFLATE = "deflate-chat1"
+# HELLO capability for resumable sessions (SESSION and RESUME)
+RESUMABLE = "resume1"
+# HELLO capability for file transfers (FILE_* messages and a data connection)
+FILES = "files1"
+# shorter payloads are not worth a compressor's setup cost
+COMPRESS_THRESHOLD = 256
+COMPRESS_LEVEL = 6
+
+# Preset dictionary primed with what long chat messages tend to contain:
+# pasted logs, tracebacks and code. deflate matches against the end of the
+# dictionary most cheaply, so the most common strings come last. Changing
+# it breaks compatibility; add a new DEFLATE version instead.
+CHAT_DICTIONARY = (
+    "SELECT * FROM WHERE ORDER BY GROUP BY INSERT INTO VALUES UPDATE SET "
+    "<div class=\"</div> <span></span> <a href=\"https://www. .com/ .org/ "
+    "#include <stdio.h> int main(int argc, char **argv) { printf(\"%s\\n\", "
+    "public static void private final String class interface extends implements "
+    "function const let var => console.log( module.exports require(\" export default "
+    "} else { } catch (e) { throw new Error(\" null undefined true false "
+    "\"id\": \"name\": \"type\": \"value\": \"status\": \"error\": \"message\": "
+    "$ sudo apt-get install pip install npm install git commit -m \" git push origin main "
+    "Exception: ValueError: TypeError: KeyError: AttributeError: ImportError: "
+    "Traceback (most recent call last):\n  File \"/usr/lib/python3/ line , in <module>\n    "
+    "def __init__(self, self. return None if not for in range(len( import from "
+    "DEBUG INFO WARNING WARN ERROR CRITICAL FATAL 2025-01-01T00:00:00.000Z "
+    "http://localhost:8080/api/v1/ 127.0.0.1 GET POST HTTP/1.1\" 200 404 500 "
+    "failed to connect: connection refused timeout not found permission denied "
+    "I think that it's the and the to the of the in the is not this is what do you "
+    "can you please thanks! yes no ok lol haha :) :( https:// "
+).encode("utf-8")
+
+
+class MsgType(IntEnum):
+    HELLO = 0          # client -> server: protocol handshake
+    CHAT = 1           # client: text[, room] / server: sender, text, room
+    SERVER_CHAT = 2    # server: text written by the server operator
+    RENAME = 3         # client: new name / server: old, new
+    SERVER_NAME = 4    # server: operator display name
+    TYPING = 5         # server: room, names of everyone typing in it
+    STOP_TYPING = 6    # server: room
+    SYSTEM = 7         # server: notice text
+    HISTORY = 8        # client: "last", count | "since", seq [, room] / server: end of replay, count, room
+    JOIN = 9           # client: room / server: room, name of who joined
+    LEAVE = 10         # client: room / server: room, name of who left
+    ROOMS = 11         # client: list request / server: room, member count, room, member count...
+    DIRECT = 12        # client: recipient name, text / server: sender, recipient, text
+    PING = 13          # either side: liveness probe, optional token
+    PONG = 14          # either side: answer to PING, echoing its token
+    SESSION = 15       # server: session token to resume with after a reconnect
+    RESUME = 16        # client: session token, last seq seen / server: "resumed"|"partial"|"expired", replayed count
+    BYE = 17           # server: reason; the server closed the connection on purpose, do not reconnect
+    FILE_OFFER = 18    # client: ref, recipient name or "#room", file name, size / server: transfer id, ref, sender, recipient, file name, size
+    FILE_ACCEPT = 19   # client: transfer id / server to the sender: transfer id, who accepted, upload token, data port
+    FILE_READY = 20    # server: transfer id, download token, data port, file name, size
+    FILE_CANCEL = 21   # client: transfer id, to withdraw or decline an offer / server: transfer id, reason
+    SEARCH = 22        # client: words, room or "", sender or "", since, until (unix times or "") / server: "hit", seq, room, sender, time, text | "end", count, "complete"|"partial"
+    ACK = 23           # client: room, delivered seq, read seq, for each room whose marks moved; cumulative per room
+    RECEIPT = 24       # server to a sender: seq, delivered count, read count, recipients, for each of its messages whose counts changed
+
+
+class StreamOp(IntEnum):
+    """
+    Frame types on a file transfer's data connection, which is separate
+    from the chat connection and carries one transfer at a time.
+    """
+    OPEN = 0           # client: "upload"|"download", transfer id, token, offset / server: offset the transfer continues from
+    CHUNK = 1          # uploader or server: the next bytes of the file, at most CHUNK_SIZE
+    ACK = 2            # server: bytes of the upload stored so far
+    DONE = 3           # client: upload finished / server: transfer complete
+    FAIL = 4           # server: reason; the connection closes after it
+
+
+# data connections carry files in chunks this big; the uploader keeps at
+# most UPLOAD_WINDOW bytes past the server's last ACK in flight
+CHUNK_SIZE = 64 * 1024
+ACK_INTERVAL = 256 * 1024
+UPLOAD_WINDOW = 1024 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class Frame(namedtuple("Frame", "type seq payload")):
+    __slots__ = ()
+
+    def text(self):
+        return str(self.payload, "utf-8", "replace")
+
+    def fields(self):
+        payload = self[2]
+        if not payload:
+            return []
+        return str(payload, "utf-8", "replace").split(FIELD_SEP)
+
+
+class DeflatedFrame(Frame):
+    """
+    A FLAG_DEFLATE frame from a FrameDecoder(inflate=False), its payload
+    still compressed, so it can be judged by type and wire size before any
+    work goes into it. inflated() gives the plain Frame.
+    """
+
+    __slots__ = ()
+
+    def inflated(self, max_size=MAX_PAYLOAD):
+        return tuple.__new__(Frame, (self[0], self[1], inflate(self[2], max_size)))
+
+
+def encode_payload(fields):
+    return FIELD_SEP.join(fields).encode("utf-8")
+
+
+def encode_frame(msg_type, fields=(), seq=None, payload=None, flags=0):
+    if payload is None:
+        payload = encode_payload(fields)
+    if seq is None:
+        return HEADER.pack(MAGIC, VERSION, msg_type, flags, len(payload)) + payload
+    return HEADER.pack(MAGIC, VERSION, msg_type, flags | FLAG_SEQ, len(payload)) + SEQ.pack(seq) + payload
+
+
+def deflate(payload, level=COMPRESS_LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=CHAT_DICTIONARY)
+    return compressor.compress(payload) + compressor.flush()
+
+
+def inflate(data, max_size=MAX_PAYLOAD):
+    """Decompresses a FLAG_DEFLATE payload, refusing anything that inflates past max_size."""
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=CHAT_DICTIONARY)
+    try:
+        payload = decompressor.decompress(data, max_size)
+    except zlib.error as e:
+        raise ProtocolError(f"bad compressed payload: {e}")
+    if decompressor.unconsumed_tail:
+        raise ProtocolError(f"compressed payload inflates past {max_size} bytes")
+    if not decompressor.eof:
+        raise ProtocolError("truncated compressed payload")
+    return payload
+
+
+class FrameDecoder:
+    """
+    Incremental decoder. feed() accepts whatever recv() returned and gives
+    back every complete frame in it. Payloads are memoryview slices of the
+    received bytes; only a trailing partial frame is copied and kept until
+    the rest arrives. With inflate=False compressed frames come back as
+    DeflatedFrames for the caller to inflate once it has accepted them.
+    """
+
+    def __init__(self, max_payload=MAX_PAYLOAD, inflate=True):
+        self.max_payload = max_payload
+        self.inflate = inflate
+        self._pending = bytearray()
+        self._needed = 0
+
+    def feed(self, data):
+        if self._pending:
+            self._pending += data
+            if len(self._pending) < self._needed:
+                return []
+            data = bytes(self._pending)
+            self._pending = bytearray()
+
+        view = memoryview(data)
+        end = len(data)
+        pos = 0
+        frames = []
+        append = frames.append
+        unpack_header = HEADER.unpack_from
+        header_size = HEADER.size
+        new_frame = tuple.__new__
+        max_payload = self.max_payload
+        eager = self.inflate
+        while True:
+            if end - pos < header_size:
+                self._needed = header_size
+                break
+            magic, version, msg_type, flags, length = unpack_header(data, pos)
+            if magic != MAGIC or version != VERSION:
+                raise ProtocolError(f"bad frame header {magic:#x}/{version}")
+            if length > max_payload:
+                raise ProtocolError(f"frame of {length} bytes exceeds {max_payload}")
+            start = pos + header_size
+            if flags & FLAG_SEQ:
+                stop = start + SEQ.size + length
+                if stop > end:
+                    self._needed = stop - pos
+                    break
+                seq = SEQ.unpack_from(data, start)[0]
+                start += SEQ.size
+            else:
+                stop = start + length
+                if stop > end:
+                    self._needed = stop - pos
+                    break
+                seq = None
+            payload = view[start:stop]
+            if not flags & FLAG_DEFLATE:
+                append(new_frame(Frame, (msg_type, seq, payload)))
+            elif eager:
+                append(new_frame(Frame, (msg_type, seq, inflate(payload, max_payload))))
+            else:
+                append(new_frame(DeflatedFrame, (msg_type, seq, payload)))
+            pos = stop
+
+        if pos < end:
+            self._pending += view[pos:]
+        return frames
+
+
+def parse_legacy(data):
+    """
+    Classifies one legacy chunk the way the text protocol always did.
+    Returns a Frame, or None for chunks the protocol ignores. Legacy chat
+    messages carry their own sender name as a second field.
+    """
+    if "#usern#" in data:
+        return Frame(MsgType.RENAME, None, encode_payload([data.replace("#usern#", "")]))
+    if "#writing#" in data:
+        return Frame(MsgType.TYPING, None, encode_payload([data.replace("#writing#", "")]))
+    if "#nowriting#" in data:
+        return Frame(MsgType.STOP_TYPING, None, b"")
+    match = re.search(r"#(.*?)#", data)
+    if match is None:
+        return None
+    msg = re.sub(r"#.*?#", "", data).strip()
+    return Frame(MsgType.CHAT, None, encode_payload([msg, match.group(1)]))
+
+
+def strip_legacy_tags(text):
+    for tag in LEGACY_TAGS:
+        text = text.replace(tag, "")
+    return text
+
+
+def encode_legacy(msg_type, fields=(), seq=None):
+    fields = [strip_legacy_tags(f) for f in fields]
+    if msg_type == MsgType.CHAT:
+        text = f"#other#{fields[0]}: {fields[1]}"
+    elif msg_type == MsgType.SERVER_CHAT:
+        text = f"{fields[0]}\n"
+    elif msg_type == MsgType.RENAME:
+        text = f"🗣️ {fields[0]} changed their name to {fields[1]}"
+    elif msg_type == MsgType.SERVER_NAME:
+        text = f"#usern#{fields[0]}"
+    elif msg_type == MsgType.TYPING:
+        text = "#writing#" + ", ".join(fields[1:])
+    elif msg_type == MsgType.STOP_TYPING:
+        text = "#nowriting#"
+    elif msg_type == MsgType.SYSTEM:
+        text = fields[0]
+    elif msg_type == MsgType.JOIN:
+        text = f"➡️ {fields[1]} joined #{fields[0]}"
+    elif msg_type == MsgType.LEAVE:
+        text = f"⬅️ {fields[1]} left #{fields[0]}"
+    elif msg_type == MsgType.BYE:
+        text = f"⛔ {fields[0]}"
+    elif msg_type == MsgType.DIRECT:
+        text = f"#other#{fields[0]} (private to {fields[1]}): {fields[2]}"
+    else:
+        return b""
+    return text.encode("utf-8")
+
+
+def typing_text(names):
+    if not names:
+        return ""
+    if len(names) == 1:
+        return f"{names[0]} is typing..."
+    if len(names) <= 3:
+        return f"{', '.join(names[:-1])} and {names[-1]} are typing..."
+    return f"{', '.join(names[:2])} and {len(names) - 2} others are typing..."
+
+
+class FrameCodec:
+    """
+    The framed protocol as the server reads it: decode() leaves compressed
+    payloads packed, as DeflatedFrames, so rate limits are applied to the
+    wire size before anything is inflated.
+    """
+
+    name = "frame"
+
+    def __init__(self):
+        self.decoder = FrameDecoder(inflate=False)
+
+    def decode(self, data):
+        return self.decoder.feed(data)
+
+    @staticmethod
+    def encode(msg_type, fields=(), seq=None):
+        return encode_frame(msg_type, fields, seq)
+
+
+class DeflateCodec(FrameCodec):
+    """
+    The framed protocol for peers that listed DEFLATE in their HELLO.
+    Payloads of threshold bytes or more go out compressed, unless that
+    would not make them smaller. Pass stats to have every compression
+    counted with stats.count_compression(raw, compressed, seconds).
+    """
+
+    name = "deflate"
+
+    def __init__(self, stats=None, threshold=COMPRESS_THRESHOLD):
+        super().__init__()
+        self.stats = stats
+        self.threshold = threshold
+
+    def encode(self, msg_type, fields=(), seq=None):
+        payload = encode_payload(fields)
+        if len(payload) < self.threshold:
+            return encode_frame(msg_type, seq=seq, payload=payload)
+        started = time.perf_counter()
+        compressed = deflate(payload)
+        if self.stats is not None:
+            self.stats.count_compression(len(payload), len(compressed), time.perf_counter() - started)
+        if len(compressed) >= len(payload):
+            return encode_frame(msg_type, seq=seq, payload=payload)
+        return encode_frame(msg_type, seq=seq, payload=compressed, flags=FLAG_DEFLATE)
+
+
+class LegacyCodec:
+    """The original "#tag#" text protocol: every recv() chunk is one message."""
+
+    name = "legacy"
+
+    def decode(self, data):
+        frame = parse_legacy(data.decode("utf-8", "replace"))
+        return [] if frame is None else [frame]
+
+    @staticmethod
+    def encode(msg_type, fields=(), seq=None):
+        return encode_legacy(msg_type, fields, seq)
+
+
+CODECS = {codec.name: codec for codec in (FrameCodec, DeflateCodec, LegacyCodec)}
+
+
+def detect_codec(first_chunk):
+    if first_chunk[:1] == bytes([MAGIC]):
+        return FrameCodec()
+    return LegacyCodec()
@@ -1,5 +1,27 @@
 # server/core/__init__.py
 
+import os
+import sys
+
+# the wire protocol lives in common/ at the repository root, shared by the server and the client
+_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+if _ROOT not in sys.path:
+    sys.path.append(_ROOT)
+
 from .network import ChatServer
+from .async_network import AsyncChatServer
+from .cluster import ClusterServer
+
+ENGINES = {
+    "thread": ChatServer,
+    "asyncio": AsyncChatServer,
+}
+
+
+def create_server(engine="thread", workers=1, **options):
+    """Builds a server on the given engine, sharded over worker processes when workers > 1."""
+    if workers > 1:
+        return ClusterServer(workers=workers, worker_engine=engine, **options)
+    return ENGINES[engine](**options)
 
-__all__ = ["ChatServer"]
\ No newline at end of file
+__all__ = ["ChatServer", "AsyncChatServer", "ClusterServer", "ENGINES", "create_server"]
\ No newline at end of file
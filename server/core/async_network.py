@@ -0,0 +1,224 @@
+import asyncio
+import sys
+import threading
+import time
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from .base import BaseChatServer
+from .instrument import WRITE
+from .network import create_listener
+from common.protocol import LegacyCodec
+
+WRITE_BUFFER_HIGH = 64 * 1024
+FLUSH_BATCH = 256
+
+
+VECTORED_WRITELINES = uvloop is not None or sys.version_info >= (3, 12)
+
+
+def new_event_loop():
+    if uvloop is not None:
+        return uvloop.new_event_loop()
+    return asyncio.new_event_loop()
+
+
+def raise_open_file_limit():
+    """
+    Lifts the soft RLIMIT_NOFILE to the hard limit. Every connection costs
+    one descriptor, and the default soft limit (often 1024) is far below
+    what a single event loop can hold.
+    """
+    if resource is None:
+        return
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard == resource.RLIM_INFINITY or hard > soft:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+
+class ClientProtocol(asyncio.Protocol):
+    """
+    One connected client. send() queues into the client's OutboundQueue and
+    a flush scheduled for the end of the loop iteration hands the queue to
+    the transport. While the transport's buffer is above its high-water mark
+    the queue absorbs (and, when full, sheds) the backlog instead.
+
+    Legacy clients tell messages apart by send, so they are written one
+    message at a time with a zero high-water mark: the next one is handed
+    over only once the transport has sent the previous one.
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.codec = None
+        self.outbound = server.new_outbound_queue()
+        self.paused = False
+        self.flush_scheduled = False
+        self.legacy = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.server.client_connected(self, transport.get_extra_info("peername"))
+
+    def data_received(self, data):
+        try:
+            keep_open = self.server.handle_data(self, data)
+        except Exception as e:
+            print(f"Error in handle_data: {e}")
+            keep_open = False
+        if not keep_open:
+            self.transport.close()
+
+    def connection_lost(self, exc):
+        self.server.client_disconnected(self)
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    def send(self, data, msg_type=None):
+        if self.transport.is_closing():
+            return True
+        if not self.outbound.push(data, msg_type):
+            return False
+        if not self.flush_scheduled and not self.paused:
+            self.flush_scheduled = True
+            self.server.loop.call_soon(self.flush)
+        return True
+
+    def flush(self):
+        self.flush_scheduled = False
+        stats = self.server.stats
+        if not self.legacy and isinstance(self.codec, LegacyCodec):
+            self.legacy = True
+            self.transport.set_write_buffer_limits(high=0, low=0)
+        while not self.paused and not self.transport.is_closing():
+            batch = self.outbound.pop_many(1 if self.legacy else FLUSH_BATCH)
+            if not batch:
+                break
+            # uvloop and Python 3.12+ turn writelines() into a single writev
+            probe = self.server.probe
+            if probe is None:
+                self.transport.writelines(batch)
+            else:
+                started = time.perf_counter_ns()
+                self.transport.writelines(batch)
+                probe.record(WRITE, None, time.perf_counter_ns() - started)
+            stats.write_calls += 1
+            stats.bytes_written += sum(map(len, batch))
+            if len(batch) > 1 and not VECTORED_WRITELINES:
+                stats.bytes_copied += sum(map(len, batch))
+
+    def close(self):
+        # hand over what is still queued, such as a BYE; the transport writes it before closing
+        self.flush()
+        self.transport.close()
+
+
+class AsyncChatServer(BaseChatServer):
+    """
+    Single-threaded asyncio engine with the same surface as ChatServer.
+    An idle client costs one transport object instead of a thread stack,
+    so one process holds tens of thousands of connections. uvloop is used
+    when it is installed.
+    """
+
+    def __init__(self, host="0.0.0.0", port=5000, backlog=1024, listener=None, **options):
+        super().__init__(**options)
+        raise_open_file_limit()
+        self.server_socket = listener or create_listener(host, port, backlog)
+        self.server_socket.setblocking(False)
+
+        self.loop = None
+        self.loop_thread = None
+        self.on_new_connection = None
+        self._server = None
+
+    def start_listening(self, on_new_connection):
+        ready = threading.Event()
+        self.loop_thread = threading.Thread(
+            target=self.serve_forever, args=(on_new_connection, ready), daemon=True
+        )
+        self.loop_thread.start()
+        ready.wait()
+
+    def serve_forever(self, on_new_connection, ready=None):
+        """Runs the event loop in the calling thread until shutdown()."""
+        self.on_new_connection = on_new_connection
+        self.loop_thread = threading.current_thread()
+        self.loop = new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            self._server = self.loop.run_until_complete(
+                self.loop.create_server(lambda: ClientProtocol(self), sock=self.server_socket)
+            )
+        finally:
+            if ready is not None:
+                ready.set()
+        self.start_timers()
+        try:
+            self.loop.run_forever()
+        finally:
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def start_timers(self):
+        for interval, func, blocking in self.timers:
+            if blocking:
+                threading.Thread(target=self._run_timer, args=(interval, func), daemon=True).start()
+            else:
+                self.loop.call_later(interval, self._run_loop_timer, interval, func)
+        self.start_relay()
+
+    def _run_loop_timer(self, interval, func):
+        if self.stopped.is_set():
+            return
+        try:
+            func()
+        except Exception as e:
+            print(f"Error in timer {func.__name__}: {e}")
+        self.loop.call_later(interval, self._run_loop_timer, interval, func)
+
+    def client_connected(self, client, addr):
+        self.register_client(client, addr)
+        if self.on_new_connection:
+            self.on_new_connection(client, addr)
+
+    def wait_closed(self, timeout=None):
+        if self.loop_thread is not None and self.loop_thread is not threading.current_thread():
+            self.loop_thread.join(timeout)
+
+    def call(self, func, *args):
+        loop = self.loop
+        if loop is None or loop.is_closed() or threading.current_thread() is self.loop_thread:
+            func(*args)
+        else:
+            loop.call_soon_threadsafe(func, *args)
+
+    def close_client(self, client):
+        client.close()
+
+    def close_listener(self):
+        if self._server is not None:
+            self._server.close()
+        else:
+            self.server_socket.close()
+        if self.loop is not None and self.loop.is_running():
+            # let the connection_lost callbacks queued by close() run first
+            self.loop.call_soon(self.loop.stop)
@@ -0,0 +1,1054 @@
+import itertools
+import threading
+import time
+
+from common.protocol import (
+    MsgType, FIELD_SEP, CODECS, DEFLATE, RESUMABLE, FILES, COMPRESS_THRESHOLD, DeflateCodec, DeflatedFrame, LegacyCodec,
+    detect_codec, encode_payload, typing_text,
+)
+from .outbound import OutboundQueue, POLICIES, DEFAULT_QUEUE_LIMIT, DROP_TYPING
+from .stats import ServerStats
+from .presence import PresenceEngine, PUBLISH_INTERVAL
+from .history import RoomHistory, SYNC_INTERVAL, valid_room
+from .directory import UserDirectory
+from .timerwheel import TimerWheel
+from .sessions import SessionTable, ReplayBuffer, REPLAY_LIMIT
+from .instrument import Probe, DECODE, ROUTE, ENQUEUE
+from .search import SearchIndex, INDEX_INTERVAL, merge_by_seq
+from .ratelimit import RateLimits, FloodGuard, KICK
+from .relay import Relay, RELAY_WINDOW
+from .receipts import ReceiptTable, RECEIPT_INTERVAL
+from .capture import TrafficCapture
+from .transfer import TransferTable, TransferServer, TransferRefused, FILE_RATE, MAX_FILE_SIZE, safe_file_name
+
+SERVER_KEY = "server"
+# every client starts here; messages without a room, such as the operator's, are recorded here
+DEFAULT_ROOM = "general"
+HANDSHAKE_GRACE = 0.5
+# a client silent this long is pinged every third of it, then dropped
+IDLE_TIMEOUT = 45.0
+WHEEL_TICK = 1.0
+WHEEL_SLOTS = 64
+# how often timing hooks get the stage histograms while instrumentation is on
+TIMING_INTERVAL = 5.0
+# recorded messages that go into the search index
+SEARCHABLE = (MsgType.CHAT, MsgType.SERVER_CHAT)
+# broadcasts shared with peer servers; typing has its own path
+RELAYED = (MsgType.CHAT, MsgType.SERVER_CHAT, MsgType.RENAME, MsgType.JOIN, MsgType.LEAVE)
+
+# roster deltas passed to on_roster_change(event, client, name)
+ROSTER_JOIN = "join"
+ROSTER_LEAVE = "leave"
+ROSTER_RENAME = "rename"
+DEFAULT_LIMITS = RateLimits()
+
+
+class BaseChatServer:
+    """
+    Client bookkeeping and message routing shared by every server engine.
+    Engines own the sockets: they register accepted clients, pass each
+    received chunk to handle_data and report closed clients back. Clients
+    are objects with a codec attribute and send(bytes, msg_type), which
+    queues without blocking and returns False when the client should be
+    dropped as a slow consumer.
+    """
+
+    def __init__(self, queue_limit=DEFAULT_QUEUE_LIMIT, overflow_policy=DROP_TYPING, history_dir=None,
+                 compress_threshold=COMPRESS_THRESHOLD, idle_timeout=IDLE_TIMEOUT, instrument=False,
+                 file_dir=None, file_host="0.0.0.0", file_port=0, file_rate=FILE_RATE, max_file_size=MAX_FILE_SIZE,
+                 rate_limits=DEFAULT_LIMITS, relay_host="0.0.0.0", relay_port=None, peers=(), relay_secret="",
+                 relay_window=RELAY_WINDOW, node_id=None, capture_path=None):
+        if overflow_policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy {overflow_policy!r}, expected one of {POLICIES}")
+        self.queue_limit = queue_limit
+        self.overflow_policy = overflow_policy
+        # payloads from this size up are compressed for clients that negotiated it; 0 turns compression off
+        self.compress_threshold = compress_threshold
+        # 0 turns heartbeats and the idle reaper off
+        self.idle_timeout = idle_timeout
+        self.ping_interval = idle_timeout / 3
+        # per-connection token buckets; None turns flood protection off
+        self.rate_limits = rate_limits
+        # per-stage latency histograms; None while instrumentation is off
+        self.probe = Probe() if instrument else None
+        self.timing_hooks = []
+        # inbound traffic recorder for bench/replay.py; None while capture is off
+        self.capture = None
+        self.capture_ids = itertools.count(1)
+
+        self.users = UserDirectory()
+        # room -> set of member clients, so delivery is proportional to the room's size
+        self.rooms = {}
+        self.clients_lock = threading.Lock()
+        self.stats = ServerStats()
+        self.presence = PresenceEngine(self.publish_typing)
+        self.stopped = threading.Event()
+        self.timers = []
+        self.every(PUBLISH_INTERVAL, self.presence.tick)
+        self.every(1.0, self.stats.sample_rates)
+        self.every(TIMING_INTERVAL, self.report_timings)
+        self.every(1.0, self.flush_capture, blocking=True)
+        if capture_path:
+            self.set_capture(capture_path)
+        # one wheel tracks every connection's next liveness check
+        self.idle_timers = TimerWheel(WHEEL_TICK, WHEEL_SLOTS) if idle_timeout else None
+        if self.idle_timers is not None:
+            self.every(WHEEL_TICK, self.check_idle)
+
+        self.history = RoomHistory(history_dir) if history_dir else None
+        self.last_seq = self.history.last_seq if self.history else 0
+        self.sessions = SessionTable()
+        self.replay = ReplayBuffer()
+        self.every(1.0, self.expire_sessions)
+        self.receipts = ReceiptTable()
+        self.every(RECEIPT_INTERVAL, self.publish_receipts)
+        if self.history:
+            self.every(SYNC_INTERVAL, self.history.sync, blocking=True)
+            self.every(60.0, self.history.enforce_retention, blocking=True)
+        # search reads the hits' text back from the history, so it only exists alongside it
+        self.search = SearchIndex() if self.history else None
+        if self.search is not None:
+            self.every(INDEX_INTERVAL, self.search.index_pending)
+            threading.Thread(target=self.backfill_search, daemon=True).start()
+
+        # file data has its own port and threads; the chat connection only carries offers and tokens
+        self.transfers = TransferTable(file_dir) if file_dir else None
+        self.file_server = None
+        self.max_file_size = max_file_size
+        if self.transfers is not None:
+            self.file_server = TransferServer(
+                self.transfers, file_host, file_port, file_rate, self.file_uploaded, self.stats
+            )
+            self.file_server.start()
+            self.every(60.0, self.expire_transfers)
+        self.offers_files = self.file_server is not None
+
+        # links to peer servers, started with the timers once the engine is up
+        self.relay = None
+        if relay_port is not None or peers:
+            self.relay = Relay(
+                self.relayed, self.stats, node_id, relay_host, relay_port, peers, relay_secret, relay_window
+            )
+            self.every(PUBLISH_INTERVAL, self.relay_typing)
+
+        self.on_message = None
+        self.on_typing = None
+        self.on_client_disconnect = None
+        self.on_roster_change = None
+
+        self.frame_handlers = {
+            MsgType.HELLO: self.handle_hello,
+            MsgType.CHAT: self.handle_chat,
+            MsgType.RENAME: self.handle_rename,
+            MsgType.TYPING: self.handle_typing,
+            MsgType.STOP_TYPING: self.handle_stop_typing,
+            MsgType.HISTORY: self.handle_history,
+            MsgType.JOIN: self.handle_join,
+            MsgType.LEAVE: self.handle_leave,
+            MsgType.ROOMS: self.handle_rooms,
+            MsgType.DIRECT: self.handle_direct,
+            MsgType.PING: self.handle_ping,
+            MsgType.PONG: self.handle_pong,
+            MsgType.RESUME: self.handle_resume,
+            MsgType.SEARCH: self.handle_search,
+            MsgType.ACK: self.handle_ack,
+            MsgType.FILE_OFFER: self.handle_file_offer,
+            MsgType.FILE_ACCEPT: self.handle_file_accept,
+            MsgType.FILE_CANCEL: self.handle_file_cancel,
+        }
+
+    def set_callbacks(self, on_message, on_typing, on_client_disconnect, on_roster_change=None):
+        """
+        on_roster_change(event, client, name) reports every join, leave and
+        rename as it happens, outside clients_lock, so a UI can keep its own
+        copy of the client list without ever reading the directory.
+        """
+        self.on_message = on_message
+        self.on_typing = on_typing
+        self.on_client_disconnect = on_client_disconnect
+        self.on_roster_change = on_roster_change
+
+    def every(self, interval, func, blocking=False):
+        """
+        Registers func to run every interval seconds in the engine's I/O
+        context. Blocking timers, the ones that wait on the disk, always get
+        a thread of their own so they never stall an event loop.
+        """
+        self.timers.append((interval, func, blocking))
+
+    def start_timers(self):
+        for interval, func, _ in self.timers:
+            threading.Thread(target=self._run_timer, args=(interval, func), daemon=True).start()
+        self.start_relay()
+
+    def start_relay(self):
+        if self.relay is not None:
+            self.relay.start()
+
+    def _run_timer(self, interval, func):
+        while not self.stopped.wait(interval):
+            try:
+                func()
+            except Exception as e:
+                print(f"Error in timer {func.__name__}: {e}")
+
+    def set_instrumentation(self, enabled):
+        """
+        Turns the per-stage latency histograms on or off. Turning them off
+        drops what was recorded; the hot paths then skip every clock read.
+        """
+        if not enabled:
+            self.probe = None
+        elif self.probe is None:
+            self.probe = Probe()
+
+    def set_capture(self, path):
+        """
+        Starts recording every connection's inbound bytes to path, replacing
+        any capture in progress, or stops recording when path is None.
+        Connections that are already open are captured from their next read.
+        """
+        old, self.capture = self.capture, TrafficCapture(path, self.stats) if path else None
+        if old is not None:
+            old.close()
+
+    def flush_capture(self):
+        capture = self.capture
+        if capture is not None:
+            capture.flush()
+
+    def add_timing_hook(self, hook):
+        """Registers a TimingHook to receive timings() every TIMING_INTERVAL while instrumentation is on."""
+        self.timing_hooks.append(hook)
+
+    def timings(self):
+        """Snapshot of the stage histograms, keyed by (stage, msg type or None); empty while off."""
+        probe = self.probe
+        return probe.snapshot() if probe is not None else {}
+
+    def report_timings(self):
+        if not self.timing_hooks or self.probe is None:
+            return
+        histograms = self.timings()
+        for hook in list(self.timing_hooks):
+            try:
+                hook.on_timings(histograms)
+            except Exception as e:
+                print(f"Error in timing hook: {e}")
+
+    def new_outbound_queue(self):
+        return OutboundQueue(self.queue_limit, self.overflow_policy)
+
+    def register_client(self, client, addr):
+        client.codec = None
+        client.connected_at = client.last_seen = time.monotonic()
+        client.rooms = set()
+        client.room = None
+        client.session = None
+        client.files = False
+        client.flood = FloodGuard(self.rate_limits, client.connected_at) if self.rate_limits is not None else None
+        client.capture_id = next(self.capture_ids)
+        capture = self.capture
+        if capture is not None:
+            capture.opened(client.capture_id)
+        with self.clients_lock:
+            name = self.users.add(client, f"Cliente-{addr[1]}")
+            self.stats.connections_total += 1
+            self._join_room(client, DEFAULT_ROOM)
+        if self.idle_timers is not None:
+            self.idle_timers.schedule(client, self.ping_interval)
+        if self.on_roster_change:
+            self.on_roster_change(ROSTER_JOIN, client, name)
+
+    def handle_data(self, client, data):
+        """
+        Decodes one received chunk and routes every message in it. Returns
+        False once the client asked to stop, so the engine can close it.
+        """
+        # any traffic proves the client alive; the idle check reads this lazily
+        client.last_seen = time.monotonic()
+        capture = self.capture
+        if capture is not None:
+            capture.received(client.capture_id, data)
+        if client.codec is None:
+            client.codec = detect_codec(data)
+        probe = self.probe
+        if probe is None:
+            frames = client.codec.decode(data)
+        else:
+            started = time.perf_counter_ns()
+            frames = client.codec.decode(data)
+            probe.record(DECODE, None, time.perf_counter_ns() - started)
+        self.stats.count_in(len(data), len(frames))
+        guard = client.flood
+        for frame in frames:
+            handler = self.frame_handlers.get(frame.type)
+            if handler is None:
+                continue
+            # judged on the header alone, by type and wire size: a dropped
+            # message is never inflated or parsed
+            if guard is not None:
+                verdict = guard.admit(frame.type, len(frame.payload), client.last_seen)
+                if verdict == KICK:
+                    self.flood_kick(client)
+                    return False
+                if verdict:
+                    self.throttle(client, guard)
+                    continue
+            if type(frame) is DeflatedFrame:
+                frame = frame.inflated()
+            if probe is None:
+                keep_open = handler(client, frame)
+            else:
+                started = time.perf_counter_ns()
+                keep_open = handler(client, frame)
+                probe.record(ROUTE, frame.type, time.perf_counter_ns() - started)
+            if keep_open is False:
+                return False
+        return True
+
+    def throttle(self, client, guard):
+        """A message over the client's limits was dropped."""
+        self.stats.count_flood(throttled=1)
+        if guard.should_warn(client.last_seen):
+            self.reply(client, MsgType.SYSTEM, "⚠️ You are sending too fast; some of your messages were dropped.")
+
+    def flood_kick(self, client):
+        """Ends a flooding client's session; handle_data's caller then closes the connection."""
+        self.stats.count_flood(kicked=1)
+        self.reply(client, MsgType.BYE, "Disconnected for flooding the chat.")
+        with self.clients_lock:
+            self.sessions.close(client.session)
+        if self.on_message:
+            self.on_message("🌊 Disconnected a client for flooding.")
+
+    def handle_hello(self, client, frame):
+        offered = frame.fields()
+        self.negotiate(client, offered)
+        self.start_session(client, offered)
+
+    def negotiate(self, client, offered):
+        """Framed clients may list capabilities in HELLO; the reply lists the ones accepted."""
+        if not offered:
+            return
+        accepted = []
+        if DEFLATE in offered and self.compress_threshold:
+            client.codec = self.new_codec(DeflateCodec.name)
+            accepted.append(DEFLATE)
+        if RESUMABLE in offered:
+            accepted.append(RESUMABLE)
+        if FILES in offered and self.offers_files:
+            client.files = True
+            accepted.append(FILES)
+        self.reply(client, MsgType.HELLO, *accepted)
+
+    def start_session(self, client, offered):
+        if RESUMABLE not in offered:
+            return
+        with self.clients_lock:
+            if client not in self.users:
+                return
+            session = self.sessions.open(client)
+        self.reply(client, MsgType.SESSION, session.token)
+
+    def new_codec(self, name):
+        if name == DeflateCodec.name:
+            return DeflateCodec(self.stats, self.compress_threshold)
+        return CODECS[name]()
+
+    def handle_chat(self, client, frame):
+        fields = frame.fields()
+        if not fields:
+            return
+        msg = fields[0].strip()
+        room = client.room
+        with self.clients_lock:
+            user = self.users.name_of(client)
+        # legacy clients name themselves in every message
+        if isinstance(client.codec, LegacyCodec):
+            user = fields[1] if len(fields) > 1 else user
+        elif len(fields) > 1:
+            room = fields[1]
+        if room not in client.rooms:
+            self.reply(client, MsgType.SYSTEM, f"⚠️ You are not in #{room}; join it first." if room else "⚠️ Join a room first.")
+            return
+        self.presence.stop_typing(client)
+        self.broadcast(MsgType.CHAT, (user, msg, room), record=True, room=room)
+        if self.on_message:
+            self.on_message(f"[#{room}] {user}: {msg}" if room != DEFAULT_ROOM else f"{user}: {msg}")
+        return msg.upper() != "STOP"
+
+    def handle_rename(self, client, frame):
+        new_name = frame.text().strip()
+        if not new_name:
+            return
+        with self.clients_lock:
+            old = self.users.rename(client, new_name)
+            if old is not None:
+                self.receipts.rename(old, new_name)
+        if old is None:
+            self.reply(client, MsgType.SYSTEM, f"⚠️ The name {new_name} is already taken.")
+            return
+        self.presence.rename(client, new_name)
+        if self.on_roster_change:
+            self.on_roster_change(ROSTER_RENAME, client, new_name)
+        self.broadcast(MsgType.RENAME, (old, new_name))
+        if self.on_message:
+            self.on_message(f"🗣️ {old} changed their name to {new_name}")
+
+    def handle_typing(self, client, frame):
+        with self.clients_lock:
+            name = self.users.name_of(client)
+        # legacy clients put their own name in the notice
+        if isinstance(client.codec, LegacyCodec):
+            name = frame.text() or name
+        if client.room is not None:
+            self.presence.start_typing(client, name, client.room)
+
+    def handle_stop_typing(self, client, frame):
+        self.presence.stop_typing(client)
+
+    def handle_history(self, client, frame):
+        fields = frame.fields()
+        room = fields[2] if len(fields) > 2 else client.room
+        if len(fields) < 2 or not fields[1].isdigit() or self.history is None or room not in client.rooms:
+            records = []
+        elif fields[0] == "since":
+            records = self.history.read_since(room, int(fields[1]))
+        else:
+            records = self.history.read_last(room, int(fields[1]))
+        codec = client.codec
+        for record in records:
+            fields = str(record.payload, "utf-8", "replace").split(FIELD_SEP)
+            client.send(codec.encode(record.type, fields, record.seq), record.type)
+        self.reply(client, MsgType.HISTORY, str(len(records)), room or "")
+
+    def handle_join(self, client, frame):
+        room = frame.text().strip()
+        if not valid_room(room):
+            self.reply(client, MsgType.SYSTEM, "⚠️ Room names are 1-32 letters, digits, '-' or '_'.")
+            return
+        with self.clients_lock:
+            joined = room not in client.rooms
+            self._join_room(client, room)
+            name = self.users.name_of(client)
+        if joined:
+            self.broadcast(MsgType.JOIN, (room, name), room=room)
+
+    def handle_leave(self, client, frame):
+        room = frame.text().strip()
+        with self.clients_lock:
+            if room not in client.rooms:
+                return
+            self._leave_room(client, room)
+            name = self.users.name_of(client)
+        self.presence.stop_typing(client)
+        self.broadcast(MsgType.LEAVE, (room, name), room=room)
+        self.reply(client, MsgType.LEAVE, room, name)
+
+    def handle_rooms(self, client, frame):
+        with self.clients_lock:
+            listing = sorted((room, len(members)) for room, members in self.rooms.items())
+        fields = []
+        for room, members in listing:
+            fields += [room, str(members)]
+        self.reply(client, MsgType.ROOMS, *fields)
+
+    def handle_direct(self, client, frame):
+        fields = frame.fields()
+        if len(fields) < 2 or not fields[1].strip():
+            return
+        with self.clients_lock:
+            sender = self.users.name_of(client)
+            recipient = self.users.find(fields[0])
+            name = self.users.name_of(recipient)
+        if recipient is None:
+            self.reply(client, MsgType.SYSTEM, f"⚠️ No user named {fields[0].strip()} is connected.")
+            return
+        message = (sender, name, fields[1].strip())
+        self.reply(recipient, MsgType.DIRECT, *message)
+        if recipient is not client:
+            self.reply(client, MsgType.DIRECT, *message)
+
+    def handle_ack(self, client, frame):
+        """
+        Cumulative delivery and read marks, as room, delivered seq, read seq
+        for each room that moved. Clients send them batched, at most about
+        once a second, and the senders hear back in publish_receipts().
+        """
+        fields = frame.fields()
+        with self.clients_lock:
+            name = self.users.name_of(client)
+            if name is None:
+                return
+            for i in range(0, len(fields) - 2, 3):
+                room, delivered, read = fields[i:i + 3]
+                if room in client.rooms and delivered.isdigit() and read.isdigit():
+                    # nobody can have seen past the newest message
+                    self.receipts.ack(room, name, min(int(delivered), self.last_seq), min(int(read), self.last_seq))
+            self.stats.acks_received += 1
+
+    def publish_receipts(self):
+        """Timer: sends each sender one RECEIPT with the counts of its messages that changed."""
+        with self.clients_lock:
+            updates = self.receipts.flush({room: len(members) for room, members in self.rooms.items()})
+            senders = [(self.users.find(name), counts) for name, counts in updates.items()]
+        for client, counts in senders:
+            if client is None:
+                continue
+            fields = []
+            for entry in counts:
+                fields += map(str, entry)
+            self.reply(client, MsgType.RECEIPT, *fields)
+            self.stats.receipts_sent += 1
+
+    def handle_resume(self, client, frame):
+        """
+        A reconnected client names its old session and the last seq it saw.
+        It gets the session's name and rooms back, then only what it missed
+        in those rooms, from the in-memory replay buffer when that still
+        reaches back far enough and from the history log otherwise. When
+        more than REPLAY_LIMIT messages of a room were missed, only the
+        newest of them are sent and the reply says "partial".
+        """
+        fields = frame.fields()
+        if len(fields) < 2 or not fields[1].isdigit():
+            return
+        token, last_seq = fields[0], int(fields[1])
+        with self.clients_lock:
+            session = self.sessions.get(token)
+            old = session.client if session is not None else None
+        if session is None:
+            self.reply(client, MsgType.RESUME, "expired", "0")
+            return
+        if old is not None and old is not client:
+            # the old connection is half-open and has not been reaped yet
+            self._kick(old)
+
+        with self.clients_lock:
+            if client not in self.users:
+                return
+            self.sessions.attach(session, client)
+            renamed = session.name is not None and self.users.rename(client, session.name) is not None
+            for room in list(client.rooms):
+                if room not in session.rooms:
+                    self._leave_room(client, room)
+            for room in session.rooms:
+                self._join_room(client, room)
+            if session.room in client.rooms:
+                client.room = session.room
+            missed, stale, partial = [], set(), False
+            for room in (None, *client.rooms):
+                entries, complete = self.replay.since(room, last_seq)
+                if complete:
+                    missed += entries
+                elif self.history is not None and (room or DEFAULT_ROOM) in client.rooms:
+                    # messages to everyone are recorded in the history of DEFAULT_ROOM
+                    stale.add(room or DEFAULT_ROOM)
+                else:
+                    missed += entries
+                    partial = True
+        for room in stale:
+            records, skipped = self.missed_history(room, last_seq)
+            partial = partial or skipped
+            for record in records:
+                missed.append((record.seq, record.type, str(record.payload, "utf-8", "replace").split(FIELD_SEP)))
+        # messages to everyone are in the history of DEFAULT_ROOM as well
+        missed = sorted({entry[0]: entry for entry in missed}.values(), key=lambda entry: entry[0])
+
+        if renamed and self.on_roster_change:
+            self.on_roster_change(ROSTER_RENAME, client, session.name)
+        self.rooms_changed(client)
+        self.reply(client, MsgType.SESSION, session.token)
+        codec = self.codec_for(client, time.monotonic())
+        for seq, msg_type, fields in missed:
+            client.send(codec.encode(msg_type, fields, seq), msg_type)
+        self.reply(client, MsgType.RESUME, "partial" if partial else "resumed", str(len(missed)))
+
+    def missed_history(self, room, last_seq):
+        """The newest REPLAY_LIMIT records of room after last_seq, and whether older ones were left out."""
+        records = [
+            record for record in self.history.read_last(room, REPLAY_LIMIT, REPLAY_LIMIT) if record.seq > last_seq
+        ]
+        skipped = False
+        if len(records) == REPLAY_LIMIT:
+            first = self.history.read_since(room, last_seq, 1)
+            skipped = bool(first) and first[0].seq < records[0].seq
+        return records, skipped
+
+    def handle_file_offer(self, client, frame):
+        """
+        Offers a file to one user or to the members of a room ("#room").
+        Everyone it goes to, the sender included, gets the transfer id; the
+        file itself only moves over a data connection once someone accepts.
+        """
+        fields = frame.fields()
+        if len(fields) < 4 or not fields[3].isdigit():
+            return
+        ref, recipient, name, size = fields[0], fields[1].strip(), safe_file_name(fields[2]), int(fields[3])
+        if self.transfers is None or not client.files:
+            self.reply(client, MsgType.SYSTEM, "⚠️ This server does not take file transfers.")
+            return
+        if not name or size > self.max_file_size:
+            self.reply(client, MsgType.SYSTEM, f"⚠️ Files are limited to {self.max_file_size // (1024 * 1024)} MiB.")
+            return
+        with self.clients_lock:
+            sender = self.users.name_of(client)
+            if recipient.startswith("#"):
+                room = recipient[1:]
+                members = None
+                if room in client.rooms:
+                    members = [member for member in self.rooms.get(room, ()) if member is not client and member.files]
+                problem = f"⚠️ Join #{room} before sharing files there."
+            else:
+                target = self.users.find(recipient)
+                members = [target] if target is not None and target is not client and target.files else None
+                recipient = self.users.name_of(target) or recipient
+                problem = f"⚠️ No user named {recipient} who can receive files is connected."
+        if members is None:
+            self.reply(client, MsgType.SYSTEM, problem)
+            return
+        try:
+            transfer = self.transfers.offer(sender, recipient, name, size)
+        except TransferRefused as e:
+            self.reply(client, MsgType.SYSTEM, f"⚠️ {e}")
+            return
+        message = (transfer.id, ref, sender, recipient, name, str(size))
+        for member in members:
+            self.reply(member, MsgType.FILE_OFFER, *message)
+        self.reply(client, MsgType.FILE_OFFER, *message)
+
+    def handle_file_accept(self, client, frame):
+        """
+        The accepter gets a download token once the file is in; the sender
+        is told, with the upload token and data port, so it starts (or has
+        already started) uploading.
+        """
+        transfer = self.transfers.get(frame.text()) if self.transfers is not None else None
+        with self.clients_lock:
+            name = self.users.name_of(client)
+        if transfer is None or not self.may_receive(client, name, transfer):
+            self.reply(client, MsgType.SYSTEM, "⚠️ That file offer is no longer available.")
+            return
+        token, _ = self.transfers.accept(transfer, name)
+        port = str(self.file_server.port)
+        if transfer.complete:
+            self.reply(client, MsgType.FILE_READY, transfer.id, token, port, transfer.name, str(transfer.size))
+        sender = self.find_client(transfer.sender)
+        if sender is not None:
+            self.reply(sender, MsgType.FILE_ACCEPT, transfer.id, name, transfer.upload_token, port)
+
+    def handle_file_cancel(self, client, frame):
+        """The sender withdraws an offer, or a recipient declines it; a room offer stays open for the other members."""
+        transfer = self.transfers.get(frame.text()) if self.transfers is not None else None
+        with self.clients_lock:
+            name = self.users.name_of(client)
+        if transfer is None:
+            return
+        if name == transfer.sender:
+            self.transfers.cancel(transfer.id)
+            notify = set(transfer.accepted)
+            if not transfer.recipient.startswith("#"):
+                notify.add(transfer.recipient)
+            for other in notify:
+                target = self.find_client(other)
+                if target is not None:
+                    self.reply(target, MsgType.FILE_CANCEL, transfer.id, f"{name} withdrew {transfer.name}.")
+        elif self.may_receive(client, name, transfer):
+            sender = self.find_client(transfer.sender)
+            if transfer.recipient.startswith("#"):
+                if sender is not None:
+                    self.reply(sender, MsgType.SYSTEM, f"📎 {name} declined {transfer.name}.")
+                return
+            self.transfers.cancel(transfer.id)
+            if sender is not None:
+                self.reply(sender, MsgType.FILE_CANCEL, transfer.id, f"{name} declined {transfer.name}.")
+
+    def may_receive(self, client, name, transfer):
+        if name is None or name == transfer.sender:
+            return False
+        if transfer.recipient.startswith("#"):
+            return transfer.recipient[1:] in client.rooms
+        return name.casefold() == transfer.recipient.casefold()
+
+    def file_uploaded(self, transfer):
+        """Called from the data connection's thread once a file is complete."""
+        self.call(self._announce_file, transfer)
+
+    def _announce_file(self, transfer):
+        port = str(self.file_server.port)
+        for name, token in list(transfer.accepted.items()):
+            client = self.find_client(name)
+            if client is not None:
+                self.reply(client, MsgType.FILE_READY, transfer.id, token, port, transfer.name, str(transfer.size))
+
+    def expire_transfers(self):
+        self.transfers.expire()
+
+    def handle_search(self, client, frame):
+        """
+        Full-text search over the history of the client's rooms, or of one
+        of them. Each hit comes back as its own SEARCH frame, newest first,
+        followed by one that ends the results.
+        """
+        fields = frame.fields() + [""] * 5
+        query, room, user, since, until = (field.strip() for field in fields[:5])
+        rooms = set(client.rooms)
+        if room:
+            rooms &= {room}
+        try:
+            since = float(since) if since else None
+            until = float(until) if until else None
+        except ValueError:
+            since = until = None
+        hits, complete = [], True
+        if self.search is not None and rooms:
+            hits, complete = self.search.search(query, rooms, user, since, until)
+        codec = self.codec_for(client, time.monotonic())
+        count = 0
+        for seq, room in hits:
+            record = self.history.read_seq(room, seq)
+            if record is None:
+                continue
+            sender, text = self.searchable(record.type, str(record.payload, "utf-8", "replace").split(FIELD_SEP))
+            client.send(codec.encode(MsgType.SEARCH, ("hit", str(seq), room, sender, f"{record.timestamp:.3f}", text)),
+                        MsgType.SEARCH)
+            count += 1
+        self.reply(client, MsgType.SEARCH, "end", str(count), "complete" if complete else "partial")
+
+    @staticmethod
+    def searchable(msg_type, fields):
+        """The sender and text of a SEARCHABLE message."""
+        if msg_type == MsgType.CHAT:
+            return fields[0], fields[1]
+        return SERVER_KEY, fields[0]
+
+    def backfill_search(self):
+        """Indexes the history written before this start, oldest first, next to the live indexing."""
+        last_seq = self.last_seq
+
+        def records(room):
+            seq = 0
+            while True:
+                batch = self.history.read_since(room, seq)
+                for record in batch:
+                    if record.seq > last_seq:
+                        return
+                    if record.type in SEARCHABLE:
+                        sender, text = self.searchable(record.type, str(record.payload, "utf-8", "replace").split(FIELD_SEP))
+                        yield record.seq, record.timestamp, room, sender, text
+                if not batch:
+                    return
+                seq = batch[-1].seq
+
+        try:
+            self.search.backfill(merge_by_seq([records(room) for room in self.history.rooms()]))
+        except Exception as e:
+            print(f"Error indexing history: {e}")
+
+    def relayed(self, origin, msg_type, record, room, fields):
+        """An event from the peer server origin; runs on the relay link's thread."""
+        # room names become directory names, so a peer gets no more trust than a client
+        if room is not None and not valid_room(room):
+            return
+        self.call(self.deliver_relayed, origin, msg_type, record, room, fields)
+
+    def deliver_relayed(self, origin, msg_type, record, room, fields):
+        if msg_type == MsgType.TYPING:
+            if room is not None:
+                self.presence.set_remote(origin, room, tuple(fields[1:]))
+            return
+        if msg_type not in RELAYED:
+            return
+        msg_type = MsgType(msg_type)
+        # each node numbers and records what it delivers, so history and resume cover peers' messages too
+        self.broadcast(msg_type, tuple(fields), record and msg_type in SEARCHABLE, room, relayed=True)
+        if self.on_message and msg_type == MsgType.CHAT and len(fields) > 1:
+            self.on_message(f"[{origin}] {fields[0]}: {fields[1]}")
+
+    def relay_typing(self):
+        self.relay.sync_typing(self.presence.local_typing())
+
+    def rooms_changed(self, client):
+        """Called after the server, not the client, changed the client's rooms."""
+
+    def expire_sessions(self):
+        with self.clients_lock:
+            self.sessions.expire()
+
+    def handle_ping(self, client, frame):
+        self.reply(client, MsgType.PONG, *frame.fields())
+
+    def handle_pong(self, client, frame):
+        pass
+
+    def check_idle(self):
+        """
+        Timer: visits only the clients whose check came due. One that was
+        heard from since is simply re-armed; a quiet one is pinged, and one
+        quiet for idle_timeout is dropped. Legacy clients cannot answer a
+        ping, so they leave the wheel once identified.
+        """
+        now = time.monotonic()
+        with self.clients_lock:
+            due = [client for client in self.idle_timers.advance() if client in self.users]
+        dead = []
+        for client in due:
+            idle = now - client.last_seen
+            if idle >= self.idle_timeout:
+                dead.append(client)
+                continue
+            if isinstance(self.codec_for(client, now), LegacyCodec):
+                continue
+            if idle >= self.ping_interval:
+                self.reply(client, MsgType.PING)
+                self.idle_timers.schedule(client, min(self.ping_interval, self.idle_timeout - idle))
+            else:
+                self.idle_timers.schedule(client, self.ping_interval - idle)
+        for client in dead:
+            self.stats.idle_disconnects += 1
+            self._kick(client)
+        if dead and self.on_message:
+            self.on_message(f"💤 Disconnected {len(dead)} unresponsive client(s).")
+
+    def reply(self, client, msg_type, *fields):
+        """Sends one message to one client."""
+        codec = self.codec_for(client, time.monotonic())
+        data = codec.encode(msg_type, fields) if codec is not None else b""
+        if data:
+            client.send(data, msg_type)
+
+    def codec_for(self, client, now):
+        """The client's wire format, or None while a new client may still send HELLO."""
+        if client.codec is None:
+            # framed clients send HELLO on connect; one that stays
+            # silent past the grace period speaks the legacy protocol
+            if now - client.connected_at < HANDSHAKE_GRACE:
+                return None
+            client.codec = LegacyCodec()
+        return client.codec
+
+    def _join_room(self, client, room):
+        """Call with clients_lock held."""
+        self.rooms.setdefault(room, set()).add(client)
+        client.rooms.add(room)
+        client.room = room
+
+    def _leave_room(self, client, room):
+        """Call with clients_lock held."""
+        members = self.rooms.get(room)
+        if members is not None:
+            members.discard(client)
+            if not members:
+                del self.rooms[room]
+        client.rooms.discard(room)
+        if client.room == room:
+            client.room = next(iter(client.rooms), None)
+
+    def publish_typing(self, room, names):
+        if names:
+            self.broadcast(MsgType.TYPING, (room,) + names, room=room)
+        else:
+            self.broadcast(MsgType.STOP_TYPING, (room,), room=room)
+        if self.on_typing and room == DEFAULT_ROOM:
+            self.on_typing(typing_text(names))
+
+    def server_typing(self, name):
+        self.presence.start_typing(SERVER_KEY, name, DEFAULT_ROOM)
+
+    def server_stopped_typing(self):
+        self.presence.stop_typing(SERVER_KEY)
+
+    def broadcast(self, msg_type, fields=(), record=False, room=None, relayed=False):
+        """
+        Sends a message to every member of room, or to every client when
+        room is None. With record=True the message gets the next sequence
+        number and is appended to the room's history; both happen under
+        clients_lock so sequence order matches delivery order. Messages
+        that did not come from a peer server (relayed) are passed on to
+        the peers.
+        """
+        with self.clients_lock:
+            seq = self.next_seq(msg_type, fields, room, relayed) if record else None
+            stalled = self._fan_out(msg_type, fields, seq, room)
+        for client in stalled:
+            self.drop_slow_consumer(client)
+        if self.relay is not None and not relayed and msg_type in RELAYED:
+            self.relay.publish(msg_type, fields, room, record)
+
+    def deliver(self, msg_type, fields=(), seq=None, room=None):
+        """Sends a message that was already sequenced elsewhere to the local members of room."""
+        with self.clients_lock:
+            stalled = self._fan_out(msg_type, fields, seq, room)
+        for client in stalled:
+            self.drop_slow_consumer(client)
+
+    def next_seq(self, msg_type, fields, room=None, relayed=False):
+        """
+        Assigns the next sequence number and records the message. Call with
+        clients_lock held. Receipts are kept for local senders only: a
+        relayed message's sender is a user of another node, who may share
+        a name with one here.
+        """
+        self.last_seq += 1
+        self.replay.append(room, self.last_seq, msg_type, fields)
+        if self.history is not None:
+            self.history.append(room or DEFAULT_ROOM, self.last_seq, msg_type, encode_payload(fields))
+        if self.search is not None and msg_type in SEARCHABLE:
+            self.search.add(self.last_seq, room or DEFAULT_ROOM, *self.searchable(msg_type, fields))
+        if msg_type == MsgType.CHAT and room is not None and not relayed:
+            self.receipts.track(room, self.last_seq, fields[0])
+        return self.last_seq
+
+    def _fan_out(self, msg_type, fields, seq, room=None):
+        """Queues the message for the room (or everyone) and returns clients that stalled. Call with clients_lock held."""
+        # encode once per wire format and share the immutable bytes between recipients
+        encoded = {}
+        stalled = []
+        stats = self.stats
+        started = time.perf_counter()
+        now = time.monotonic()
+        recipients = self.users if room is None else self.rooms.get(room, ())
+        stats.broadcasts += 1
+        stats.recipients += len(recipients)
+        for client in recipients:
+            codec = self.codec_for(client, now)
+            if codec is None:
+                continue
+            # clients with the same codec type share one encoding, so a
+            # broadcast is compressed at most once
+            data = encoded.get(type(codec))
+            if data is None:
+                data = encoded[type(codec)] = codec.encode(msg_type, fields, seq)
+                stats.bytes_encoded += len(data)
+            if data and not client.send(data, msg_type):
+                stalled.append(client)
+        elapsed = time.perf_counter() - started
+        stats.broadcast_latency.observe(elapsed)
+        probe = self.probe
+        if probe is not None:
+            probe.record(ENQUEUE, msg_type, int(elapsed * 1e9))
+        return stalled
+
+    def queue_stats(self):
+        """Depth, deepest queue, bytes and drops across the outbound queues of connected clients."""
+        with self.clients_lock:
+            queues = [client.outbound for client in self.users]
+        depths = [len(queue) for queue in queues]
+        return {
+            "queued": sum(depths),
+            "queued_max": max(depths, default=0),
+            "queued_bytes": sum(queue.nbytes for queue in queues),
+            "dropped": sum(queue.dropped for queue in queues),
+        }
+
+    def drop_slow_consumer(self, client):
+        if self.on_message:
+            self.on_message("🐢 Disconnected a client that stopped reading.")
+        self._kick(client)
+
+    def client_disconnected(self, client):
+        self._forget_client(client)
+        if self.on_message:
+            self.on_message("❌ A client has disconnected.")
+        if self.on_client_disconnect:
+            self.on_client_disconnect()
+
+    def send_to_all(self, message):
+        self.call(self.broadcast, MsgType.SERVER_CHAT, (message,), True)
+
+    def announce(self, msg_type, *fields):
+        """Broadcasts a server-originated event such as TYPING or SERVER_NAME."""
+        self.call(self.broadcast, msg_type, fields)
+
+    def kick_client(self, client):
+        self.call(self._remove, client)
+
+    def find_client(self, name):
+        """The connected client called name (ignoring case), or None."""
+        with self.clients_lock:
+            return self.users.find(name)
+
+    def kick_user(self, name):
+        """Kicks the client called name. Returns False when nobody has that name."""
+        client = self.find_client(name)
+        if client is None:
+            return False
+        self.kick_client(client)
+        return True
+
+    def shutdown(self):
+        self.call(self._shutdown)
+
+    def wait_closed(self, timeout=None):
+        """Blocks until a shutdown() requested from another thread has finished."""
+
+    def call(self, func, *args):
+        """Runs func in the engine's I/O context. Threaded engines run it inline."""
+        func(*args)
+
+    def close_client(self, client):
+        raise NotImplementedError
+
+    def close_listener(self):
+        raise NotImplementedError
+
+    def _forget_client(self, client):
+        with self.clients_lock:
+            name = self.users.remove(client)
+            if name is not None:
+                self.sessions.detach(client, name)
+            for room in list(client.rooms):
+                self._leave_room(client, room)
+        self.presence.stop_typing(client)
+        if self.idle_timers is not None:
+            self.idle_timers.cancel(client)
+        capture = self.capture
+        if name is not None and capture is not None:
+            capture.closed(client.capture_id)
+        if name is not None and self.on_roster_change:
+            self.on_roster_change(ROSTER_LEAVE, client, name)
+
+    def _remove(self, client):
+        """An operator kick: the client is told not to reconnect and its session ends."""
+        self.reply(client, MsgType.BYE, "You were removed from the chat by the server.")
+        self._kick(client)
+        with self.clients_lock:
+            self.sessions.close(client.session)
+
+    def _kick(self, client):
+        self._forget_client(client)
+        try:
+            self.close_client(client)
+        except Exception:
+            pass
+
+    def _shutdown(self):
+        self.stopped.set()
+        # the server going down is not the clients hanging up, so it stays out of the capture
+        capture, self.capture = self.capture, None
+        if capture is not None:
+            capture.close()
+        with self.clients_lock:
+            clients = list(self.users)
+        for client in clients:
+            try:
+                self.close_client(client)
+            except Exception:
+                pass
+        try:
+            self.close_listener()
+        except Exception:
+            pass
+        if self.history is not None:
+            self.history.close()
+        if self.file_server is not None:
+            self.file_server.stop()
+            self.transfers.clear()
+        if self.relay is not None:
+            self.relay.stop()
+        for hook in self.timing_hooks:
+            try:
+                hook.close()
+            except Exception:
+                pass
@@ -0,0 +1,123 @@
+import heapq
+import struct
+import threading
+import time
+
+# File layout, all integers big-endian:
+#
+#   magic:8s  started:f64 (unix time)
+#   then records of  delta:u32 (microseconds since the previous record)  conn:u32  kind:u8  length:u32  payload
+#
+# DATA payloads are the bytes exactly as one recv() returned them, so
+# frames split across reads, compressed frames and legacy "#tag#" chunks
+# replay the way they arrived.
+CAPTURE_MAGIC = b"CHATCAP1"
+HEADER = struct.Struct("!8sd")
+RECORD = struct.Struct("!IIBI")
+MAX_DELTA = 0xFFFFFFFF
+WRITE_BUFFER = 1024 * 1024
+
+OPEN = 0    # a connection was accepted
+DATA = 1    # bytes received on it
+CLOSE = 2   # it went away
+
+
+class TrafficCapture:
+    """
+    Appends every connection's inbound bytes to a capture file, stamped
+    with the time and a connection id. Records go through a large write
+    buffer, so the hot path costs one struct pack and a memcpy; the server
+    flushes it every second. Engines with reader threads call in
+    concurrently, hence the lock.
+    """
+
+    def __init__(self, path, stats=None):
+        self.path = path
+        self.stats = stats
+        self.file = open(path, "wb", buffering=WRITE_BUFFER)
+        self.started = time.monotonic()
+        self.last = 0
+        self.lock = threading.Lock()
+        self.file.write(HEADER.pack(CAPTURE_MAGIC, time.time()))
+
+    def opened(self, conn):
+        self.write(conn, OPEN)
+
+    def received(self, conn, data):
+        self.write(conn, DATA, data)
+
+    def closed(self, conn):
+        self.write(conn, CLOSE)
+
+    def write(self, conn, kind, payload=b""):
+        now = int((time.monotonic() - self.started) * 1e6)
+        with self.lock:
+            if self.file is None:
+                return
+            # gaps longer than MAX_DELTA (about 71 minutes) replay shortened
+            delta = min(now - self.last, MAX_DELTA)
+            self.last = now
+            self.file.write(RECORD.pack(delta, conn, kind, len(payload)))
+            if payload:
+                self.file.write(payload)
+            if self.stats is not None:
+                self.stats.captured_bytes += RECORD.size + len(payload)
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def read_capture(path):
+    """
+    Yields (seconds since the capture started, conn, kind, payload) for
+    every record of a capture file. Raises ValueError for files that are
+    not captures; a record cut short by a crash ends the iteration.
+    """
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size or header[:8] != CAPTURE_MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        elapsed = 0
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            delta, conn, kind, length = RECORD.unpack(head)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            elapsed += delta
+            yield elapsed / 1e6, conn, kind, payload
+
+
+def capture_start(path):
+    with open(path, "rb") as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size or header[:8] != CAPTURE_MAGIC:
+        raise ValueError(f"{path} is not a traffic capture")
+    return HEADER.unpack(header)[1]
+
+
+def merge_captures(paths):
+    """
+    Merges the captures of several processes, such as a cluster's workers,
+    into one stream ordered by wall time. Connection ids are made unique by
+    numbering them per file: file i's conn c becomes (i, c).
+    """
+    starts = [capture_start(path) for path in paths]
+    first = min(starts)
+
+    def shifted(index, path):
+        offset = starts[index] - first
+        for elapsed, conn, kind, payload in read_capture(path):
+            yield elapsed + offset, (index, conn), kind, payload
+
+    return heapq.merge(*(shifted(index, path) for index, path in enumerate(paths)), key=lambda record: record[0])
@@ -0,0 +1,505 @@
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from enum import IntEnum
+
+from .base import BaseChatServer, IDLE_TIMEOUT, DEFAULT_LIMITS, RELAYED
+from .history import valid_room
+from .network import create_listener
+from common.protocol import MsgType, Frame, FrameDecoder, FIELD_SEP, FILES, encode_frame
+from .instrument import ROUTE, ENQUEUE, dump_histograms, load_histograms, merge_histograms
+
+STATS_INTERVAL = 1.0
+READY_TIMEOUT = 30.0
+CLOSE_TIMEOUT = 5.0
+SEP = FIELD_SEP.encode()
+# worker counters the hub adds up; broadcasts and connections are counted by the hub itself
+MERGED_STATS = (
+    "messages_in", "bytes_in", "recipients", "bytes_encoded", "bytes_copied", "write_calls", "bytes_written",
+    "compressed_payloads", "compression_bytes_saved", "compression_seconds", "idle_disconnects",
+    "throttled_messages", "flood_disconnects", "captured_bytes",
+)
+
+
+class BusOp(IntEnum):
+    READY = 0          # worker -> hub: listening
+    JOIN = 1           # worker -> hub: client id, host, port
+    LEAVE = 2          # worker -> hub: client id
+    FORWARD = 3        # worker -> hub: client id, msg type, codec name, client payload
+    STATS = 4          # worker -> hub: JSON counters
+    BROADCAST = 5      # hub -> worker: msg type, room or "" for everyone, fields (seq in the frame)
+    UNICAST = 6        # hub -> worker: client id, msg type, encoded message
+    KICK = 7           # hub -> worker: client id
+    SHUTDOWN = 8       # hub -> worker
+    ROOMS = 9          # hub -> worker: client id, current room or "", rooms the client is now in
+    INSTRUMENT = 10    # hub -> worker: "1" or "0" to turn the stage histograms on or off
+    CAPTURE = 11       # hub -> worker: capture file to record to, or "" to stop
+
+
+class BusLink:
+    """
+    One end of the Unix socket between a worker and the hub. Frames carry
+    a BusOp as their type. Sends only queue the frame; a writer thread
+    writes whatever has queued up with one sendall(), so a worker that is
+    slow to read never holds up the hub's routing (and the other way
+    round).
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = []
+        self.closed = False
+        self.cond = threading.Condition()
+        self.writer = threading.Thread(target=self.write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, op, *fields, seq=None):
+        self.send_frame(encode_frame(op, fields, seq))
+
+    def send_raw(self, op, head, data):
+        """Sends head fields followed by an opaque byte string as the last field."""
+        self.send_frame(encode_frame(op, payload=FIELD_SEP.join(head).encode("utf-8") + SEP + data))
+
+    def send_frame(self, data):
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append(data)
+            if len(self.pending) == 1:
+                self.cond.notify()
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                batch = b"".join(self.pending)
+                self.pending = []
+            try:
+                self.sock.sendall(batch)
+            except OSError:
+                with self.cond:
+                    self.closed = True
+                    self.pending = []
+                return
+
+    def serve(self, handler):
+        """Passes every frame to handler until the other end goes away."""
+        decoder = FrameDecoder()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    try:
+                        handler(frame)
+                    except Exception as e:
+                        print(f"Error in bus handler: {e}")
+        except OSError:
+            pass
+
+    def close(self):
+        """Stops taking frames, gives the writer up to CLOSE_TIMEOUT to send the queued ones, then shuts down."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join(CLOSE_TIMEOUT)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def split_raw(frame, count):
+    """Splits a send_raw payload into count head fields and the trailing bytes."""
+    parts = bytes(frame.payload).split(SEP, count)
+    return [part.decode("utf-8") for part in parts[:count]] + [parts[count]]
+
+
+class WorkerMixin:
+    """
+    Turns an engine into a cluster worker. The worker owns its connections
+    and does all socket I/O and parsing; every decoded message is forwarded
+    to the hub, which runs the usual routing once for the whole cluster
+    and sends each broadcast back to all workers for local fan-out.
+    """
+
+    def __init__(self, bus, worker_index, files=False, **options):
+        super().__init__(**options)
+        # the hub runs the file server; workers only accept FILES on its behalf
+        self.offers_files = files
+        self.bus = BusLink(bus)
+        self.worker_index = worker_index
+        self.clients_by_id = {}
+        self.client_ids = itertools.count(1)
+        self.frame_handlers = dict.fromkeys(self.frame_handlers, self.forward)
+        self.frame_handlers[MsgType.HELLO] = self.forward_hello
+        # heartbeats are between the client and the worker holding its socket
+        self.frame_handlers[MsgType.PING] = self.handle_ping
+        self.frame_handlers[MsgType.PONG] = self.handle_pong
+        self.frame_handlers[MsgType.JOIN] = self.forward_membership
+        self.frame_handlers[MsgType.LEAVE] = self.forward_membership
+        self.bus_handlers = {
+            BusOp.BROADCAST: self.bus_broadcast,
+            BusOp.UNICAST: self.bus_unicast,
+            BusOp.KICK: self.bus_kick,
+            BusOp.SHUTDOWN: self.bus_shutdown,
+            BusOp.ROOMS: self.bus_rooms,
+            BusOp.INSTRUMENT: self.bus_instrument,
+            BusOp.CAPTURE: self.bus_capture,
+        }
+        self.every(STATS_INTERVAL, self.report_stats)
+
+    def register_client(self, client, addr):
+        super().register_client(client, addr)
+        client.cluster_id = f"{self.worker_index}.{next(self.client_ids)}"
+        self.clients_by_id[client.cluster_id] = client
+        self.bus.send(BusOp.JOIN, client.cluster_id, str(addr[0]), str(addr[1]))
+
+    def forward(self, client, frame):
+        head = (client.cluster_id, str(int(frame.type)), client.codec.name)
+        self.bus.send_raw(BusOp.FORWARD, head, bytes(frame.payload))
+
+    def forward_hello(self, client, frame):
+        """
+        The handshake is answered here, where the codec is used for fan-out;
+        it is forwarded so the hub learns the negotiated codec and opens
+        the client's session.
+        """
+        self.negotiate(client, frame.fields())
+        self.forward(client, frame)
+
+    def forward_membership(self, client, frame):
+        """Room changes are applied here too, since this worker fans out room messages to its own clients."""
+        room = frame.text().strip()
+        with self.clients_lock:
+            if frame.type == MsgType.JOIN and valid_room(room):
+                self._join_room(client, room)
+            elif frame.type == MsgType.LEAVE and room in client.rooms:
+                self._leave_room(client, room)
+        self.forward(client, frame)
+
+    def _forget_client(self, client):
+        super()._forget_client(client)
+        if self.clients_by_id.pop(client.cluster_id, None) is not None:
+            self.bus.send(BusOp.LEAVE, client.cluster_id)
+
+    def report_stats(self):
+        counters = {name: getattr(self.stats, name) for name in MERGED_STATS}
+        counters.update(self.queue_stats())
+        timings = self.timings()
+        if timings:
+            counters["timings"] = dump_histograms(timings)
+        self.bus.send(BusOp.STATS, json.dumps(counters))
+
+    def run_bus(self):
+        self.bus.send(BusOp.READY)
+        self.bus.serve(self.handle_bus)
+        # the hub is gone, so this worker can no longer route anything
+        if not self.stopped.is_set():
+            self.shutdown()
+
+    def handle_bus(self, frame):
+        handler = self.bus_handlers.get(frame.type)
+        if handler is not None:
+            handler(frame)
+
+    def bus_broadcast(self, frame):
+        fields = frame.fields()
+        self.call(self.deliver, MsgType(int(fields[0])), fields[2:], frame.seq, fields[1] or None)
+
+    def bus_unicast(self, frame):
+        client_id, msg_type, data = split_raw(frame, 2)
+        client = self.clients_by_id.get(client_id)
+        if client is not None:
+            self.call(client.send, data, MsgType(int(msg_type)))
+
+    def bus_kick(self, frame):
+        client = self.clients_by_id.get(frame.text())
+        if client is not None:
+            # the hub has already told the client why
+            self.call(self._kick, client)
+
+    def bus_rooms(self, frame):
+        client_id, room, *rooms = frame.fields()
+        client = self.clients_by_id.get(client_id)
+        if client is not None:
+            self.call(self.set_rooms, client, rooms, room or None)
+
+    def set_rooms(self, client, rooms, room):
+        with self.clients_lock:
+            for name in list(client.rooms):
+                if name not in rooms:
+                    self._leave_room(client, name)
+            for name in rooms:
+                self._join_room(client, name)
+            client.room = room
+
+    def bus_instrument(self, frame):
+        self.call(self.set_instrumentation, frame.text() == "1")
+
+    def bus_capture(self, frame):
+        self.call(self.set_capture, frame.text() or None)
+
+    def bus_shutdown(self, frame):
+        self.shutdown()
+
+
+@functools.lru_cache(maxsize=None)
+def worker_class(engine_class):
+    return type(f"Worker{engine_class.__name__}", (WorkerMixin, engine_class), {})
+
+
+def worker_main(index, engine, host, port, backlog, listener, bus, options):
+    """Entry point of a worker process."""
+    from . import ENGINES
+
+    # Ctrl+C reaches the whole process group; the hub decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if listener is None:
+        listener = create_listener(host, port, backlog, reuse_port=True)
+    server = worker_class(ENGINES[engine])(
+        host=host, port=port, backlog=backlog, listener=listener, bus=bus, worker_index=index, **options
+    )
+    server.set_callbacks(None, None, None)
+    server.start_listening(lambda client, addr: None)
+    server.run_bus()
+    server.wait_closed(timeout=5)
+
+
+class RemoteClient:
+    """The hub's handle on a client connected to one of the workers."""
+
+    def __init__(self, link, cluster_id):
+        self.link = link
+        self.cluster_id = cluster_id
+        self.codec = None
+
+    def send(self, data, msg_type=None):
+        self.link.send_raw(BusOp.UNICAST, (self.cluster_id, str(int(msg_type))), data)
+        return True
+
+
+class ClusterServer(BaseChatServer):
+    """
+    Runs the chat server as several worker processes sharing one port, so
+    parsing and fan-out use every core. On Linux each worker binds its own
+    socket with SO_REUSEPORT and the kernel balances connections between
+    them; elsewhere the workers accept from one listening socket created
+    here.
+
+    This process is the hub. Workers forward every client message over a
+    Unix socket pair and the hub handles it with the ordinary routing code:
+    it assigns sequence numbers, keeps history, presence and the merged
+    client list, and sends each broadcast to every worker once. The
+    control panel and metrics talk to the hub like to any other engine.
+    """
+
+    def __init__(self, host="0.0.0.0", port=5000, workers=None, worker_engine="asyncio", backlog=1024,
+                 idle_timeout=IDLE_TIMEOUT, rate_limits=DEFAULT_LIMITS, capture_path=None, **options):
+        # workers see the traffic, so they run the heartbeats, the idle reaper, the flood limits and the capture
+        super().__init__(idle_timeout=0, rate_limits=None, **options)
+        self.worker_idle_timeout = idle_timeout
+        self.worker_rate_limits = rate_limits
+        self.capture_path = capture_path
+        self.host = host
+        self.worker_count = workers or os.cpu_count() or 1
+        self.worker_engine = worker_engine
+        self.backlog = backlog
+        self.reuse_port = hasattr(socket, "SO_REUSEPORT") and sys.platform.startswith("linux")
+        if self.reuse_port:
+            # bound but never listening: it only reserves the port (and
+            # resolves port 0) for the workers' own sockets
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.server_socket.bind((host, port))
+        else:
+            self.server_socket = create_listener(host, port, backlog)
+        self.port = self.server_socket.getsockname()[1]
+
+        self.links = []
+        self.processes = []
+        self.clients_by_id = {}
+        self.worker_stats = {}
+        self.on_new_connection = None
+        self.ready = threading.Semaphore(0)
+        self.bus_handlers = {
+            BusOp.READY: self.bus_ready,
+            BusOp.JOIN: self.bus_join,
+            BusOp.LEAVE: self.bus_leave,
+            BusOp.FORWARD: self.bus_forward,
+            BusOp.STATS: self.bus_stats,
+        }
+
+    def start_listening(self, on_new_connection):
+        self.on_new_connection = on_new_connection
+        context = multiprocessing.get_context("spawn")
+        worker_options = {
+            "queue_limit": self.queue_limit,
+            "overflow_policy": self.overflow_policy,
+            "compress_threshold": self.compress_threshold,
+            "idle_timeout": self.worker_idle_timeout,
+            "rate_limits": self.worker_rate_limits,
+            "instrument": self.probe is not None,
+            "files": self.offers_files,
+        }
+        listener = None if self.reuse_port else self.server_socket
+        for index in range(self.worker_count):
+            hub_end, worker_end = socket.socketpair()
+            options = dict(worker_options, capture_path=self.worker_capture(index))
+            process = context.Process(
+                target=worker_main,
+                args=(index, self.worker_engine, self.host, self.port, self.backlog, listener, worker_end, options),
+                daemon=True,
+            )
+            process.start()
+            worker_end.close()
+            link = BusLink(hub_end)
+            self.links.append(link)
+            self.processes.append(process)
+            threading.Thread(target=link.serve, args=(functools.partial(self.handle_bus, link),), daemon=True).start()
+        for _ in self.links:
+            if not self.ready.acquire(timeout=READY_TIMEOUT):
+                print("Error in start_listening: a worker did not start")
+                break
+        self.start_timers()
+
+    def handle_bus(self, link, frame):
+        handler = self.bus_handlers.get(frame.type)
+        if handler is not None:
+            handler(link, frame)
+
+    def bus_ready(self, link, frame):
+        self.ready.release()
+
+    def bus_join(self, link, frame):
+        client_id, host, port = frame.fields()
+        client = self.clients_by_id[client_id] = RemoteClient(link, client_id)
+        addr = (host, int(port))
+        self.register_client(client, addr)
+        if self.on_new_connection:
+            self.on_new_connection(client, addr)
+
+    def bus_leave(self, link, frame):
+        client = self.clients_by_id.pop(frame.text(), None)
+        if client is not None:
+            self.client_disconnected(client)
+
+    def bus_forward(self, link, frame):
+        client_id, msg_type, codec, payload = split_raw(frame, 3)
+        client = self.clients_by_id.get(client_id)
+        if client is None:
+            return
+        if client.codec is None or client.codec.name != codec:
+            client.codec = self.new_codec(codec)
+        msg_type = MsgType(int(msg_type))
+        handler = self.frame_handlers.get(msg_type)
+        if handler is None:
+            return
+        probe = self.probe
+        if probe is None:
+            keep_open = handler(client, Frame(msg_type, None, payload))
+        else:
+            started = time.perf_counter_ns()
+            keep_open = handler(client, Frame(msg_type, None, payload))
+            probe.record(ROUTE, msg_type, time.perf_counter_ns() - started)
+        if keep_open is False:
+            self._kick(client)
+
+    def handle_hello(self, client, frame):
+        # the worker already answered; bus_forward has picked up the codec
+        offered = frame.fields()
+        client.files = self.offers_files and FILES in offered
+        self.start_session(client, offered)
+
+    def rooms_changed(self, client):
+        with self.clients_lock:
+            fields = (client.cluster_id, client.room or "", *client.rooms)
+        client.link.send(BusOp.ROOMS, *fields)
+
+    def bus_stats(self, link, frame):
+        self.worker_stats[link] = json.loads(frame.text())
+        reports = list(self.worker_stats.values())
+        for name in MERGED_STATS:
+            setattr(self.stats, name, sum(report[name] for report in reports))
+
+    def broadcast(self, msg_type, fields=(), record=False, room=None, relayed=False):
+        started = time.perf_counter()
+        with self.clients_lock:
+            seq = self.next_seq(msg_type, fields, room, relayed) if record else None
+            data = encode_frame(BusOp.BROADCAST, (str(int(msg_type)), room or "") + tuple(fields), seq)
+            # only queued here, in seq order; each link's writer thread does the sending
+            for link in self.links:
+                link.send_frame(data)
+            self.stats.broadcasts += 1
+            elapsed = time.perf_counter() - started
+            self.stats.broadcast_latency.observe(elapsed)
+        probe = self.probe
+        if probe is not None:
+            probe.record(ENQUEUE, msg_type, int(elapsed * 1e9))
+        if self.relay is not None and not relayed and msg_type in RELAYED:
+            self.relay.publish(msg_type, fields, room, record)
+
+    def set_instrumentation(self, enabled):
+        super().set_instrumentation(enabled)
+        for link in self.links:
+            link.send(BusOp.INSTRUMENT, "1" if enabled else "0")
+
+    def worker_capture(self, index):
+        """Each worker records its own connections to the capture path with its index appended."""
+        return f"{self.capture_path}.{index}" if self.capture_path else None
+
+    def set_capture(self, path):
+        self.capture_path = path
+        for index, link in enumerate(self.links):
+            link.send(BusOp.CAPTURE, self.worker_capture(index) or "")
+
+    def timings(self):
+        """
+        The hub's own histograms merged with the latest ones each worker
+        reported. Route covers both the worker forwarding a message and
+        the hub handling it; enqueue both the hub's send to the workers
+        and each worker's local fan-out.
+        """
+        histograms = super().timings()
+        if self.probe is None:
+            return histograms
+        for report in list(self.worker_stats.values()):
+            if "timings" in report:
+                merge_histograms(histograms, load_histograms(report["timings"]))
+        return histograms
+
+    def queue_stats(self):
+        reports = list(self.worker_stats.values())
+        return {
+            "queued": sum(report["queued"] for report in reports),
+            "queued_max": max((report["queued_max"] for report in reports), default=0),
+            "queued_bytes": sum(report["queued_bytes"] for report in reports),
+            "dropped": sum(report["dropped"] for report in reports),
+        }
+
+    def close_client(self, client):
+        client.link.send(BusOp.KICK, client.cluster_id)
+
+    def close_listener(self):
+        self.server_socket.close()
+        for link in self.links:
+            link.send(BusOp.SHUTDOWN)
+            link.close()
+
+    def wait_closed(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for process in self.processes:
+            process.join(None if deadline is None else max(deadline - time.monotonic(), 0))
@@ -0,0 +1,64 @@
+import itertools
+
+
+class UserDirectory:
+    """
+    The connected clients, indexed by client, by connection id and by
+    display name, so every lookup is a dict hit. Names are unique ignoring
+    case: a rename to a name someone else holds is refused, and a default
+    name that clashes gets the connection id appended. The three indexes
+    only change together; callers hold the server's clients_lock.
+    """
+
+    def __init__(self):
+        self.names = {}
+        self.by_id = {}
+        self.by_name = {}
+        self.ids = itertools.count(1)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __contains__(self, client):
+        return client in self.names
+
+    def add(self, client, name):
+        """Assigns client.user_id and returns the unique name the client was given."""
+        client.user_id = next(self.ids)
+        if name.casefold() in self.by_name:
+            name = f"{name}-{client.user_id}"
+        self.names[client] = name
+        self.by_id[client.user_id] = client
+        self.by_name[name.casefold()] = client
+        return name
+
+    def rename(self, client, name):
+        """Returns the client's previous name, or None when the name is taken or the client is gone."""
+        old = self.names.get(client)
+        owner = self.by_name.get(name.casefold())
+        if old is None or (owner is not None and owner is not client):
+            return None
+        del self.by_name[old.casefold()]
+        self.by_name[name.casefold()] = client
+        self.names[client] = name
+        return old
+
+    def remove(self, client):
+        """Returns the name the client had, or None if it was not listed."""
+        name = self.names.pop(client, None)
+        if name is not None:
+            del self.by_id[client.user_id]
+            del self.by_name[name.casefold()]
+        return name
+
+    def name_of(self, client, default="Unknown"):
+        return self.names.get(client, default)
+
+    def find(self, name):
+        return self.by_name.get(name.strip().casefold())
+
+    def get(self, user_id):
+        return self.by_id.get(user_id)
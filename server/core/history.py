@@ -0,0 +1,539 @@
+import bisect
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from array import array
+from collections import OrderedDict, namedtuple
+
+# Segment record, big-endian:
+#
+#   payload_len:u32  crc32:u32  seq:u64  timestamp:f64  type:u8  payload
+#
+# crc32 covers everything after itself, so a record torn by a crash is
+# detected on recovery and the log is truncated just before it.
+RECORD = struct.Struct("!IIQdB")
+PREFIX = struct.Struct("!II")
+BODY = struct.Struct("!QdB")
+CRC_START = PREFIX.size
+INDEX_ENTRY = struct.Struct("!QQ")
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+INDEX_INTERVAL = 4096
+# Retention is per room: every room's HistoryLog keeps up to RETENTION_BYTES
+# on its own, so the whole history directory can grow to that times the
+# number of rooms. Only whole sealed segments are dropped, oldest first, and
+# never the active one, so after a pass a room keeps up to RETENTION_BYTES
+# and may have freed up to one segment more than it had to. Passes run every
+# minute over the open logs only; a room evicted from the MAX_OPEN_ROOMS
+# cache is trimmed on the first pass after it is used again.
+RETENTION_BYTES = 1024 * 1024 * 1024
+SYNC_INTERVAL = 0.2
+MAX_READ = 500
+MAX_OPEN_ROOMS = 256
+ROOM_NAME = re.compile(r"[A-Za-z0-9_-]{1,32}")
+
+Record = namedtuple("Record", "seq timestamp type payload")
+
+
+class Segment:
+    """
+    One log file plus its sparse index. The index holds a (seq, offset)
+    pair roughly every INDEX_INTERVAL bytes; lookups bisect it and scan
+    forward from there through an mmap of the log.
+    """
+
+    def __init__(self, directory, base_seq):
+        self.base_seq = base_seq
+        stem = os.path.join(directory, f"{base_seq:020d}")
+        self.log_path = stem + ".log"
+        self.index_path = stem + ".idx"
+        self.index_seqs = array("Q")
+        self.index_offsets = array("Q")
+        self.size = 0
+        self.last_seq = base_seq - 1
+        self.last_indexed = -INDEX_INTERVAL
+        self.log = None
+        self.index = None
+        self._map = None
+        self._map_size = 0
+
+    def open_for_append(self):
+        self.log = open(self.log_path, "ab")
+        self.index = open(self.index_path, "ab")
+
+    def append(self, seq, timestamp, msg_type, payload, index_interval):
+        body = BODY.pack(seq, timestamp, msg_type) + payload
+        record = PREFIX.pack(len(payload), zlib.crc32(body)) + body
+        offset = self.size
+        self.log.write(record)
+        if offset - self.last_indexed >= index_interval:
+            self.index.write(INDEX_ENTRY.pack(seq, offset))
+            self.index_seqs.append(seq)
+            self.index_offsets.append(offset)
+            self.last_indexed = offset
+        self.size += len(record)
+        self.last_seq = seq
+
+    def flush(self, fsync):
+        if self.log is None:
+            return
+        self.log.flush()
+        self.index.flush()
+        if fsync:
+            # the log goes first: recovery drops index entries past its end
+            os.fsync(self.log.fileno())
+            os.fsync(self.index.fileno())
+
+    def sync_handles(self):
+        """
+        Writes the buffered records out and returns duplicates of the log
+        and index descriptors, in fsync order, for syncing without the log's
+        lock. The duplicates stay valid if the segment is sealed meanwhile.
+        """
+        if self.log is None:
+            return []
+        self.flush(fsync=False)
+        return [os.dup(self.log.fileno()), os.dup(self.index.fileno())]
+
+    def seal(self):
+        self.flush(fsync=True)
+        self.close_files()
+
+    def close_files(self):
+        self.log.close()
+        self.index.close()
+        self.log = None
+        self.index = None
+
+    def load_index(self):
+        try:
+            with open(self.index_path, "rb") as f:
+                raw = f.read()
+        except FileNotFoundError:
+            raw = b""
+        self.size = os.path.getsize(self.log_path)
+        usable = len(raw) - len(raw) % INDEX_ENTRY.size
+        for seq, offset in INDEX_ENTRY.iter_unpack(raw[:usable]):
+            if offset >= self.size:
+                break
+            self.index_seqs.append(seq)
+            self.index_offsets.append(offset)
+        if self.index_offsets:
+            self.last_indexed = self.index_offsets[-1]
+
+    def recover(self, index_interval):
+        """
+        Validates the log from the last index entry onward, truncates a
+        torn tail and indexes the records written after that entry. Only
+        the tail of the segment is read, never the whole history.
+        """
+        self.load_index()
+        with open(self.log_path, "r+b") as f:
+            while True:
+                start = self.index_offsets[-1] if self.index_offsets else 0
+                f.seek(start)
+                tail = f.read()
+                records, valid = scan(tail)
+                if records or not self.index_offsets:
+                    break
+                # the indexed record itself is torn; step back one entry
+                self.index_seqs.pop()
+                self.index_offsets.pop()
+            end = start + valid
+            if end < self.size:
+                f.truncate(end)
+                self.size = end
+
+        self.last_indexed = self.index_offsets[-1] if self.index_offsets else -index_interval
+        self.last_seq = self.base_seq - 1
+        pos = start
+        for record, length in records:
+            if pos - self.last_indexed >= index_interval:
+                self.index_seqs.append(record.seq)
+                self.index_offsets.append(pos)
+                self.last_indexed = pos
+            self.last_seq = record.seq
+            pos += length
+        with open(self.index_path, "wb") as f:
+            for seq, offset in zip(self.index_seqs, self.index_offsets):
+                f.write(INDEX_ENTRY.pack(seq, offset))
+
+    def view(self):
+        if self.log is not None:
+            self.log.flush()
+        if self.size == 0:
+            return b""
+        if self._map is None or self._map_size != self.size:
+            self.close_map()
+            with open(self.log_path, "rb") as f:
+                self._map = mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+            self._map_size = self.size
+        return self._map
+
+    def read_from(self, seq, limit):
+        i = bisect.bisect_right(self.index_seqs, seq) - 1
+        pos = self.index_offsets[i] if i >= 0 else 0
+        data = self.view()
+        out = []
+        while pos < self.size and len(out) < limit:
+            record, length = read_record(data, pos)
+            if record.seq >= seq:
+                out.append(record)
+            pos += length
+        return out
+
+    def read_tail(self, count):
+        """The last count records, found by stepping back through the sparse index."""
+        if count <= 0 or self.size == 0:
+            return []
+        data = self.view()
+        i = len(self.index_offsets) - 1
+        step = 1
+        while True:
+            pos = self.index_offsets[i] if i >= 0 else 0
+            records = []
+            while pos < self.size:
+                record, length = read_record(data, pos)
+                records.append(record)
+                pos += length
+            if len(records) >= count or i < 0:
+                return records[-count:]
+            i = max(i - step, -1)
+            step *= 2
+
+    def close_map(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+    def close(self):
+        self.close_map()
+        if self.log is not None:
+            self.seal()
+
+    def delete(self):
+        self.close()
+        for path in (self.log_path, self.index_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+def read_record(data, pos):
+    length, _, seq, timestamp, msg_type = RECORD.unpack_from(data, pos)
+    start = pos + RECORD.size
+    return Record(seq, timestamp, msg_type, bytes(data[start:start + length])), RECORD.size + length
+
+
+def scan(data):
+    """Parses records until the first truncated or corrupt one. Returns (records, valid bytes)."""
+    records = []
+    pos = 0
+    while len(data) - pos >= RECORD.size:
+        length, crc = PREFIX.unpack_from(data, pos)
+        end = pos + RECORD.size + length
+        if end > len(data) or zlib.crc32(data[pos + CRC_START:end]) != crc:
+            break
+        record, size = read_record(data, pos)
+        records.append((record, size))
+        pos = end
+    return records, pos
+
+
+class HistoryLog:
+    """
+    Append-only chat history split into segment files.
+
+    append() only buffers the record; sync(), called by the server every
+    SYNC_INTERVAL, writes and fsyncs the whole batch at once, along with
+    the segments rolled over since, so append() never waits on the disk.
+    Retention drops whole segments, oldest first, once the log exceeds
+    retention_bytes or a sealed segment is older than retention_seconds.
+    """
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, index_interval=INDEX_INTERVAL,
+                 retention_bytes=RETENTION_BYTES, retention_seconds=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.index_interval = index_interval
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.lock = threading.Lock()
+        self.dirty = False
+        # segments rolled over but not fsynced yet; sync() seals them
+        self.unsealed = []
+
+        os.makedirs(directory, exist_ok=True)
+        bases = sorted(
+            int(name[:-4]) for name in os.listdir(directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        self.segments = [Segment(directory, base) for base in bases]
+        for segment in self.segments[:-1]:
+            segment.load_index()
+            if not segment.index_offsets and segment.size:
+                segment.recover(index_interval)
+        if self.segments:
+            self.segments[-1].recover(index_interval)
+        else:
+            self.segments.append(Segment(directory, 1))
+        self.active.open_for_append()
+
+    @property
+    def active(self):
+        return self.segments[-1]
+
+    @property
+    def last_seq(self):
+        return self.active.last_seq
+
+    def append(self, seq, msg_type, payload, timestamp=None):
+        with self.lock:
+            if self.active.size >= self.segment_bytes:
+                self._roll(seq)
+            self.active.append(seq, timestamp or time.time(), msg_type, payload, self.index_interval)
+            self.dirty = True
+
+    def _roll(self, next_seq):
+        self.unsealed.append(self.active)
+        segment = Segment(self.directory, next_seq)
+        segment.open_for_append()
+        self.segments.append(segment)
+
+    def sync(self):
+        # only the write to the OS holds the lock; appends go on during the fsync
+        with self.lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            handles = []
+            for segment in self.unsealed:
+                handles += segment.sync_handles()
+                segment.close_files()
+            self.unsealed = []
+            handles += self.active.sync_handles()
+        try:
+            for fd in handles:
+                os.fsync(fd)
+        finally:
+            for fd in handles:
+                os.close(fd)
+
+    def read_since(self, seq, limit=MAX_READ):
+        """Records with a sequence number greater than seq, oldest first."""
+        with self.lock:
+            bases = [segment.base_seq for segment in self.segments]
+            i = max(bisect.bisect_right(bases, seq + 1) - 1, 0)
+            out = []
+            for segment in self.segments[i:]:
+                out.extend(segment.read_from(seq + 1, limit - len(out)))
+                if len(out) >= limit:
+                    break
+            return out
+
+    def read_last(self, count, limit=MAX_READ):
+        """The newest count records (at most limit), oldest first. Sequence numbers may have gaps."""
+        count = min(count, limit)
+        with self.lock:
+            out = []
+            for segment in reversed(self.segments):
+                out[:0] = segment.read_tail(count - len(out))
+                if len(out) >= count:
+                    break
+            return out
+
+    def enforce_retention(self):
+        with self.lock:
+            now = time.time()
+            total = sum(segment.size for segment in self.segments)
+            while len(self.segments) > 1:
+                oldest = self.segments[0]
+                too_big = total > self.retention_bytes
+                too_old = (
+                    self.retention_seconds is not None
+                    and now - os.path.getmtime(oldest.log_path) > self.retention_seconds
+                )
+                if not (too_big or too_old):
+                    break
+                total -= oldest.size
+                if oldest in self.unsealed:
+                    self.unsealed.remove(oldest)
+                oldest.delete()
+                self.segments.pop(0)
+
+    def close(self):
+        with self.lock:
+            for segment in self.segments:
+                segment.close()
+
+
+def valid_room(room):
+    """Room names double as directory names, so they are kept to a safe alphabet."""
+    return ROOM_NAME.fullmatch(room) is not None
+
+
+class RoomHistory:
+    """
+    One HistoryLog per room, in directory/<room>. Sequence numbers are
+    global, so a room's log has gaps where other rooms spoke. Logs are
+    opened on first use and at most max_open stay open; the least recently
+    used one is evicted to make room, and reopening it only re-checks its
+    tail. A log is pinned while a call is using it and is never evicted
+    under that call: when every open log is pinned, the limit gives way
+    until one is released.
+
+    append() runs under the server's clients_lock, so it never opens or
+    closes a log: records for a room whose log is not open wait in the
+    backlog until a reader or sync() opens it, and evicted logs are closed
+    by the next sync(). Opening happens outside the lock that append()
+    takes.
+    """
+
+    def __init__(self, directory, max_open=MAX_OPEN_ROOMS, **log_options):
+        self.directory = directory
+        self.max_open = max_open
+        self.log_options = log_options
+        self.logs = OrderedDict()
+        # room -> number of calls using its log right now
+        self.pins = {}
+        # room -> (seq, msg_type, payload, timestamp) appended while its log was not open
+        self.backlog = {}
+        # room -> evicted log, still open until sync() closes it
+        self.closing = {}
+        self.lock = threading.Lock()
+        # held while a log is opened or closed, so a room's files are only used by one log at a time
+        self.open_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+        self.last_seq = 0
+        for room in self.rooms():
+            self.last_seq = max(self.last_seq, self.using(room, lambda log: log.last_seq))
+        self._close_evicted()
+
+    def _lookup(self, room):
+        """room's open log, taken back from closing if need be, or None. Call with lock held."""
+        log = self.logs.get(room)
+        if log is None and room in self.closing:
+            log = self.logs[room] = self.closing.pop(room)
+        if log is not None:
+            self.logs.move_to_end(room)
+        return log
+
+    def pin(self, room):
+        """Opens room's log if needed and keeps it open until unpin(room)."""
+        with self.lock:
+            log = self._lookup(room)
+            if log is not None:
+                self.pins[room] = self.pins.get(room, 0) + 1
+                return log
+        with self.open_lock:
+            with self.lock:
+                log = self._lookup(room)
+            if log is None:
+                # recovery reads the disk; appends meanwhile go to the backlog
+                log = HistoryLog(os.path.join(self.directory, room), **self.log_options)
+            with self.lock:
+                if room not in self.logs:
+                    self._evict()
+                    self.logs[room] = log
+                    for seq, msg_type, payload, timestamp in self.backlog.pop(room, ()):
+                        log.append(seq, msg_type, payload, timestamp)
+                self.pins[room] = self.pins.get(room, 0) + 1
+                return log
+
+    def unpin(self, room):
+        with self.lock:
+            self.pins[room] -= 1
+            if not self.pins[room]:
+                del self.pins[room]
+
+    def _evict(self):
+        """Moves the least recently used unpinned logs to closing, down to max_open - 1. Call with lock held."""
+        idle = [room for room in self.logs if room not in self.pins]
+        for room in idle[:max(len(self.logs) - self.max_open + 1, 0)]:
+            self.closing[room] = self.logs.pop(room)
+
+    def _open_waiting(self):
+        """Opens the log of every room with a backlog, which writes the backlog into it."""
+        with self.lock:
+            waiting = list(self.backlog)
+        for room in waiting:
+            self.pin(room)
+            self.unpin(room)
+
+    def _close_evicted(self):
+        with self.open_lock:
+            with self.lock:
+                evicted = list(self.closing.values())
+                self.closing.clear()
+            for log in evicted:
+                log.close()
+
+    def using(self, room, func):
+        """Returns func(log) for room's log, pinned for the duration of the call."""
+        log = self.pin(room)
+        try:
+            return func(log)
+        finally:
+            self.unpin(room)
+
+    def append(self, room, seq, msg_type, payload):
+        with self.lock:
+            log = self._lookup(room)
+            if log is None:
+                self.backlog.setdefault(room, []).append((seq, msg_type, payload, time.time()))
+            else:
+                log.append(seq, msg_type, payload)
+
+    def read_since(self, room, seq, limit=MAX_READ):
+        return self.using(room, lambda log: log.read_since(seq, limit))
+
+    def read_last(self, room, count, limit=MAX_READ):
+        return self.using(room, lambda log: log.read_last(count, limit))
+
+    def read_seq(self, room, seq):
+        """The record with exactly this seq in room, or None once retention dropped it."""
+        records = self.read_since(room, seq - 1, 1)
+        return records[0] if records and records[0].seq == seq else None
+
+    def rooms(self):
+        """Every room with a log on disk, open or not."""
+        return sorted(
+            room for room in os.listdir(self.directory)
+            if valid_room(room) and os.path.isdir(os.path.join(self.directory, room))
+        )
+
+    def each_open(self, func):
+        """Runs func(log) for every open log, each pinned so eviction cannot close it mid-call."""
+        with self.lock:
+            pinned = list(self.logs.items())
+            for room, _ in pinned:
+                self.pins[room] = self.pins.get(room, 0) + 1
+        try:
+            for _, log in pinned:
+                func(log)
+        finally:
+            for room, _ in pinned:
+                self.unpin(room)
+
+    def sync(self):
+        """Opens the logs that have a backlog, closes the evicted ones and fsyncs the rest."""
+        self._open_waiting()
+        self._close_evicted()
+        self.each_open(HistoryLog.sync)
+
+    def enforce_retention(self):
+        self.each_open(HistoryLog.enforce_retention)
+
+    def close(self):
+        self._open_waiting()
+        self._close_evicted()
+        with self.open_lock, self.lock:
+            for log in self.logs.values():
+                log.close()
+            self.logs.clear()
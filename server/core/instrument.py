@@ -0,0 +1,218 @@
+import json
+import threading
+import time
+
+from common.protocol import MsgType
+
+# pipeline stages, in the order a message goes through them
+READ = "read"            # recv() on a client socket (thread engine)
+DECODE = "decode"        # turning a received chunk into frames
+ROUTE = "route"          # running the handler for one frame, fan-out included
+ENQUEUE = "enqueue"      # encoding a message and queueing it for every recipient
+WRITE = "write"          # one socket write of queued messages
+STAGES = (READ, DECODE, ROUTE, ENQUEUE, WRITE)
+
+# each power of two is split into 2 ** (SUB_BITS - 1) buckets, about 3% apart
+SUB_BITS = 6
+HALF = 1 << (SUB_BITS - 1)
+# up to 2 ** 40 ns, about 18 minutes; longer samples land in the last bucket
+BUCKETS = (40 - SUB_BITS + 1) * HALF + HALF
+
+
+def bucket_of(ns):
+    if ns < (1 << SUB_BITS):
+        return max(ns, 0)
+    shift = ns.bit_length() - SUB_BITS
+    return min(shift * HALF + (ns >> shift), BUCKETS - 1)
+
+
+def bucket_floor(index):
+    """Smallest value, in ns, that falls in bucket index."""
+    if index < (1 << SUB_BITS):
+        return index
+    shift, mantissa = divmod(index, HALF)
+    shift -= 1
+    return (mantissa + HALF) << shift
+
+
+class HdrHistogram:
+    """
+    Log-linear latency histogram in the HdrHistogram style: constant
+    relative precision from nanoseconds to minutes in a fixed list of
+    counters, so recording is an index computation and an increment.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        self.counts[bucket_of(ns)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            if count:
+                self.counts[index] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        """Value in ns at or below which fraction of the samples fall (bucket lower bound)."""
+        if not self.count:
+            return 0
+        rank = max(int(fraction * self.count + 0.5), 1)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_floor(index), self.max)
+        return self.max
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def to_dict(self):
+        return {
+            "buckets": {str(i): c for i, c in enumerate(self.counts) if c},
+            "count": self.count,
+            "total": self.total,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        for index, count in data["buckets"].items():
+            histogram.counts[int(index)] = count
+        histogram.count = data["count"]
+        histogram.total = data["total"]
+        histogram.max = data["max"]
+        return histogram
+
+
+class Probe:
+    """
+    Per-stage, per-message-type latency histograms. The server only holds
+    a Probe while instrumentation is on; its hot paths test for that once
+    per received chunk or written batch, so turning it off leaves no clock
+    reads and no bookkeeping behind.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, stage, msg_type, ns):
+        """msg_type is None for stages that handle several messages at once."""
+        key = (stage, msg_type)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = HdrHistogram()
+            histogram.record(ns)
+
+    def snapshot(self):
+        """A copy of every histogram, keyed by (stage, msg type or None)."""
+        with self.lock:
+            copies = {}
+            for key, histogram in self.histograms.items():
+                copy = copies[key] = HdrHistogram()
+                copy.merge(histogram)
+            return copies
+
+
+def type_name(msg_type):
+    try:
+        return MsgType(msg_type).name
+    except ValueError:
+        return str(msg_type)
+
+
+def by_stage(histograms):
+    """Merges the per-type histograms of each stage into one, keyed by stage."""
+    stages = {}
+    for (stage, _), histogram in histograms.items():
+        merge_histograms(stages, {stage: histogram})
+    return stages
+
+
+def merge_histograms(target, histograms):
+    """Adds every histogram of histograms into target, both keyed by (stage, msg type or None)."""
+    for key, histogram in histograms.items():
+        merged = target.get(key)
+        if merged is None:
+            merged = target[key] = HdrHistogram()
+        merged.merge(histogram)
+    return target
+
+
+def dump_histograms(histograms):
+    """A JSON-friendly copy of histograms, keyed by "stage|type" ("stage|" for all types)."""
+    return {
+        f"{stage}|{'' if msg_type is None else int(msg_type)}": histogram.to_dict()
+        for (stage, msg_type), histogram in histograms.items()
+    }
+
+
+def load_histograms(data):
+    histograms = {}
+    for key, value in data.items():
+        stage, msg_type = key.split("|")
+        histograms[(stage, int(msg_type) if msg_type else None)] = HdrHistogram.from_dict(value)
+    return histograms
+
+
+class TimingHook:
+    """
+    Receives the server's stage histograms every report interval, from the
+    server's timer context. Subclass it for panels, exporters or dumpers
+    and register instances with BaseChatServer.add_timing_hook().
+    """
+
+    def on_timings(self, histograms):
+        """histograms maps (stage, msg type or None) to an HdrHistogram snapshot."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def summarize(histograms):
+    """Flattens histograms into rows of (stage, type, count, p50, p99, p999, max), times in microseconds."""
+    rows = []
+    for (stage, msg_type), histogram in sorted(histograms.items(), key=lambda item: (STAGES.index(item[0][0]), str(item[0][1]))):
+        rows.append((
+            stage,
+            "all" if msg_type is None else type_name(msg_type),
+            histogram.count,
+            histogram.percentile(0.50) / 1000,
+            histogram.percentile(0.99) / 1000,
+            histogram.percentile(0.999) / 1000,
+            histogram.max / 1000,
+        ))
+    return rows
+
+
+class TimingFileDumper(TimingHook):
+    """Appends one JSON line per report to path: the time and each stage's count and percentiles in microseconds."""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+
+    def on_timings(self, histograms):
+        stages = [
+            {"stage": stage, "type": msg_type, "count": count, "p50_us": p50, "p99_us": p99, "p999_us": p999, "max_us": top}
+            for stage, msg_type, count, p50, p99, p999, top in summarize(histograms)
+        ]
+        self.file.write(json.dumps({"time": time.time(), "stages": stages}) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,130 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .instrument import type_name
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+def render_metrics(server):
+    """Renders the server's counters in the Prometheus text exposition format."""
+    stats = server.stats
+    with server.clients_lock:
+        connected = len(server.users)
+    queues = server.queue_stats()
+
+    lines = []
+
+    def metric(name, kind, help_text, value):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.append(f"{name} {value}")
+
+    metric("chat_connections", "gauge", "Connected clients.", connected)
+    metric("chat_connections_total", "counter", "Accepted connections.", stats.connections_total)
+    metric("chat_messages_received_total", "counter", "Messages decoded from clients.", stats.messages_in)
+    metric("chat_messages_per_second", "gauge", "Received messages per second over the last second.",
+           f"{stats.messages_per_sec:.3f}")
+    metric("chat_bytes_received_total", "counter", "Bytes read from clients.", stats.bytes_in)
+    metric("chat_bytes_sent_total", "counter", "Bytes written to clients.", stats.bytes_written)
+    metric("chat_broadcasts_total", "counter", "Broadcasts fanned out.", stats.broadcasts)
+    metric("chat_write_calls_total", "counter", "Socket write calls.", stats.write_calls)
+    metric("chat_bytes_copied_total", "counter", "Bytes copied in user space while encoding and writing.",
+           stats.bytes_encoded + stats.bytes_copied)
+    metric("chat_idle_disconnects_total", "counter", "Clients dropped for not answering heartbeats.",
+           stats.idle_disconnects)
+    metric("chat_throttled_messages_total", "counter", "Messages dropped for exceeding a rate limit.",
+           stats.throttled_messages)
+    metric("chat_flood_disconnects_total", "counter", "Clients kicked for flooding.", stats.flood_disconnects)
+    metric("chat_acks_received_total", "counter", "Batched delivery and read acknowledgements received.",
+           stats.acks_received)
+    metric("chat_receipts_sent_total", "counter", "Aggregated receipts sent to message senders.", stats.receipts_sent)
+    metric("chat_captured_bytes_total", "counter", "Bytes written to the traffic capture file.", stats.captured_bytes)
+    metric("chat_compressed_payloads_total", "counter", "Payloads compressed for clients that negotiated deflate.",
+           stats.compressed_payloads)
+    metric("chat_compression_saved_bytes_total", "counter",
+           "Bytes saved by compression, counted once per compressed encoding.", stats.compression_bytes_saved)
+    metric("chat_compression_seconds_total", "counter", "CPU time spent compressing.",
+           f"{stats.compression_seconds:.6f}")
+    metric("chat_files_uploaded_total", "counter", "File transfers whose upload completed.", stats.files_uploaded)
+    metric("chat_file_bytes_received_total", "counter", "File bytes received on data connections.",
+           stats.file_bytes_received)
+    metric("chat_file_bytes_sent_total", "counter", "File bytes sent on data connections.", stats.file_bytes_sent)
+    metric("chat_outbound_queue_messages", "gauge", "Messages waiting in all outbound queues.", queues["queued"])
+    metric("chat_outbound_queue_max", "gauge", "Deepest outbound queue.", queues["queued_max"])
+    metric("chat_outbound_queue_bytes", "gauge", "Bytes waiting in all outbound queues.", queues["queued_bytes"])
+    metric("chat_outbound_dropped_messages", "gauge",
+           "Messages shed by the overflow policy for connected clients.", queues["dropped"])
+    if server.relay is not None:
+        metric("chat_relay_links", "gauge", "Connected peer servers.", len(server.relay.peer_links()))
+        metric("chat_relay_events_sent_total", "counter", "Events written to peer links.", stats.relay_events_sent)
+        metric("chat_relay_events_received_total", "counter", "New events received from peers.",
+               stats.relay_events_received)
+        metric("chat_relay_duplicates_total", "counter", "Events dropped for having arrived before.",
+               stats.relay_duplicates)
+        metric("chat_relay_batches_total", "counter", "Writes to peer links, each carrying a batch of events.",
+               stats.relay_batches)
+    if server.search is not None:
+        metric("chat_search_index_messages", "gauge", "Messages in the search index.", len(server.search))
+        metric("chat_search_index_bytes", "gauge", "Estimated memory held by the search index.",
+               server.search.nbytes)
+
+    name = "chat_broadcast_latency_seconds"
+    histogram = stats.broadcast_latency
+    lines.append(f"# HELP {name} Time to fan one broadcast out to every queue.")
+    lines.append(f"# TYPE {name} histogram")
+    for bound, count in histogram.cumulative():
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        lines.append(f'{name}_bucket{{le="{le}"}} {count}')
+    lines.append(f"{name}_sum {histogram.sum}")
+    lines.append(f"{name}_count {histogram.count}")
+
+    timings = server.timings()
+    if timings:
+        name = "chat_stage_latency_seconds"
+        lines.append(f"# HELP {name} Time spent in each pipeline stage, per message type, while instrumentation is on.")
+        lines.append(f"# TYPE {name} summary")
+        for (stage, msg_type), histogram in sorted(timings.items(), key=lambda item: (item[0][0], str(item[0][1]))):
+            labels = f'stage="{stage}",type="{"all" if msg_type is None else type_name(msg_type)}"'
+            for quantile in QUANTILES:
+                lines.append(f'{name}{{{labels},quantile="{quantile}"}} {histogram.percentile(quantile) / 1e9!r}')
+            lines.append(f"{name}_sum{{{labels}}} {histogram.total / 1e9!r}")
+            lines.append(f"{name}_count{{{labels}}} {histogram.count}")
+    return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """Serves GET /metrics over HTTP from a daemon thread."""
+
+    def __init__(self, server, host="127.0.0.1", port=9100):
+        chat_server = server
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = render_metrics(chat_server).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
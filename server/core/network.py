@@ -1,122 +1,333 @@
+import os
+import select
+import selectors
 import socket
 import threading
-import re
+import time
+from collections import deque
 
+from .base import BaseChatServer
+from .instrument import READ, WRITE
+from common.protocol import LegacyCodec
 
-class ChatServer:
-    def __init__(self, host="0.0.0.0", port=5000):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((host, port))
-        self.server_socket.listen(5)
-        self.client_names = {}
-        self.clients_lock = threading.Lock()
+WRITE_BUDGET = 64
+IOV_BATCH = 256
+# a closing client whose queue has not drained by then is shut down anyway
+CLOSE_LINGER = 5.0
 
-        self.on_message = None
-        self.on_typing = None
-        self.on_client_disconnect = None
 
-    def set_callbacks(self, on_message, on_typing, on_client_disconnect):
-        self.on_message = on_message
-        self.on_typing = on_typing
-        self.on_client_disconnect = on_client_disconnect
+def send_buffers(sock, buffers):
+    """
+    Writes a list of buffers with one syscall. Returns (bytes sent, bytes
+    copied in user space); sendmsg() is a writev, platforms without it get
+    a joined copy instead.
+    """
+    if len(buffers) == 1:
+        return sock.send(buffers[0]), 0
+    if hasattr(sock, "sendmsg"):
+        return sock.sendmsg(buffers), 0
+    joined = b"".join(buffers)
+    return sock.send(joined), len(joined)
+
+
+def advance(buffers, sent):
+    """Drops the first sent bytes from a list of buffers."""
+    for i, buf in enumerate(buffers):
+        if sent < len(buf):
+            rest = buffers[i:]
+            if sent:
+                rest[0] = memoryview(buf)[sent:]
+            return rest
+        sent -= len(buf)
+    return []
+
+
+def create_listener(host, port, backlog, reuse_port=False):
+    """
+    Binds a listening TCP socket. With reuse_port several processes can
+    each bind their own socket to the same port and the kernel spreads
+    incoming connections between them.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if os.name != "nt":
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+def readable_waiter(sock):
+    """Returns a callable that blocks until sock has data, EOF or an error."""
+    if hasattr(select, "poll"):
+        poller = select.poll()
+        poller.register(sock, select.POLLIN)
+        return poller.poll
+    return lambda: select.select([sock], [], [sock])
+
+
+class SocketClient:
+    """
+    A client served by its own reader thread. The socket is non-blocking;
+    send() only queues, and the shared SocketWriter thread drains the queue.
+    """
+
+    def __init__(self, sock, addr, outbound, writer):
+        self.sock = sock
+        self.addr = addr
+        self.codec = None
+        self.outbound = outbound
+        self.writer = writer
+        self.pending = []
+        self.watched = False
+        self.closed = False
+        self.closing = False
+        self.close_deadline = None
+
+    def send(self, data, msg_type=None):
+        if self.closed:
+            return True
+        if not self.outbound.push(data, msg_type):
+            return False
+        self.writer.notify(self)
+        return True
+
+    def close(self):
+        """
+        Closes the connection once what is queued, such as a BYE, has been
+        written. The writer shuts the socket down after draining the queue.
+        """
+        if self.closing or self.closed:
+            return
+        self.closing = True
+        self.close_deadline = time.monotonic() + CLOSE_LINGER
+        if self.writer.running:
+            self.writer.close_later(self)
+        else:
+            self.shutdown()
+
+    def shutdown(self):
+        # shutdown() wakes the reader thread; the writer closes the socket afterwards
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class SocketWriter:
+    """
+    Single thread that writes every client's outbound queue with non-blocking
+    sends. Everything queued for a client since its last turn goes out in
+    one vectored write, except for legacy clients: the text protocol has no
+    delimiter, so they get one message per send as they always did. A
+    client whose TCP window is full is parked on the selector until it
+    becomes writable, so it never holds up anyone else. Closing clients are
+    shut down once their queue is drained, or after CLOSE_LINGER.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        # the server's Probe while instrumentation is on
+        self.probe = None
+        self.selector = selectors.DefaultSelector()
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_recv.setblocking(False)
+        self.wake_send.setblocking(False)
+        self.selector.register(self.wake_recv, selectors.EVENT_READ)
+        self.ready = deque()
+        self.ready_lock = threading.Lock()
+        self.woken = False
+        self.running = True
+        # clients waiting for their queue to drain before being shut down
+        self.lingering = set()
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def notify(self, client):
+        with self.ready_lock:
+            self.ready.append(client)
+            if self.woken:
+                return
+            self.woken = True
+        self._wake()
+
+    def close_later(self, client):
+        with self.ready_lock:
+            self.lingering.add(client)
+        self.notify(client)
+
+    def stop(self):
+        self.running = False
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wake_send.send(b"\0")
+        except OSError:
+            pass
+
+    def run(self):
+        while self.running:
+            for key, _ in self.selector.select(1.0 if self.lingering else None):
+                if key.fileobj is self.wake_recv:
+                    self._drain_wakeups()
+                else:
+                    self.flush(key.data)
+            with self.ready_lock:
+                batch, self.ready = self.ready, deque()
+                lingering = list(self.lingering)
+            for client in dict.fromkeys(batch):
+                self.flush(client)
+            now = time.monotonic()
+            for client in lingering:
+                if now >= client.close_deadline:
+                    self._finish_close(client)
+        with self.ready_lock:
+            lingering, self.lingering = self.lingering, set()
+        for client in lingering:
+            client.shutdown()
+        self.selector.close()
+        self.wake_recv.close()
+        self.wake_send.close()
+
+    def _drain_wakeups(self):
+        with self.ready_lock:
+            self.woken = False
+        try:
+            while self.wake_recv.recv(4096):
+                pass
+        except OSError:
+            pass
+
+    def flush(self, client):
+        if client.closed:
+            self._release(client)
+            return
+        stats = self.stats
+        for _ in range(WRITE_BUDGET):
+            if not client.pending:
+                batch = 1 if isinstance(client.codec, LegacyCodec) else IOV_BATCH
+                client.pending = client.outbound.pop_many(batch)
+                if not client.pending:
+                    self._watch(client, False)
+                    if client.closing:
+                        self._finish_close(client)
+                    return
+            probe = self.probe
+            try:
+                if probe is None:
+                    sent, copied = send_buffers(client.sock, client.pending)
+                else:
+                    started = time.perf_counter_ns()
+                    sent, copied = send_buffers(client.sock, client.pending)
+                    probe.record(WRITE, None, time.perf_counter_ns() - started)
+            except (BlockingIOError, InterruptedError):
+                self._watch(client, True)
+                return
+            except OSError:
+                client.pending = []
+                client.outbound.clear()
+                self._watch(client, False)
+                self._finish_close(client)
+                return
+            stats.write_calls += 1
+            stats.bytes_written += sent
+            stats.bytes_copied += copied
+            client.pending = advance(client.pending, sent)
+            if client.pending:
+                self._watch(client, True)
+                return
+        # budget used up; come back after the other clients had their turn
+        with self.ready_lock:
+            self.ready.append(client)
+
+    def _finish_close(self, client):
+        with self.ready_lock:
+            self.lingering.discard(client)
+        client.shutdown()
+
+    def _watch(self, client, writable):
+        if writable and not client.watched:
+            self.selector.register(client.sock, selectors.EVENT_WRITE, client)
+        elif not writable and client.watched:
+            self.selector.unregister(client.sock)
+        client.watched = writable
+
+    def _release(self, client):
+        with self.ready_lock:
+            self.lingering.discard(client)
+        self._watch(client, False)
+        client.sock.close()
+
+
+class ChatServer(BaseChatServer):
+    def __init__(self, host="0.0.0.0", port=5000, backlog=5, listener=None, **options):
+        super().__init__(**options)
+        self.server_socket = listener or create_listener(host, port, backlog)
+        self.writer = SocketWriter(self.stats)
+        self.writer.probe = self.probe
+        self.writer.start()
+
+    def set_instrumentation(self, enabled):
+        super().set_instrumentation(enabled)
+        self.writer.probe = self.probe
 
     def start_listening(self, on_new_connection):
+        self.start_timers()
+
         def accept_loop():
             while True:
                 try:
                     client_socket, addr = self.server_socket.accept()
-                    with self.clients_lock:
-                        self.client_names[client_socket] = f"Cliente-{addr[1]}"
-                    on_new_connection(client_socket, addr)
-                    threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
+                    client_socket.setblocking(False)
+                    client = SocketClient(client_socket, addr, self.new_outbound_queue(), self.writer)
+                    self.register_client(client, addr)
+                    on_new_connection(client, addr)
+                    threading.Thread(target=self.handle_client, args=(client,), daemon=True).start()
                 except Exception:
                     break
         threading.Thread(target=accept_loop, daemon=True).start()
 
-    def handle_client(self, client_socket):
+    def handle_client(self, client):
+        wait_readable = readable_waiter(client.sock)
         try:
             while True:
-                data = client_socket.recv(1024).decode()
+                wait_readable()
+                probe = self.probe
+                try:
+                    if probe is None:
+                        data = client.sock.recv(65536)
+                    else:
+                        started = time.perf_counter_ns()
+                        data = client.sock.recv(65536)
+                        probe.record(READ, None, time.perf_counter_ns() - started)
+                except (BlockingIOError, InterruptedError):
+                    continue
                 if not data:
                     break
-
-                if "#usern#" in data:
-                    new_name = data.replace("#usern#", "")
-                    with self.clients_lock:
-                        old = self.client_names.get(client_socket, "Unknown")
-                        self.client_names[client_socket] = new_name
-                        for c in self.client_names:
-                            c.send(f"🗣️ {old} changed their name to {new_name}".encode())
-                    if self.on_message:
-                        self.on_message(f"🗣️ {old} changed their name to {new_name}")
-
-                elif "#writing#" in data:
-                    writing = data.replace("#writing#", "")
-                    with self.clients_lock:
-                        for c in self.client_names:
-                            c.send(f"#writing#{writing}".encode())
-                    if self.on_typing:
-                        self.on_typing(f"{writing} is typing...")
-
-                elif "#nowriting#" in data:
-                    with self.clients_lock:
-                        for c in self.client_names:
-                            c.send(data.encode())
-                    if self.on_typing:
-                        self.on_typing("")
-
-                else:
-                    try:
-                        user = re.search(r"#(.*?)#", data).group(1)
-                        msg = re.sub(r"#.*?#", "", data).strip()
-                        with self.clients_lock:
-                            for c in self.client_names:
-                                c.send(f"#other#{user}: {msg}".encode())
-                        if self.on_message:
-                            self.on_message(f"{user}: {msg}")
-                    except AttributeError:
-                        continue
-
-                if data.strip().upper().endswith("STOP"):
+                if not self.handle_data(client, data):
                     break
-
         except Exception as e:
             print(f"Error in handle_client: {e}")
         finally:
-            with self.clients_lock:
-                if client_socket in self.client_names:
-                    del self.client_names[client_socket]
-            client_socket.close()
-            if self.on_message:
-                self.on_message("❌ A client has disconnected.")
-            if self.on_client_disconnect:
-                self.on_client_disconnect()
-
-    def send_to_all(self, message):
-        with self.clients_lock:
-            for client_socket in self.client_names:
-                try:
-                    client_socket.send(message.encode())
-                except:
-                    pass
+            client.closed = True
+            client.shutdown()
+            # the writer owns the socket from here and closes it once unregistered
+            if self.writer.running:
+                self.writer.notify(client)
+            else:
+                client.sock.close()
+            self.client_disconnected(client)
 
-    def kick_client(self, client_socket):
-        with self.clients_lock:
-            try:
-                client_socket.close()
-                if client_socket in self.client_names:
-                    del self.client_names[client_socket]
-            except:
-                pass
+    def close_client(self, client):
+        client.close()
 
-    def shutdown(self):
-        with self.clients_lock:
-            for client_socket in list(self.client_names):
-                try:
-                    client_socket.close()
-                except:
-                    pass
+    def close_listener(self):
         try:
-            self.server_socket.close()
-        except:
-            pass
\ No newline at end of file
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_socket.close()
+        self.writer.stop()
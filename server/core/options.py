@@ -0,0 +1,124 @@
+from . import ENGINES
+from .base import IDLE_TIMEOUT
+from .outbound import POLICIES, DEFAULT_QUEUE_LIMIT, DROP_TYPING
+from common.protocol import COMPRESS_THRESHOLD
+from .ratelimit import RateLimits, MESSAGE_RATE, MESSAGE_BURST, BYTE_RATE, KICK_AFTER, parse_type_limits
+from .relay import RELAY_WINDOW, parse_peer
+from .transfer import FILE_RATE
+
+# The one set of defaults for the control panel (main.py) and headless.py.
+# File transfers open a second port and write uploads to disk, so they are
+# opt-in; --file-dir turns them on.
+SERVER_DEFAULTS = {
+    "host": "0.0.0.0",
+    "port": 5000,
+    "engine": "thread",
+    "workers": 1,
+    "queue_limit": DEFAULT_QUEUE_LIMIT,
+    "overflow_policy": DROP_TYPING,
+    "history_dir": "history",
+    "compress_threshold": COMPRESS_THRESHOLD,
+    "idle_timeout": IDLE_TIMEOUT,
+    "file_dir": "",
+    "file_port": 5001,
+    "file_rate": FILE_RATE,
+    "rate_limits": True,
+    "message_rate": MESSAGE_RATE,
+    "message_burst": MESSAGE_BURST,
+    "byte_rate": BYTE_RATE,
+    "type_limits": [],
+    "kick_after": KICK_AFTER,
+    "relay_port": None,
+    "peers": [],
+    "relay_secret": "",
+    "node_id": "",
+    "relay_window_ms": RELAY_WINDOW * 1000,
+    "instrument": False,
+    "capture": "",
+}
+
+
+def add_server_arguments(parser):
+    """
+    Adds the server's options to parser. None of them has a default of its
+    own: unset options stay None so a config file can fill them in, and
+    server_options() takes the rest from SERVER_DEFAULTS.
+    """
+    parser.add_argument("--host", help=f"address to listen on (default {SERVER_DEFAULTS['host']})")
+    parser.add_argument("--port", type=int, help=f"chat port (default {SERVER_DEFAULTS['port']})")
+    parser.add_argument("--engine", choices=sorted(ENGINES), help=f"default {SERVER_DEFAULTS['engine']}")
+    parser.add_argument("--workers", type=int, help="worker processes sharing the port")
+    parser.add_argument("--queue-limit", type=int, help="messages queued per client before the overflow policy applies")
+    parser.add_argument("--overflow-policy", choices=POLICIES)
+    parser.add_argument("--history-dir", help=f"where chat history is kept (default {SERVER_DEFAULTS['history_dir']}); empty string disables it")
+    parser.add_argument("--compress-threshold", type=int, help="compress payloads of this many bytes or more; 0 disables")
+    parser.add_argument("--idle-timeout", type=float, help="seconds of silence before a client is dropped; 0 disables")
+    parser.add_argument("--file-dir", help="where file transfers are spooled; transfers are off unless this is given")
+    parser.add_argument("--file-port", type=int, help=f"port of the file data connections (default {SERVER_DEFAULTS['file_port']})")
+    parser.add_argument("--file-rate", type=int, help="bandwidth cap per transfer in bytes per second; 0 lifts it")
+    parser.add_argument("--no-rate-limits", dest="rate_limits", action="store_false", default=None,
+                        help="turn per-connection flood protection off")
+    parser.add_argument("--message-rate", type=float, help="messages per second per connection; 0 lifts the limit")
+    parser.add_argument("--message-burst", type=float, help="messages a connection may send at once")
+    parser.add_argument("--byte-rate", type=int, help="bytes per second per connection; 0 lifts the limit")
+    parser.add_argument("--type-limit", dest="type_limits", action="append",
+                        help="per-type limit as type=rate[/burst], e.g. chat=5/20; repeatable, rate 0 lifts it")
+    parser.add_argument("--kick-after", type=int, help="dropped messages before a flooding client is kicked; 0 never kicks")
+    parser.add_argument("--relay-port", type=int, help="accept links from peer servers on this port")
+    parser.add_argument("--peer", dest="peers", action="append", help="host:port of a peer server's relay port; repeatable")
+    parser.add_argument("--relay-secret", help="shared secret every linked server must present; required with --relay-port or --peer")
+    parser.add_argument("--node-id", help="this server's name on relay links; random when empty")
+    parser.add_argument("--relay-window-ms", type=float, help="how long relayed events are batched per link")
+    parser.add_argument("--instrument", action="store_true", default=None, help="record per-stage latency histograms from the start")
+    parser.add_argument("--capture", help="record all inbound traffic to this file for bench/replay.py")
+
+
+def given(args):
+    """The options set on the command line, as a dict without the unset ones."""
+    return {key: value for key, value in vars(args).items() if value is not None}
+
+
+def server_options(parser, options):
+    """
+    Turns option values, with SERVER_DEFAULTS under them, into
+    create_server() arguments. Bad values end the program through
+    parser.error().
+    """
+    options = dict(SERVER_DEFAULTS, **options)
+    try:
+        type_limits = parse_type_limits(options["type_limits"])
+        peers = [parse_peer(peer) for peer in options["peers"]]
+    except ValueError as e:
+        parser.error(str(e))
+    if (options["relay_port"] is not None or peers) and not options["relay_secret"]:
+        parser.error("relay links need a --relay-secret; without one any host could join the cluster")
+    return {
+        "engine": options["engine"],
+        "workers": options["workers"],
+        "host": options["host"],
+        "port": options["port"],
+        "queue_limit": options["queue_limit"],
+        "overflow_policy": options["overflow_policy"],
+        "history_dir": options["history_dir"] or None,
+        "compress_threshold": options["compress_threshold"],
+        "idle_timeout": options["idle_timeout"],
+        "file_dir": options["file_dir"] or None,
+        "file_host": options["host"],
+        "file_port": options["file_port"],
+        "file_rate": options["file_rate"],
+        "instrument": options["instrument"],
+        "rate_limits": RateLimits(
+            message_rate=options["message_rate"],
+            message_burst=options["message_burst"],
+            byte_rate=options["byte_rate"],
+            type_limits=type_limits,
+            kick_after=options["kick_after"],
+        ) if options["rate_limits"] else None,
+        "relay_host": options["host"],
+        "relay_port": options["relay_port"],
+        "peers": peers,
+        "relay_secret": options["relay_secret"],
+        "relay_window": options["relay_window_ms"] / 1000,
+        "node_id": options["node_id"] or None,
+        "capture_path": options["capture"] or None,
+    }
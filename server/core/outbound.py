@@ -0,0 +1,77 @@
+import threading
+from collections import deque
+
+from common.protocol import MsgType
+
+DROP_OLDEST = "drop_oldest"
+DROP_TYPING = "drop_typing"
+DISCONNECT = "disconnect"
+POLICIES = (DROP_OLDEST, DROP_TYPING, DISCONNECT)
+
+DEFAULT_QUEUE_LIMIT = 1024
+
+TYPING_TYPES = (MsgType.TYPING, MsgType.STOP_TYPING)
+
+
+class OutboundQueue:
+    """
+    Bounded queue of encoded messages waiting to be written to one client.
+    Producers never block on it: when it is full the overflow policy
+    decides what to give up.
+
+    drop_oldest  discard the oldest queued message
+    drop_typing  discard typing notices first (the incoming one if it is a
+                 typing notice itself), then fall back to drop_oldest
+    disconnect   refuse the message; the server closes the client
+    """
+
+    def __init__(self, limit=DEFAULT_QUEUE_LIMIT, policy=DROP_TYPING):
+        if policy not in POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}, expected one of {POLICIES}")
+        self.limit = limit
+        self.policy = policy
+        self.items = deque()
+        self.nbytes = 0
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, data, msg_type=None):
+        """Queues data. Returns False when the client should be disconnected."""
+        with self.lock:
+            if len(self.items) >= self.limit:
+                if self.policy == DISCONNECT:
+                    return False
+                self.dropped += 1
+                if self.policy == DROP_TYPING and msg_type in TYPING_TYPES:
+                    return True
+                self._evict()
+            self.items.append((data, msg_type))
+            self.nbytes += len(data)
+        return True
+
+    def pop_many(self, limit):
+        """Pops up to limit queued messages, oldest first, for one vectored write."""
+        with self.lock:
+            count = min(limit, len(self.items))
+            batch = [self.items.popleft()[0] for _ in range(count)]
+            for data in batch:
+                self.nbytes -= len(data)
+            return batch
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.nbytes = 0
+
+    def _evict(self):
+        if self.policy == DROP_TYPING:
+            for i, (data, msg_type) in enumerate(self.items):
+                if msg_type in TYPING_TYPES:
+                    del self.items[i]
+                    self.nbytes -= len(data)
+                    return
+        data, _ = self.items.popleft()
+        self.nbytes -= len(data)
@@ -0,0 +1,91 @@
+import threading
+import time
+
+TYPING_TTL = 6.0
+PUBLISH_INTERVAL = 0.25
+
+
+class PresenceEngine:
+    """
+    Tracks who is typing without rebroadcasting every keystroke.
+
+    start_typing() only (re)arms a per-user expiry. tick(), driven by the
+    server every PUBLISH_INTERVAL, expires stale entries and, for every
+    room whose set of typing users changed since the last tick, publishes
+    it as one aggregated event. Typing traffic is therefore capped at one
+    event per room per interval however many people type.
+
+    Entries relayed from another node carry that node's id as their
+    origin; local_typing() leaves them out.
+    """
+
+    def __init__(self, publish, ttl=TYPING_TTL, clock=time.monotonic):
+        self.publish = publish
+        self.ttl = ttl
+        self.clock = clock
+        self.typing = {}
+        self.published = {}
+        self.lock = threading.Lock()
+
+    def start_typing(self, key, name, room):
+        expires = self.clock() + self.ttl
+        with self.lock:
+            entry = self.typing.get(key)
+            if entry is None or entry[2] != room:
+                self.typing[key] = [name, expires, room, None]
+            else:
+                entry[0] = name
+                entry[1] = expires
+
+    def stop_typing(self, key):
+        with self.lock:
+            self.typing.pop(key, None)
+
+    def rename(self, key, name):
+        with self.lock:
+            entry = self.typing.get(key)
+            if entry is not None:
+                entry[0] = name
+
+    def names(self, room):
+        with self.lock:
+            return tuple(name for name, _, entry_room, _ in self.typing.values() if entry_room == room)
+
+    def local_typing(self):
+        """Who is typing on this node, as {room: names}."""
+        by_room = {}
+        with self.lock:
+            for name, _, room, origin in self.typing.values():
+                if origin is None:
+                    by_room.setdefault(room, []).append(name)
+        return {room: tuple(names) for room, names in by_room.items()}
+
+    def set_remote(self, origin, room, names):
+        """Replaces who is typing in room on the node origin."""
+        expires = self.clock() + self.ttl
+        with self.lock:
+            for key in [key for key, entry in self.typing.items() if entry[3] == origin and entry[2] == room]:
+                del self.typing[key]
+            for name in names:
+                self.typing[(origin, room, name)] = [name, expires, room, origin]
+
+    def tick(self):
+        now = self.clock()
+        with self.lock:
+            expired = [key for key, (_, expires, _, _) in self.typing.items() if expires <= now]
+            for key in expired:
+                del self.typing[key]
+            by_room = {}
+            for name, _, room, _ in self.typing.values():
+                by_room.setdefault(room, []).append(name)
+            changed = []
+            for room in set(by_room) | set(self.published):
+                names = tuple(by_room.get(room, ()))
+                if names != self.published.get(room, ()):
+                    changed.append((room, names))
+                    if names:
+                        self.published[room] = names
+                    else:
+                        del self.published[room]
+        for room, names in changed:
+            self.publish(room, names)
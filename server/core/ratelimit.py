@@ -0,0 +1,147 @@
+from common.protocol import MsgType
+
+# every message a connection sends, whatever its type
+MESSAGE_RATE = 20.0
+MESSAGE_BURST = 40.0
+BYTE_RATE = 256 * 1024
+BYTE_BURST = 1024 * 1024
+# (rate, burst) per message type, on top of the connection's own budget;
+# the bursts leave room for a reconnect rejoining many rooms at once
+TYPE_LIMITS = {
+    MsgType.CHAT: (5.0, 20.0),
+    MsgType.DIRECT: (5.0, 20.0),
+    MsgType.TYPING: (2.0, 5.0),
+    MsgType.STOP_TYPING: (2.0, 5.0),
+    MsgType.RENAME: (0.2, 3.0),
+    MsgType.JOIN: (2.0, 20.0),
+    MsgType.LEAVE: (2.0, 20.0),
+    MsgType.HISTORY: (2.0, 20.0),
+    MsgType.ROOMS: (1.0, 5.0),
+    MsgType.SEARCH: (1.0, 5.0),
+    MsgType.ACK: (2.0, 10.0),
+    MsgType.FILE_OFFER: (0.5, 5.0),
+    MsgType.FILE_ACCEPT: (1.0, 10.0),
+    MsgType.FILE_CANCEL: (1.0, 10.0),
+}
+# a client is kicked once it has had this many messages dropped faster than STRIKE_DECAY per second
+KICK_AFTER = 100
+STRIKE_DECAY = 1.0
+# a throttled client is told about it at most this often
+WARN_INTERVAL = 5.0
+
+ALLOW = 0
+DROP = 1
+KICK = 2
+
+
+class TokenBucket:
+    """Holds up to burst tokens and gains rate of them per second; take() spends them."""
+
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def take(self, now, cost=1.0):
+        if not self.has(now, cost):
+            return False
+        self.tokens -= cost
+        return True
+
+    def has(self, now, cost=1.0):
+        """Refills the bucket up to now and tells whether cost tokens are there, without spending them."""
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens >= cost
+
+
+class RateLimits:
+    """
+    The limits every connection gets. Rates are per second and bursts are
+    bucket sizes; a rate of 0 lifts that limit. type_limits maps message
+    types to (rate, burst) and replaces TYPE_LIMITS as a whole.
+    """
+
+    def __init__(self, message_rate=MESSAGE_RATE, message_burst=MESSAGE_BURST, byte_rate=BYTE_RATE,
+                 byte_burst=BYTE_BURST, type_limits=None, kick_after=KICK_AFTER):
+        self.message_rate = message_rate
+        self.message_burst = message_burst
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.type_limits = dict(TYPE_LIMITS if type_limits is None else type_limits)
+        self.kick_after = kick_after
+
+
+def parse_type_limits(specs, base=TYPE_LIMITS):
+    """
+    Reads "type=rate" or "type=rate/burst" specs, such as "chat=5/20", over
+    base. A rate of 0 lifts the type's limit. Raises ValueError on a bad spec.
+    """
+    limits = dict(base)
+    for spec in specs:
+        name, _, value = spec.partition("=")
+        try:
+            msg_type = MsgType[name.strip().upper()]
+            rate, _, burst = value.partition("/")
+            rate = float(rate)
+            burst = float(burst) if burst else max(rate, 1.0)
+        except (KeyError, ValueError):
+            raise ValueError(f"bad rate limit {spec!r}, expected type=rate or type=rate/burst")
+        if rate > 0:
+            limits[msg_type] = (rate, burst)
+        else:
+            limits.pop(msg_type, None)
+    return limits
+
+
+class FloodGuard:
+    """
+    One connection's buckets. admit() judges a message from its frame
+    header alone, so a dropped message is never parsed. Dropped messages
+    count as strikes that wear off at STRIKE_DECAY per second; a client
+    that keeps flooding past kick_after of them is kicked.
+    """
+
+    __slots__ = ("limits", "messages", "bytes", "types", "strikes", "warned_at")
+
+    def __init__(self, limits, now):
+        self.limits = limits
+        self.messages = TokenBucket(limits.message_rate, limits.message_burst, now) if limits.message_rate else None
+        self.bytes = TokenBucket(limits.byte_rate, limits.byte_burst, now) if limits.byte_rate else None
+        # created on the first message of each type
+        self.types = {}
+        self.strikes = TokenBucket(STRIKE_DECAY, limits.kick_after, now) if limits.kick_after else None
+        self.warned_at = None
+
+    def admit(self, msg_type, nbytes, now):
+        """ALLOW, DROP or KICK for one message of nbytes payload."""
+        bucket = self.types.get(msg_type)
+        if bucket is None:
+            limit = self.limits.type_limits.get(msg_type)
+            if limit is not None:
+                bucket = self.types[msg_type] = TokenBucket(limit[0], limit[1], now)
+        # every bucket must have room before any is charged, so a dropped message costs nothing
+        if (
+            (bucket is None or bucket.has(now))
+            and (self.messages is None or self.messages.has(now))
+            and (self.bytes is None or self.bytes.has(now, nbytes))
+        ):
+            if bucket is not None:
+                bucket.tokens -= 1
+            if self.messages is not None:
+                self.messages.tokens -= 1
+            if self.bytes is not None:
+                self.bytes.tokens -= nbytes
+            return ALLOW
+        if self.strikes is not None and not self.strikes.take(now):
+            return KICK
+        return DROP
+
+    def should_warn(self, now):
+        if self.warned_at is not None and now - self.warned_at < WARN_INTERVAL:
+            return False
+        self.warned_at = now
+        return True
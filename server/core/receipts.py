@@ -0,0 +1,114 @@
+import bisect
+from collections import OrderedDict, deque
+
+# how often aggregated receipts go out to the senders
+RECEIPT_INTERVAL = 1.0
+# the newest messages of each room whose receipt counts are kept current
+TRACKED_MESSAGES = 256
+MAX_RECEIPT_ROOMS = 1024
+
+
+class RoomReceipts:
+    __slots__ = ("messages", "marks", "published", "dirty")
+
+    def __init__(self, limit):
+        # (seq, sender) of the newest messages, oldest first
+        self.messages = deque(maxlen=limit)
+        # name -> [delivered seq, read seq], both cumulative
+        self.marks = {}
+        # seq -> (delivered, read) counts last sent to the sender
+        self.published = {}
+        self.dirty = False
+
+
+class ReceiptTable:
+    """
+    Delivery and read state of recent messages, kept per room as one pair
+    of cumulative watermarks per member rather than one set of readers per
+    message: a member who acked seq n has received (or read) every message
+    of the room up to n. How many members got a message is then the number
+    of watermarks at or past its seq, found by bisecting the sorted marks.
+
+    ack() only moves watermarks; flush() turns the rooms that moved into
+    counts for the messages whose counts changed. Callers hold clients_lock.
+    """
+
+    def __init__(self, limit=TRACKED_MESSAGES, max_rooms=MAX_RECEIPT_ROOMS):
+        self.limit = limit
+        self.max_rooms = max_rooms
+        self.rooms = OrderedDict()
+
+    def track(self, room, seq, sender):
+        state = self.rooms.get(room)
+        if state is None:
+            state = self.rooms[room] = RoomReceipts(self.limit)
+            if len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+        else:
+            self.rooms.move_to_end(room)
+        state.messages.append((seq, sender))
+
+    def ack(self, room, name, delivered, read):
+        """Moves name's watermarks in room forward. Returns False when they did not move."""
+        state = self.rooms.get(room)
+        if state is None or not state.messages:
+            return False
+        # reading a message implies having it
+        delivered = max(delivered, read)
+        # marks below every tracked message count for nothing, so they are not kept
+        if delivered < state.messages[0][0]:
+            return False
+        mark = state.marks.get(name)
+        if mark is None:
+            state.marks[name] = [delivered, read]
+        elif delivered > mark[0] or read > mark[1]:
+            mark[0] = max(mark[0], delivered)
+            mark[1] = max(mark[1], read)
+        else:
+            return False
+        state.dirty = True
+        return True
+
+    def rename(self, old, new):
+        for state in self.rooms.values():
+            mark = state.marks.pop(old, None)
+            if mark is not None:
+                state.marks[new] = mark
+            if any(sender == old for _, sender in state.messages):
+                state.messages = deque(
+                    ((seq, new if sender == old else sender) for seq, sender in state.messages), maxlen=self.limit
+                )
+
+    def flush(self, room_sizes):
+        """
+        Returns {sender: [(seq, delivered, read, recipients)]} for every
+        message whose counts changed since the last flush; room_sizes maps
+        rooms to how many members they have now.
+        """
+        updates = {}
+        for room, state in self.rooms.items():
+            if not state.dirty:
+                continue
+            state.dirty = False
+            oldest = state.messages[0][0]
+            for name in [name for name, mark in state.marks.items() if mark[0] < oldest]:
+                del state.marks[name]
+            delivered = sorted(mark[0] for mark in state.marks.values())
+            read = sorted(mark[1] for mark in state.marks.values())
+            recipients = max(room_sizes.get(room, 0) - 1, 0)
+            published = {}
+            for seq, sender in state.messages:
+                got = len(delivered) - bisect.bisect_left(delivered, seq)
+                seen = len(read) - bisect.bisect_left(read, seq)
+                # a sender's acks cover its own messages too
+                mark = state.marks.get(sender)
+                if mark is not None:
+                    got -= mark[0] >= seq
+                    seen -= mark[1] >= seq
+                counts = (got, seen)
+                if got:
+                    published[seq] = counts
+                    if state.published.get(seq) != counts:
+                        updates.setdefault(sender, []).append((seq, got, seen, max(recipients, got)))
+            state.published = published
+        return updates
@@ -0,0 +1,321 @@
+import itertools
+import os
+import random
+import secrets
+import socket
+import threading
+import time
+from collections import OrderedDict
+from enum import IntEnum
+
+from common.protocol import MsgType, FrameDecoder, ProtocolError, encode_frame
+
+RELAY_PORT = 5002
+# events for one link are collected this long and written with one send
+RELAY_WINDOW = 0.005
+BATCH_BYTES = 64 * 1024
+# a peer that lets this much pile up is disconnected; it reconnects and carries on
+LINK_QUEUE_BYTES = 8 * 1024 * 1024
+# event ids remembered for dedup; enough for several seconds of a busy mesh
+SEEN_IDS = 65536
+MAX_HOPS = 16
+# peers drop remote typers after TYPING_TTL, so non-empty typing sets are resent more often than that
+TYPING_REFRESH = 2.0
+HANDSHAKE_TIMEOUT = 10.0
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 30.0
+
+
+class RelayOp(IntEnum):
+    HELLO = 0      # node id, secret
+    EVENT = 1      # event id, origin node, path, msg type, "1" if recorded, room or "", fields
+
+
+class SeenIds:
+    """The last capacity event ids, for dropping events that reached this node twice."""
+
+    def __init__(self, capacity=SEEN_IDS):
+        self.capacity = capacity
+        self.ids = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, event_id):
+        """Remembers event_id; returns False when it was already known."""
+        with self.lock:
+            if event_id in self.ids:
+                return False
+            self.ids[event_id] = None
+            if len(self.ids) > self.capacity:
+                self.ids.popitem(last=False)
+            return True
+
+
+class RelayLink:
+    """
+    One connection to a peer node, with a reader thread and a writer
+    thread. send() only queues; the writer waits window seconds after the
+    first queued event, or until BATCH_BYTES are waiting, and writes the
+    whole batch with one sendall().
+    """
+
+    def __init__(self, relay, sock, address):
+        self.relay = relay
+        self.sock = sock
+        self.address = address
+        self.peer = None
+        self.pending = []
+        self.pending_bytes = 0
+        self.closed = False
+        self.cond = threading.Condition()
+        self.done = threading.Event()
+
+    def start(self):
+        threading.Thread(target=self.read_loop, daemon=True).start()
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def send(self, data):
+        with self.cond:
+            if self.closed:
+                return
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+            if self.pending_bytes > LINK_QUEUE_BYTES:
+                print(f"Error in relay: {self.peer or self.address} fell behind, disconnecting it")
+                self.closed = True
+            if len(self.pending) == 1 or self.pending_bytes >= BATCH_BYTES or self.closed:
+                self.cond.notify()
+        if self.closed:
+            self.close()
+
+    def write_loop(self):
+        window = self.relay.window
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                deadline = time.monotonic() + window
+                while not self.closed and self.pending_bytes < BATCH_BYTES:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if self.closed:
+                    return
+                batch, count = b"".join(self.pending), len(self.pending)
+                self.pending = []
+                self.pending_bytes = 0
+            try:
+                self.sock.sendall(batch)
+            except OSError:
+                self.close()
+                return
+            self.relay.stats.count_relay(sent=count, batches=1)
+
+    def read_loop(self):
+        decoder = FrameDecoder()
+        try:
+            self.sock.settimeout(HANDSHAKE_TIMEOUT)
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                for frame in decoder.feed(data):
+                    if self.peer is None:
+                        if not self.relay.handshake(self, frame):
+                            return
+                        self.sock.settimeout(None)
+                    elif frame.type == RelayOp.EVENT:
+                        self.relay.received(self, frame.fields())
+        except (OSError, ProtocolError):
+            pass
+        except Exception as e:
+            print(f"Error in relay link: {e}")
+        finally:
+            self.close()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.relay.unlink(self)
+        self.done.set()
+
+
+class Relay:
+    """
+    Links this server to peer servers so that users on every node share
+    the same rooms. Broadcasts are published as events with an id made of
+    the origin node's id and a counter, and flooded to every link. Each
+    event carries the nodes it has passed through and is never sent to
+    one of those again; an event that still arrives twice, over two paths
+    of a mesh, is dropped by id.
+
+    Typing state is relayed as each node's own typers per room whenever
+    they change, and resent every TYPING_REFRESH while non-empty so that it
+    does not expire on the peers.
+
+    on_event(origin, msg_type, record, room, fields) runs on a link's
+    reader thread for every new event.
+    """
+
+    def __init__(self, on_event, stats, node_id=None, host="0.0.0.0", port=None, peers=(), secret="",
+                 window=RELAY_WINDOW):
+        if not secret:
+            raise ValueError("relay links need a secret; with an empty one any host could link")
+        self.on_event = on_event
+        self.stats = stats
+        self.node_id = node_id or secrets.token_hex(4)
+        self.secret = secret
+        self.window = window
+        self.peers = list(peers)
+        self.links = set()
+        self.lock = threading.Lock()
+        self.seen = SeenIds()
+        self.ids = itertools.count(1)
+        # the typers last relayed, {room: names}; only the typing timer touches these
+        self.typing = {}
+        self.typing_refreshed = 0.0
+        self.stopped = threading.Event()
+        self.sock = None
+        if port is not None:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            if os.name != "nt":
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host, port))
+            self.sock.listen(16)
+            self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        if self.sock is not None:
+            threading.Thread(target=self.accept_loop, daemon=True).start()
+        for peer in self.peers:
+            threading.Thread(target=self.dial_loop, args=(peer,), daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.sock is not None:
+            self.sock.close()
+        for link in self.peer_links():
+            link.close()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, address = self.sock.accept()
+            except OSError:
+                break
+            self.open_link(sock, address)
+
+    def dial_loop(self, peer):
+        """Keeps a link to peer, a (host, port) pair, up until the relay stops."""
+        delay = RECONNECT_MIN
+        while not self.stopped.is_set():
+            try:
+                sock = socket.create_connection(peer, timeout=HANDSHAKE_TIMEOUT)
+            except OSError:
+                sock = None
+            if sock is not None:
+                link = self.open_link(sock, peer)
+                started = time.monotonic()
+                link.done.wait()
+                # a link that stayed up for a while starts the backoff over
+                if time.monotonic() - started > RECONNECT_MAX:
+                    delay = RECONNECT_MIN
+            # full jitter, so nodes that lost each other do not redial in step
+            if self.stopped.wait(random.uniform(0, delay)):
+                break
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    def open_link(self, sock, address):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = RelayLink(self, sock, address)
+        try:
+            sock.sendall(encode_frame(RelayOp.HELLO, (self.node_id, self.secret)))
+        except OSError:
+            link.close()
+            return link
+        link.start()
+        return link
+
+    def handshake(self, link, frame):
+        fields = frame.fields() + ["", ""]
+        node_id, secret = fields[:2]
+        if frame.type != RelayOp.HELLO or not node_id or not secrets.compare_digest(secret, self.secret):
+            print(f"Error in relay: {link.address} failed the handshake")
+            return False
+        if node_id == self.node_id:
+            return False
+        link.peer = node_id
+        with self.lock:
+            self.links.add(link)
+        return True
+
+    def unlink(self, link):
+        with self.lock:
+            self.links.discard(link)
+
+    def peer_links(self):
+        with self.lock:
+            return list(self.links)
+
+    def publish(self, msg_type, fields, room=None, record=False):
+        """Sends a broadcast that originated here to every peer."""
+        event_id = f"{self.node_id}.{next(self.ids)}"
+        self.seen.add(event_id)
+        head = (event_id, self.node_id, self.node_id, str(int(msg_type)), "1" if record else "0", room or "")
+        data = encode_frame(RelayOp.EVENT, head + tuple(fields))
+        for link in self.peer_links():
+            link.send(data)
+
+    def sync_typing(self, typing):
+        """
+        Timer: relays this node's own typers, {room: names}, for every room
+        where they changed, and every TYPING_REFRESH also the unchanged
+        non-empty ones, which peers would otherwise expire.
+        """
+        now = time.monotonic()
+        refresh = now - self.typing_refreshed >= TYPING_REFRESH
+        if refresh:
+            self.typing_refreshed = now
+        for room in set(typing) | set(self.typing):
+            names = typing.get(room, ())
+            if names != self.typing.get(room, ()) or (names and refresh):
+                self.publish(MsgType.TYPING, (room,) + names, room)
+        self.typing = typing
+
+    def received(self, link, fields):
+        if len(fields) < 6:
+            return
+        event_id, origin, path, msg_type, record, room = fields[:6]
+        if not self.seen.add(event_id):
+            self.stats.count_relay(duplicates=1)
+            return
+        self.stats.count_relay(received=1)
+        visited = path.split()
+        if len(visited) < MAX_HOPS:
+            # forward to the nodes this event has not been through yet
+            head = (event_id, origin, f"{path} {self.node_id}", msg_type, record, room)
+            data = None
+            for other in self.peer_links():
+                if other is not link and other.peer not in visited:
+                    if data is None:
+                        data = encode_frame(RelayOp.EVENT, head + tuple(fields[6:]))
+                    other.send(data)
+        try:
+            msg_type = int(msg_type)
+        except ValueError:
+            return
+        self.on_event(origin, msg_type, record == "1", room or None, fields[6:])
+
+
+def parse_peer(spec, default_port=RELAY_PORT):
+    """"host:port" or "host" as a (host, port) pair."""
+    host, _, port = spec.rpartition(":")
+    if not host:
+        return spec, default_port
+    return host, int(port)
@@ -0,0 +1,254 @@
+import bisect
+import heapq
+import re
+import threading
+import time
+import unicodedata
+from array import array
+from collections import deque
+
+# a segment is sealed and compacted once it holds this many messages
+SEGMENT_DOCS = 65536
+# rough budget for the whole index; the oldest segments are dropped past it
+INDEX_BYTES = 256 * 1024 * 1024
+# estimated cost of one distinct term in a segment (dict slot, key string, posting header)
+TERM_BYTES = 96
+SEALED_TERM_BYTES = 64
+DOC_BYTES = 20
+MAX_RESULTS = 100
+# candidates one query may examine before it settles for what it found
+MAX_SCAN = 200000
+MIN_TOKEN = 2
+MAX_TOKEN = 32
+INDEX_INTERVAL = 0.2
+
+WORD = re.compile(r"\w+")
+COMBINING = re.compile("[\\u0300-\\u036f]")
+# filter terms share the postings with words; the prefix cannot occur in a tokenized word
+USER_TERM = "\0u:"
+ROOM_TERM = "\0r:"
+
+
+def tokenize(text):
+    """Distinct search terms of text: case- and accent-folded words of MIN_TOKEN to MAX_TOKEN characters."""
+    text = COMBINING.sub("", unicodedata.normalize("NFKD", text.casefold()))
+    return {word for word in WORD.findall(text) if MIN_TOKEN <= len(word) <= MAX_TOKEN}
+
+
+class IndexSegment:
+    """
+    Up to SEGMENT_DOCS messages. Document numbers are positions in the
+    per-document arrays, so postings are sorted arrays of small ints and
+    time ranges bisect the times array. Sealing packs every posting list
+    into one array, which keeps a term's cost to one dict entry.
+    """
+
+    def __init__(self):
+        self.seqs = array("I")
+        self.times = array("d")
+        self.rooms = array("I")
+        self.postings = {}
+        self.packed = None
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def add(self, seq, timestamp, room_id, terms):
+        doc = len(self.seqs)
+        self.seqs.append(seq)
+        self.times.append(timestamp)
+        self.rooms.append(room_id)
+        postings = self.postings
+        for term in terms:
+            posting = postings.get(term)
+            if posting is None:
+                posting = postings[term] = array("I")
+                self.nbytes += TERM_BYTES
+            posting.append(doc)
+        self.nbytes += DOC_BYTES + 4 * len(terms)
+
+    def seal(self):
+        packed = array("I")
+        offsets = {}
+        for term, posting in self.postings.items():
+            offsets[term] = (len(packed) << 32) | len(posting)
+            packed.extend(posting)
+        self.postings = offsets
+        self.packed = memoryview(packed)
+        self.nbytes = DOC_BYTES * len(self.seqs) + 4 * len(packed) + SEALED_TERM_BYTES * len(offsets)
+
+    def posting(self, term):
+        entry = self.postings.get(term)
+        if entry is None or self.packed is None:
+            return entry if entry is not None else ()
+        start = entry >> 32
+        return self.packed[start:start + (entry & 0xFFFFFFFF)]
+
+    def search(self, terms, since, until, room_ids, limit, budget):
+        """
+        Newest first: (seq, room id) of the documents holding every term,
+        inside [since, until] and, when room_ids is given, in one of those
+        rooms. Returns the hits and the scan budget left.
+        """
+        if not self.seqs or self.times[0] > until or self.times[-1] < since:
+            return [], budget
+        lists = sorted((self.posting(term) for term in terms), key=len)
+        if not lists or not lists[0]:
+            return [], budget
+        smallest, others = lists[0], lists[1:]
+        lo = bisect.bisect_left(self.times, since)
+        hi = bisect.bisect_right(self.times, until)
+        end = bisect.bisect_left(smallest, hi)
+        start = bisect.bisect_left(smallest, lo)
+        hits = []
+        for i in range(end - 1, start - 1, -1):
+            budget -= 1
+            if budget <= 0:
+                break
+            doc = smallest[i]
+            if room_ids is not None and self.rooms[doc] not in room_ids:
+                continue
+            for other in others:
+                j = bisect.bisect_left(other, doc)
+                if j == len(other) or other[j] != doc:
+                    break
+            else:
+                hits.append((self.seqs[doc], self.rooms[doc]))
+                if len(hits) >= limit:
+                    break
+        return hits, budget
+
+
+class SearchIndex:
+    """
+    Inverted index over chat messages, kept up to date as they are sent.
+    add() only queues a message, so the routing path never tokenizes;
+    index_pending(), run by a server timer and before every query, files
+    the queue into the newest segment. Segments are sealed as they fill
+    and the oldest are dropped once the index outgrows max_bytes, so
+    memory stays bounded and a query stops as soon as the newest segments
+    gave it enough hits.
+
+    Messages hold the seq, the room and the sender; the text itself is read
+    back from the history log for the hits only.
+    """
+
+    def __init__(self, max_bytes=INDEX_BYTES, segment_docs=SEGMENT_DOCS):
+        self.max_bytes = max_bytes
+        self.segment_docs = segment_docs
+        self.segments = [IndexSegment()]
+        self.room_ids = {}
+        self.room_names = []
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(segment) for segment in self.segments)
+
+    @property
+    def nbytes(self):
+        with self.lock:
+            return sum(segment.nbytes for segment in self.segments)
+
+    def add(self, seq, room, user, text, timestamp=None):
+        """Queues a message for indexing. Safe to call with the server's locks held."""
+        self.pending.append((seq, timestamp or time.time(), room, user, text))
+
+    def index_pending(self):
+        with self.lock:
+            while self.pending:
+                seq, timestamp, room, user, text = self.pending.popleft()
+                self._index(self.segments, seq, timestamp, room, user, text)
+            self._enforce_budget()
+
+    def _index(self, segments, seq, timestamp, room, user, text):
+        """Call with lock held."""
+        segment = segments[-1]
+        if len(segment) >= self.segment_docs:
+            segment.seal()
+            segment = IndexSegment()
+            segments.append(segment)
+        # times must not go backwards within a segment, or bisecting them would miss hits
+        if segment.times:
+            timestamp = max(timestamp, segment.times[-1])
+        terms = tokenize(text)
+        terms.add(USER_TERM + user.casefold())
+        terms.add(ROOM_TERM + room)
+        segment.add(seq, timestamp, self._room_id(room), terms)
+
+    def _room_id(self, room):
+        room_id = self.room_ids.get(room)
+        if room_id is None:
+            room_id = self.room_ids[room] = len(self.room_names)
+            self.room_names.append(room)
+        return room_id
+
+    def _enforce_budget(self):
+        total = sum(segment.nbytes for segment in self.segments)
+        while len(self.segments) > 1 and total > self.max_bytes:
+            total -= self.segments.pop(0).nbytes
+
+    def backfill(self, records):
+        """
+        Indexes older messages, as (seq, timestamp, room, user, text) in
+        seq order, all older than anything add() has seen. They go into
+        segments of their own, placed before the live ones, so live
+        indexing carries on meanwhile.
+        """
+        built = [IndexSegment()]
+        size = 0
+        for count, (seq, timestamp, room, user, text) in enumerate(records, 1):
+            with self.lock:
+                self._index(built, seq, timestamp, room, user, text)
+            if len(built[-1]) == 1 and len(built) > 1:
+                size += built[-2].nbytes
+                # only the newest backfilled segments can survive the budget anyway
+                while len(built) > 2 and size > self.max_bytes:
+                    size -= built.pop(0).nbytes
+            if count % 1000 == 0:
+                time.sleep(0)
+        if not built[-1]:
+            return
+        built[-1].seal()
+        with self.lock:
+            self.segments[:0] = built
+            self._enforce_budget()
+
+    def search(self, query, rooms, user=None, since=None, until=None, limit=MAX_RESULTS):
+        """
+        Newest first, the (seq, room) of up to limit messages holding every
+        word of query, sent in one of rooms, by user when given, between
+        the since and until timestamps when given. Returns (hits, complete);
+        complete is False when the scan budget ran out first.
+        """
+        terms = tokenize(query)
+        if user:
+            terms.add(USER_TERM + user.strip().casefold())
+        if not terms:
+            return [], True
+        self.index_pending()
+        with self.lock:
+            room_ids = {self.room_ids[room] for room in rooms if room in self.room_ids}
+            if not room_ids:
+                return [], True
+            if len(room_ids) == 1:
+                # a single room is just one more posting list to intersect
+                terms.add(ROOM_TERM + self.room_names[next(iter(room_ids))])
+                room_ids = None
+            since = since if since is not None else float("-inf")
+            until = until if until is not None else float("inf")
+            hits = []
+            budget = MAX_SCAN
+            for segment in reversed(self.segments):
+                found, budget = segment.search(terms, since, until, room_ids, limit - len(hits), budget)
+                hits += [(seq, self.room_names[room_id]) for seq, room_id in found]
+                if len(hits) >= limit or budget <= 0:
+                    break
+            return hits, budget > 0
+
+
+def merge_by_seq(streams):
+    """Merges per-room record streams, each in seq order, into one."""
+    return heapq.merge(*streams, key=lambda item: item[0])
@@ -0,0 +1,133 @@
+import secrets
+from collections import OrderedDict, deque
+
+from .timerwheel import TimerWheel
+
+# how long a dropped client's session waits for it to come back
+SESSION_TTL = 120.0
+REPLAY_LIMIT = 512
+MAX_REPLAY_ROOMS = 1024
+
+
+class Session:
+    """
+    A client's identity across connections. While a connection holds it,
+    client is set; once the connection drops, the name, rooms and current
+    room it had are kept until it is resumed or expires.
+    """
+
+    __slots__ = ("token", "client", "name", "rooms", "room")
+
+    def __init__(self, token, client):
+        self.token = token
+        self.client = client
+        self.name = None
+        self.rooms = ()
+        self.room = None
+
+
+class SessionTable:
+    """Sessions by token; detached ones expire SESSION_TTL after their connection dropped. Callers hold clients_lock."""
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.sessions = {}
+        self.expiry = TimerWheel(1.0, 256)
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def open(self, client):
+        session = Session(secrets.token_urlsafe(18), client)
+        self.sessions[session.token] = session
+        client.session = session
+        return session
+
+    def get(self, token):
+        return self.sessions.get(token)
+
+    def attach(self, session, client):
+        """Moves client onto an existing session, dropping the one it was given at HELLO."""
+        self.expiry.cancel(session.token)
+        fresh = client.session
+        if fresh is not None and fresh is not session:
+            self.sessions.pop(fresh.token, None)
+        session.client = client
+        client.session = session
+
+    def detach(self, client, name):
+        session = client.session
+        if session is None or session.client is not client:
+            return
+        session.client = None
+        session.name = name
+        session.rooms = tuple(client.rooms)
+        session.room = client.room
+        self.expiry.schedule(session.token, self.ttl)
+
+    def close(self, session):
+        if session is not None:
+            self.sessions.pop(session.token, None)
+            self.expiry.cancel(session.token)
+
+    def expire(self):
+        for token in self.expiry.advance():
+            session = self.sessions.get(token)
+            if session is not None and session.client is None:
+                del self.sessions[token]
+
+
+class ReplayBuffer:
+    """
+    The last REPLAY_LIMIT sequenced messages of each room (None for ones
+    sent to everyone), kept in memory so a resuming client catches up
+    without touching the history log. Rooms are shared by all their
+    members, so one copy serves every session.
+
+    Each room keeps a floor: every message of the room with a seq above
+    it is still buffered. It rises as old entries fall out; a room the
+    LRU evicted takes evicted_seq, the newest seq any evicted room held,
+    as its floor, so a buffer rebuilt after an eviction never claims to
+    be complete.
+    """
+
+    def __init__(self, limit=REPLAY_LIMIT, max_rooms=MAX_REPLAY_ROOMS):
+        self.limit = limit
+        self.max_rooms = max_rooms
+        # room -> [floor, entries]
+        self.rooms = OrderedDict()
+        self.evicted_seq = 0
+
+    def append(self, room, seq, msg_type, fields):
+        buffered = self.rooms.get(room)
+        if buffered is None:
+            buffered = self.rooms[room] = [self.evicted_seq, deque()]
+            if len(self.rooms) > self.max_rooms:
+                _, (_, evicted) = self.rooms.popitem(last=False)
+                if evicted:
+                    self.evicted_seq = max(self.evicted_seq, evicted[-1][0])
+        else:
+            self.rooms.move_to_end(room)
+        entries = buffered[1]
+        entries.append((seq, msg_type, tuple(fields)))
+        if len(entries) > self.limit:
+            buffered[0] = entries.popleft()[0]
+
+    def since(self, room, seq):
+        """
+        Returns the entries of room after seq, oldest first, and whether
+        that is all of them: older ones may have fallen out or been evicted.
+        """
+        buffered = self.rooms.get(room)
+        if buffered is None:
+            return [], seq >= self.evicted_seq
+        floor, entries = buffered
+        complete = seq >= floor
+        missed = []
+        # seq ids only grow, so walk back from the newest end
+        for entry in reversed(entries):
+            if entry[0] <= seq:
+                break
+            missed.append(entry)
+        missed.reverse()
+        return missed, complete
@@ -0,0 +1,126 @@
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+class Histogram:
+    """Fixed-bucket histogram in the Prometheus layout (upper bounds, +Inf last)."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.bounds + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+
+class ServerStats:
+    """
+    Counters the engines bump on the hot path. Each fan-out counter has
+    one writer at a time, so readers may look at them without locking:
+    broadcasts, recipients and bytes_encoded are only bumped by the
+    broadcaster, which holds clients_lock; write_calls, bytes_written and
+    bytes_copied only by the writer side (the SocketWriter thread or the
+    event loop). Inbound counters are bumped by every reader thread and
+    take a lock.
+    """
+
+    def __init__(self):
+        self.connections_total = 0
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.broadcasts = 0
+        self.recipients = 0
+        # user-space copies: encoding broadcasts, and joining buffers where writev is missing
+        self.bytes_encoded = 0
+        self.bytes_copied = 0
+        self.write_calls = 0
+        self.bytes_written = 0
+        self.messages_per_sec = 0.0
+        self.idle_disconnects = 0
+        self.throttled_messages = 0
+        self.flood_disconnects = 0
+        self.acks_received = 0
+        self.receipts_sent = 0
+        self.captured_bytes = 0
+        self.compressed_payloads = 0
+        self.compression_bytes_saved = 0
+        self.compression_seconds = 0.0
+        # bumped by the file transfer threads through count_file_bytes()
+        self.files_uploaded = 0
+        self.file_bytes_received = 0
+        self.file_bytes_sent = 0
+        # bumped by the relay link threads through count_relay()
+        self.relay_events_sent = 0
+        self.relay_events_received = 0
+        self.relay_duplicates = 0
+        self.relay_batches = 0
+        self.broadcast_latency = Histogram()
+
+        self._in_lock = threading.Lock()
+        self._compress_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._relay_lock = threading.Lock()
+        self._last_sample = (time.monotonic(), 0)
+
+    def count_in(self, nbytes, nmessages):
+        with self._in_lock:
+            self.bytes_in += nbytes
+            self.messages_in += nmessages
+
+    def count_flood(self, throttled=0, kicked=0):
+        with self._in_lock:
+            self.throttled_messages += throttled
+            self.flood_disconnects += kicked
+
+    def count_relay(self, sent=0, received=0, duplicates=0, batches=0):
+        with self._relay_lock:
+            self.relay_events_sent += sent
+            self.relay_events_received += received
+            self.relay_duplicates += duplicates
+            self.relay_batches += batches
+
+    def count_compression(self, raw, compressed, seconds):
+        """Called by DeflateCodec; encoding happens both inside and outside clients_lock."""
+        with self._compress_lock:
+            self.compressed_payloads += 1
+            self.compression_bytes_saved += max(raw - compressed, 0)
+            self.compression_seconds += seconds
+
+    def count_file_bytes(self, received=0, sent=0, uploaded=0):
+        """Called by the file transfer threads, several of which run at once."""
+        with self._file_lock:
+            self.file_bytes_received += received
+            self.file_bytes_sent += sent
+            self.files_uploaded += uploaded
+
+    def sample_rates(self):
+        """Refreshes messages_per_sec; the server calls this once a second."""
+        now = time.monotonic()
+        then, messages = self._last_sample
+        if now > then:
+            self.messages_per_sec = (self.messages_in - messages) / (now - then)
+        self._last_sample = (now, self.messages_in)
+
+    def snapshot(self):
+        return {k: v for k, v in vars(self).items() if isinstance(v, (int, float))}
+
+    def per_broadcast(self):
+        """Average write syscalls and user-space bytes copied per broadcast."""
+        broadcasts = self.broadcasts or 1
+        return {
+            "syscalls_per_broadcast": self.write_calls / broadcasts,
+            "bytes_copied_per_broadcast": (self.bytes_encoded + self.bytes_copied) / broadcasts,
+        }
@@ -0,0 +1,60 @@
+import math
+import threading
+import time
+
+
+class TimerWheel:
+    """
+    Hashed timing wheel. A key due at tick t lives in slot t % slots, so
+    schedule() and cancel() are O(1) and advance() only visits the slots
+    for the ticks that went by, whatever the number of keys. Delays longer
+    than one turn of the wheel are allowed; such keys stay in their slot
+    until the turn they are due in. Keep slots * tick above the usual
+    delay so that is rare.
+    """
+
+    def __init__(self, tick=1.0, slots=64, clock=time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.slots = [{} for _ in range(slots)]
+        self.where = {}
+        self.current = int(clock() / tick)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.where)
+
+    def schedule(self, key, delay):
+        """Arms key to expire delay seconds from now, replacing any earlier deadline."""
+        due = math.ceil((self.clock() + delay) / self.tick)
+        with self.lock:
+            due = max(due, self.current + 1)
+            index = due % len(self.slots)
+            old = self.where.get(key)
+            if old is not None:
+                del self.slots[old][key]
+            self.slots[index][key] = due
+            self.where[key] = index
+
+    def cancel(self, key):
+        with self.lock:
+            index = self.where.pop(key, None)
+            if index is not None:
+                del self.slots[index][key]
+
+    def advance(self):
+        """Moves the wheel up to now and returns the keys that came due."""
+        now = int(self.clock() / self.tick)
+        expired = []
+        with self.lock:
+            # after a stall longer than a turn, one pass over every slot catches up
+            last = min(now, self.current + len(self.slots))
+            for tick in range(self.current + 1, last + 1):
+                slot = self.slots[tick % len(self.slots)]
+                due = [key for key, deadline in slot.items() if deadline <= now]
+                for key in due:
+                    del slot[key]
+                    del self.where[key]
+                expired += due
+            self.current = max(self.current, now)
+        return expired
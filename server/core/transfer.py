@@ -0,0 +1,383 @@
+import itertools
+import os
+import secrets
+import socket
+import threading
+import time
+
+from common.protocol import (
+    HEADER, MAGIC, VERSION, MAX_PAYLOAD, FIELD_SEP, StreamOp, CHUNK_SIZE, ACK_INTERVAL, encode_frame,
+)
+
+# per-transfer bandwidth cap in bytes per second; 0 lifts it
+FILE_RATE = 8 * 1024 * 1024
+MAX_FILE_SIZE = 1024 * 1024 * 1024
+# offered sizes of all spooled transfers together, and offers one user may have spooled at once
+SPOOL_LIMIT = 8 * 1024 * 1024 * 1024
+MAX_SENDER_TRANSFERS = 8
+# an unfinished or undownloaded transfer is dropped after this long without activity
+TRANSFER_TTL = 3600.0
+# data connections served at once; each has its own thread
+MAX_STREAMS = 64
+STREAM_TIMEOUT = 30.0
+# OPEN is read before the token is checked, so it is held to the few fields it carries
+MAX_OPEN_PAYLOAD = 512
+UPLOAD = "upload"
+DOWNLOAD = "download"
+
+
+def safe_file_name(name):
+    """The last path component of name, or "" when nothing usable is left."""
+    name = name.replace("\\", "/").rsplit("/", 1)[-1].strip()
+    return "" if name in ("", ".", "..") else name[:255]
+
+
+class TransferRefused(Exception):
+    pass
+
+
+class Transfer:
+    """
+    One offered file. recipient is a user name or "#room". The upload is
+    spooled to path; stored says how much of it arrived, so an upload that
+    dropped continues from there. accepted maps every name that accepted
+    the offer to its download token.
+    """
+
+    __slots__ = ("id", "sender", "recipient", "name", "size", "path", "upload_token", "stored", "accepted",
+                 "complete", "updated", "lock", "uploader")
+
+    def __init__(self, transfer_id, sender, recipient, name, size, path):
+        self.id = transfer_id
+        self.sender = sender
+        self.recipient = recipient
+        self.name = name
+        self.size = size
+        self.path = path
+        self.upload_token = secrets.token_urlsafe(18)
+        self.stored = 0
+        self.accepted = {}
+        self.complete = False
+        self.updated = time.monotonic()
+        # held by the one connection uploading into path
+        self.lock = threading.Lock()
+        self.uploader = None
+
+
+class TransferTable:
+    """
+    Offered transfers by id, with their spool files. Thread-safe: data
+    connections use it too. Every offer reserves its full size in the
+    spool; offers past spool_limit, or past max_per_sender of one sender,
+    are refused until earlier ones finish or expire.
+    """
+
+    def __init__(self, spool_dir, ttl=TRANSFER_TTL, spool_limit=SPOOL_LIMIT, max_per_sender=MAX_SENDER_TRANSFERS):
+        self.spool_dir = spool_dir
+        self.ttl = ttl
+        self.spool_limit = spool_limit
+        self.max_per_sender = max_per_sender
+        self.transfers = {}
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        os.makedirs(spool_dir, exist_ok=True)
+        # ids restart with the server, so leftovers of an earlier run are useless
+        for entry in os.listdir(spool_dir):
+            if entry.endswith(".part"):
+                try:
+                    os.remove(os.path.join(spool_dir, entry))
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return len(self.transfers)
+
+    def offer(self, sender, recipient, name, size):
+        """Registers the transfer and creates its spool file; raises TransferRefused when a limit is reached."""
+        with self.lock:
+            transfers = self.transfers.values()
+            if sum(transfer.sender == sender for transfer in transfers) >= self.max_per_sender:
+                raise TransferRefused(f"You already have {self.max_per_sender} files on offer.")
+            if sum(transfer.size for transfer in transfers) + size > self.spool_limit:
+                raise TransferRefused("The server has no room for more files right now, try again later.")
+            transfer_id = str(next(self.ids))
+            path = os.path.join(self.spool_dir, f"{transfer_id}.part")
+            transfer = self.transfers[transfer_id] = Transfer(transfer_id, sender, recipient, name, size, path)
+        open(path, "wb").close()
+        return transfer
+
+    def get(self, transfer_id):
+        with self.lock:
+            return self.transfers.get(transfer_id)
+
+    def accept(self, transfer, name):
+        """Returns name's download token and whether name is the first to accept."""
+        with self.lock:
+            first = not transfer.accepted
+            token = transfer.accepted.get(name)
+            if token is None:
+                token = transfer.accepted[name] = secrets.token_urlsafe(18)
+            transfer.updated = time.monotonic()
+            return token, first
+
+    def authorize(self, transfer_id, kind, token):
+        """The transfer that token lets the caller upload to or download from, or None."""
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None:
+                return None
+            if kind == UPLOAD:
+                allowed = secrets.compare_digest(token, transfer.upload_token)
+            else:
+                allowed = any(secrets.compare_digest(token, value) for value in transfer.accepted.values())
+            if not allowed:
+                return None
+            transfer.updated = time.monotonic()
+            return transfer
+
+    def cancel(self, transfer_id):
+        with self.lock:
+            transfer = self.transfers.pop(transfer_id, None)
+        if transfer is not None:
+            self._discard(transfer)
+        return transfer
+
+    def expire(self):
+        """Drops transfers idle for ttl and returns them."""
+        deadline = time.monotonic() - self.ttl
+        with self.lock:
+            expired = [t for t in self.transfers.values() if t.updated < deadline and t.uploader is None]
+            for transfer in expired:
+                del self.transfers[transfer.id]
+        for transfer in expired:
+            self._discard(transfer)
+        return expired
+
+    def clear(self):
+        with self.lock:
+            transfers, self.transfers = list(self.transfers.values()), {}
+        for transfer in transfers:
+            self._discard(transfer)
+
+    def _discard(self, transfer):
+        uploader = transfer.uploader
+        if uploader is not None:
+            try:
+                uploader.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        try:
+            os.remove(transfer.path)
+        except OSError:
+            pass
+
+
+class Pacer:
+    """Token bucket that keeps one transfer under rate bytes per second by sleeping between chunks."""
+
+    def __init__(self, rate, clock=time.monotonic):
+        self.rate = rate
+        self.clock = clock
+        # a quarter second of burst, and never less than one chunk
+        self.burst = max(rate / 4, CHUNK_SIZE)
+        self.allowance = self.burst
+        self.last = clock()
+
+    def throttle(self, nbytes):
+        if not self.rate:
+            return
+        now = self.clock()
+        self.allowance = min(self.burst, self.allowance + (now - self.last) * self.rate) - nbytes
+        self.last = now
+        if self.allowance < 0:
+            time.sleep(-self.allowance / self.rate)
+
+
+class StreamError(Exception):
+    pass
+
+
+def recv_exact(sock, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if not n:
+            raise StreamError("connection closed")
+        received += n
+    return buffer
+
+
+def read_header(sock, max_payload=MAX_PAYLOAD):
+    """Reads one frame header and returns (op, payload length)."""
+    magic, version, op, flags, length = HEADER.unpack(recv_exact(sock, HEADER.size))
+    if magic != MAGIC or version != VERSION or flags:
+        raise StreamError("bad frame header")
+    if length > max_payload:
+        raise StreamError(f"frame of {length} bytes exceeds {max_payload}")
+    return op, length
+
+
+class TransferServer:
+    """
+    Serves file data on its own port, one thread per data connection, so
+    no byte of a file goes through the chat engine or its outbound queues
+    and a large transfer never holds up chat fan-out. Uploads are written
+    to the spool as they arrive and acknowledged every ACK_INTERVAL bytes;
+    downloads leave with socket.sendfile(), which is a zero-copy
+    os.sendfile() where the platform has it. Every transfer is paced to
+    rate bytes per second in both directions.
+
+    on_uploaded(transfer) runs on the data connection's thread once a
+    transfer's file is complete.
+    """
+
+    def __init__(self, table, host="0.0.0.0", port=0, rate=FILE_RATE, on_uploaded=None, stats=None):
+        self.table = table
+        self.rate = rate
+        self.on_uploaded = on_uploaded
+        self.stats = stats
+        self.slots = threading.BoundedSemaphore(MAX_STREAMS)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if os.name != "nt":
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(MAX_STREAMS)
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.accept_loop, daemon=True).start()
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    def accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except OSError:
+                break
+            if not self.slots.acquire(blocking=False):
+                self.fail(sock, "Too many transfers in progress, try again later.")
+                sock.close()
+                continue
+            threading.Thread(target=self.serve, args=(sock,), daemon=True).start()
+
+    def serve(self, sock):
+        try:
+            sock.settimeout(STREAM_TIMEOUT)
+            op, length = read_header(sock, MAX_OPEN_PAYLOAD)
+            fields = recv_exact(sock, length).decode("utf-8", "replace").split(FIELD_SEP) if length else []
+            if op != StreamOp.OPEN or len(fields) < 3:
+                raise StreamError("expected OPEN")
+            kind, transfer_id, token = fields[:3]
+            transfer = self.table.authorize(transfer_id, kind, token)
+            if transfer is None:
+                raise StreamError("Unknown transfer or wrong token.")
+            if kind == UPLOAD:
+                self.upload(sock, transfer)
+            else:
+                offset = int(fields[3]) if len(fields) > 3 and fields[3].isdigit() else 0
+                self.download(sock, transfer, offset)
+        except StreamError as e:
+            self.fail(sock, str(e))
+        except OSError:
+            pass
+        except Exception as e:
+            print(f"Error in transfer: {e}")
+        finally:
+            sock.close()
+            self.slots.release()
+
+    def upload(self, sock, transfer):
+        if transfer.complete:
+            sock.sendall(encode_frame(StreamOp.OPEN, (str(transfer.size),)))
+            sock.sendall(encode_frame(StreamOp.DONE))
+            return
+        # a reconnecting uploader takes over from its half-open predecessor
+        previous = transfer.uploader
+        if previous is not None:
+            try:
+                previous.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        with transfer.lock:
+            transfer.uploader = sock
+            try:
+                self._receive(sock, transfer)
+            finally:
+                if transfer.uploader is sock:
+                    transfer.uploader = None
+        if transfer.complete and self.on_uploaded is not None:
+            self.on_uploaded(transfer)
+
+    def _receive(self, sock, transfer):
+        stored = transfer.stored
+        sock.sendall(encode_frame(StreamOp.OPEN, (str(stored),)))
+        pacer = Pacer(self.rate)
+        buffer = memoryview(bytearray(CHUNK_SIZE))
+        acked = stored
+        with open(transfer.path, "r+b") as f:
+            f.seek(stored)
+            f.truncate()
+            while True:
+                op, length = read_header(sock)
+                if op == StreamOp.DONE:
+                    break
+                if op != StreamOp.CHUNK:
+                    raise StreamError("expected CHUNK or DONE")
+                if stored + length > transfer.size:
+                    raise StreamError("More data than the offered size.")
+                if self.stats is not None:
+                    self.stats.count_file_bytes(received=length)
+                while length:
+                    n = sock.recv_into(buffer[:min(length, CHUNK_SIZE)])
+                    if not n:
+                        raise StreamError("connection closed")
+                    f.write(buffer[:n])
+                    length -= n
+                    stored += n
+                    transfer.stored = stored
+                    pacer.throttle(n)
+                if stored - acked >= ACK_INTERVAL:
+                    f.flush()
+                    sock.sendall(encode_frame(StreamOp.ACK, (str(stored),)))
+                    acked = stored
+                transfer.updated = time.monotonic()
+        if stored != transfer.size:
+            raise StreamError(f"Upload ended at {stored} of {transfer.size} bytes.")
+        transfer.complete = True
+        if self.stats is not None:
+            self.stats.count_file_bytes(uploaded=1)
+        sock.sendall(encode_frame(StreamOp.DONE))
+
+    def download(self, sock, transfer, offset):
+        if not transfer.complete:
+            raise StreamError("The upload has not finished yet.")
+        if offset > transfer.size:
+            raise StreamError("Offset past the end of the file.")
+        sock.sendall(encode_frame(StreamOp.OPEN, (str(offset),)))
+        pacer = Pacer(self.rate)
+        with open(transfer.path, "rb") as f:
+            while offset < transfer.size:
+                count = min(CHUNK_SIZE, transfer.size - offset)
+                sock.sendall(HEADER.pack(MAGIC, VERSION, StreamOp.CHUNK, 0, count))
+                sock.sendfile(f, offset, count)
+                offset += count
+                transfer.updated = time.monotonic()
+                if self.stats is not None:
+                    self.stats.count_file_bytes(sent=count)
+                pacer.throttle(count)
+        sock.sendall(encode_frame(StreamOp.DONE))
+
+    @staticmethod
+    def fail(sock, reason):
+        try:
+            sock.sendall(encode_frame(StreamOp.FAIL, (reason,)))
+        except OSError:
+            pass
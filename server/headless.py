@@ -0,0 +1,115 @@
+"""
+Runs the chat server without the Qt control panel, for nodes with no display.
+
+    python3 server/headless.py --engine asyncio --port 5000 --metrics-port 9100
+    python3 server/headless.py --file-dir transfers
+    python3 server/headless.py --workers 4
+    python3 server/headless.py --config server.json
+    python3 server/headless.py --timings-file timings.jsonl
+    python3 server/headless.py --capture evening.cap
+
+Options may come from a JSON config file whose keys are the long option
+names (e.g. {"engine": "asyncio", "metrics_port": 9100}); flags given on
+the command line win over the file.
+"""
+import argparse
+import json
+import signal
+import sys
+import threading
+from datetime import datetime
+
+from core import create_server
+from core.instrument import TimingFileDumper
+from core.metrics import MetricsServer
+from core.options import SERVER_DEFAULTS, add_server_arguments, given, server_options
+
+DEFAULTS = dict(
+    SERVER_DEFAULTS,
+    timings_file="",
+    metrics_host="127.0.0.1",
+    metrics_port=9100,
+    quiet=False,
+)
+
+
+def parse_args(argv=None):
+    """Returns the headless options and the create_server() arguments they make."""
+    parser = argparse.ArgumentParser(description="Headless chat server")
+    parser.add_argument("--config", help="JSON file with default values for the options below")
+    add_server_arguments(parser)
+    parser.add_argument("--timings-file", help="append the stage histograms to this file as JSON lines; implies --instrument")
+    parser.add_argument("--metrics-host")
+    parser.add_argument("--metrics-port", type=int, help="0 disables the metrics endpoint")
+    parser.add_argument("--quiet", action="store_true", default=None, help="do not log chat events")
+    args = parser.parse_args(argv)
+
+    options = dict(DEFAULTS)
+    if args.config:
+        with open(args.config, "r") as f:
+            file_options = json.load(f)
+        unknown = set(file_options) - set(DEFAULTS)
+        if unknown:
+            parser.error(f"unknown keys in {args.config}: {', '.join(sorted(unknown))}")
+        options.update(file_options)
+    command_line = given(args)
+    command_line.pop("config", None)
+    options.update(command_line)
+    options["instrument"] = options["instrument"] or bool(options["timings_file"])
+    return options, server_options(parser, options)
+
+
+def log(message):
+    print(f"{datetime.now():%Y-%m-%d %H:%M:%S} {message}", flush=True)
+
+
+def main(argv=None):
+    options, server_kwargs = parse_args(argv)
+    server = create_server(**server_kwargs)
+    if options["timings_file"]:
+        server.add_timing_hook(TimingFileDumper(options["timings_file"]))
+    quiet = options["quiet"]
+    server.set_callbacks(
+        on_message=None if quiet else log,
+        on_typing=None,
+        on_client_disconnect=None,
+    )
+
+    metrics = None
+    if options["metrics_port"]:
+        metrics = MetricsServer(server, options["metrics_host"], options["metrics_port"])
+        metrics.start()
+        log(f"Metrics on http://{options['metrics_host']}:{metrics.address[1]}/metrics")
+
+    stop = threading.Event()
+
+    def request_stop(signum, frame):
+        stop.set()
+
+    for signame in ("SIGINT", "SIGTERM", "SIGHUP"):
+        if hasattr(signal, signame):
+            signal.signal(getattr(signal, signame), request_stop)
+
+    def on_new_connection(client, addr):
+        if not quiet:
+            log(f"🔌 New connection from {addr}")
+
+    server.start_listening(on_new_connection)
+    log(f"Listening on {options['host']}:{options['port']} ({options['engine']} engine, {options['workers']} worker(s))")
+    if options["capture"]:
+        log(f"Capturing inbound traffic to {options['capture']}" + (".<worker>" if options["workers"] > 1 else ""))
+
+    # wake up regularly so signals are handled promptly on every platform
+    while not stop.wait(0.5):
+        pass
+
+    log("Shutting down")
+    server.shutdown()
+    server.wait_closed(timeout=5)
+    if metrics is not None:
+        metrics.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
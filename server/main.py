@@ -1,9 +1,16 @@
 import sys
+import argparse
 from PySide6.QtWidgets import QApplication
 from ui.widgets import ChatServerControlPanel
+from core.options import add_server_arguments, given, server_options
 
 if __name__ == "__main__":
-    app = QApplication(sys.argv)
-    server_ui = ChatServerControlPanel()
+    parser = argparse.ArgumentParser()
+    add_server_arguments(parser)
+    args, qt_args = parser.parse_known_args()
+    options = server_options(parser, given(args))
+
+    app = QApplication(sys.argv[:1] + qt_args)
+    server_ui = ChatServerControlPanel(**options)
     server_ui.show()
     sys.exit(app.exec())
\ No newline at end of file
@@ -0,0 +1,77 @@
+from collections import deque
+
+from PySide6.QtCore import Qt, QAbstractListModel, QModelIndex
+
+from core.base import ROSTER_LEAVE
+
+ClientRole = Qt.UserRole
+
+
+class ClientListModel(QAbstractListModel):
+    """
+    The control panel's copy of the connected clients. The server reports
+    joins, leaves and renames through push(), from any thread and without
+    the panel touching clients_lock; apply_pending(), run on the GUI thread
+    by a timer, folds everything queued since the last call into one
+    remove pass, one insert and per-row renames.
+    """
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.clients = []
+        self.names = {}
+        self.rows = {}
+        self.pending = deque()
+
+    def push(self, event, client, name):
+        self.pending.append((event, client, name))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.clients)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        client = self.clients[index.row()]
+        if role == Qt.DisplayRole:
+            return self.names[client]
+        if role == ClientRole:
+            return client
+        return None
+
+    def client_at(self, row):
+        return self.clients[row] if 0 <= row < len(self.clients) else None
+
+    def apply_pending(self):
+        # fold the queue into the final state of each client it mentions
+        final = {}
+        for _ in range(len(self.pending)):
+            event, client, name = self.pending.popleft()
+            final[client] = None if event == ROSTER_LEAVE else name
+        if not final:
+            return
+
+        removed = sorted((self.rows[c] for c, name in final.items() if name is None and c in self.rows), reverse=True)
+        for row in removed:
+            self.beginRemoveRows(QModelIndex(), row, row)
+            del self.names[self.clients.pop(row)]
+            self.endRemoveRows()
+        if removed:
+            self.rows = {client: row for row, client in enumerate(self.clients)}
+
+        for client, name in final.items():
+            row = self.rows.get(client)
+            if name is not None and row is not None and self.names[client] != name:
+                self.names[client] = name
+                index = self.index(row)
+                self.dataChanged.emit(index, index, [Qt.DisplayRole])
+
+        added = [(c, name) for c, name in final.items() if name is not None and c not in self.rows]
+        if added:
+            first = len(self.clients)
+            self.beginInsertRows(QModelIndex(), first, first + len(added) - 1)
+            for row, (client, name) in enumerate(added, first):
+                self.clients.append(client)
+                self.names[client] = name
+                self.rows[client] = row
+            self.endInsertRows()
@@ -1,26 +1,57 @@
 from PySide6.QtWidgets import (
     QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QLineEdit,
-    QPushButton, QLabel, QListWidget, QMessageBox
+    QPushButton, QLabel, QListView, QMessageBox, QCheckBox
 )
 from PySide6.QtCore import Signal, QObject, QTimer
 from utils.styles import load_custom_css
-from core.network import ChatServer
+from core import create_server
+from common.protocol import MsgType
+from core.instrument import TimingHook, STAGES, by_stage
+from .models import ClientListModel
 import socket
+import time
+
+# the server expires typing state on its own, so re-announce well within its TTL
+TYPING_RESEND = 2.0
+# how often queued client list changes are applied to the view
+ROSTER_INTERVAL_MS = 100
 
 class Communicator(QObject):
     message_received = Signal(str)
+    typing_changed = Signal(str)
+    timings_changed = Signal(object)
+
+class PanelTimingHook(TimingHook):
+    """Hands the stage histograms to the Qt thread; the server calls it from its timer context."""
+
+    def __init__(self, signal):
+        self.signal = signal
+
+    def on_timings(self, histograms):
+        self.signal.emit(by_stage(histograms))
 
 class ChatServerControlPanel(QWidget):
-    def __init__(self):
+    def __init__(self, engine="thread", **server_options):
         super().__init__()
         self.setWindowTitle("Chat Server Control Panel")
         self.setGeometry(100, 100, 700, 400)
 
         self.username = "Servidor"
+        self.last_typing_sent = 0.0
         self.comm = Communicator()
         self.comm.message_received.connect(self.display_message)
 
-        self.network = ChatServer()
+        self.clients_model = ClientListModel(self)
+        self.network = create_server(engine, **server_options)
+        # register before listening so no join is missed
+        self.network.set_callbacks(
+            on_message=self.comm.message_received.emit,
+            on_typing=self.comm.typing_changed.emit,
+            on_client_disconnect=None,
+            on_roster_change=self.clients_model.push,
+        )
+        self.comm.timings_changed.connect(self.show_timings)
+        self.network.add_timing_hook(PanelTimingHook(self.comm.timings_changed))
         self.network.start_listening(self.new_connection)
 
         main_layout = QHBoxLayout()
@@ -34,6 +65,7 @@ class ChatServerControlPanel(QWidget):
         self.username_btn.clicked.connect(self.change_username)
 
         self.typing_label = QLabel("")
+        self.comm.typing_changed.connect(self.typing_label.setText)
         self.message_input = QLineEdit(placeholderText="Type a message...")
         self.message_input.textEdited.connect(self.notify_typing)
         self.message_input.returnPressed.connect(self.send_message)
@@ -50,7 +82,9 @@ class ChatServerControlPanel(QWidget):
         left_layout.addWidget(self.send_btn)
 
         right_layout = QVBoxLayout()
-        self.clients_list = QListWidget()
+        self.clients_list = QListView()
+        self.clients_list.setModel(self.clients_model)
+        self.clients_list.setUniformItemSizes(True)
         self.kick_btn = QPushButton("Kick selected client")
         self.kick_btn.clicked.connect(self.kick_client)
 
@@ -59,6 +93,11 @@ class ChatServerControlPanel(QWidget):
 
         self.info_label = QLabel("Active clients: 0\nCPU usage: -")
         self.info_label.setStyleSheet("font-size: 12px;")
+        self.instrument_box = QCheckBox("Record stage latencies")
+        self.instrument_box.setChecked(self.network.probe is not None)
+        self.instrument_box.toggled.connect(self.toggle_instrumentation)
+        self.timings_label = QLabel("")
+        self.timings_label.setStyleSheet("font-size: 12px;")
         self.ip_label = QLabel("Server IP:")
         self.ip_btn = QPushButton("Show local IP")
         self.ip_btn.clicked.connect(self.get_local_ip)
@@ -71,29 +110,63 @@ class ChatServerControlPanel(QWidget):
         right_layout.addStretch()
         right_layout.addWidget(QLabel("Server status:"))
         right_layout.addWidget(self.info_label)
+        right_layout.addWidget(self.instrument_box)
+        right_layout.addWidget(self.timings_label)
         right_layout.addWidget(self.shutdown_btn)
 
         main_layout.addLayout(left_layout, 3)
         main_layout.addLayout(right_layout, 1)
 
         self.setStyleSheet(load_custom_css())
-        
-        self.network.set_callbacks(
-            on_message=self.comm.message_received.emit,
-            on_typing=self.typing_label.setText,
-            on_client_disconnect=self.refresh_client_list
-        )
 
+        self.roster_timer = QTimer()
+        self.roster_timer.timeout.connect(self.clients_model.apply_pending)
+        self.roster_timer.start(ROSTER_INTERVAL_MS)
+
+        self.last_cpu_sample = (time.monotonic(), time.process_time())
         self.timer = QTimer()
         self.timer.timeout.connect(self.update_stats)
         self.timer.start(2000)
 
     def update_stats(self):
-        import psutil
-        cpu = psutil.cpu_percent()
-        with self.network.clients_lock:
-            active = len(self.network.client_names)
-        self.info_label.setText(f"Active clients: {active}\nCPU usage: {cpu:.1f}%")
+        # CPU share of this process since the last tick
+        now = time.monotonic()
+        cpu_time = time.process_time()
+        last_now, last_cpu = self.last_cpu_sample
+        self.last_cpu_sample = (now, cpu_time)
+        cpu = 100.0 * (cpu_time - last_cpu) / max(now - last_now, 1e-9)
+
+        stats = self.network.stats
+        active = self.clients_model.rowCount()
+        fanout = stats.per_broadcast()
+        self.info_label.setText(
+            f"Active clients: {active}\nCPU usage: {cpu:.1f}%\n"
+            f"Messages/sec: {stats.messages_per_sec:.1f}\n"
+            f"Syscalls/broadcast: {fanout['syscalls_per_broadcast']:.2f}\n"
+            f"Bytes copied/broadcast: {fanout['bytes_copied_per_broadcast']:.0f}\n"
+            f"Compression: {stats.compression_bytes_saved / 1024:.1f} KiB saved, "
+            f"{stats.compression_seconds * 1000:.0f} ms CPU\n"
+            f"Throttled messages: {stats.throttled_messages}, flood kicks: {stats.flood_disconnects}"
+        )
+        if self.network.relay is not None:
+            self.info_label.setText(
+                self.info_label.text() + f"\nRelay: {len(self.network.relay.peer_links())} peer(s), "
+                f"{stats.relay_events_sent} events out in {stats.relay_batches} batches"
+            )
+
+    def toggle_instrumentation(self, enabled):
+        self.network.set_instrumentation(enabled)
+        self.timings_label.setText("Collecting..." if enabled else "")
+
+    def show_timings(self, stages):
+        if self.network.probe is None:
+            return
+        lines = ["Stage p50 / p99 (µs):"]
+        for stage in STAGES:
+            histogram = stages.get(stage)
+            if histogram is not None:
+                lines.append(f"{stage}: {histogram.percentile(0.5) / 1000:.1f} / {histogram.percentile(0.99) / 1000:.1f}")
+        self.timings_label.setText("\n".join(lines))
 
     def get_local_ip(self):
         try:
@@ -107,70 +180,41 @@ class ChatServerControlPanel(QWidget):
 
     def new_connection(self, conn, addr):
         self.comm.message_received.emit(f"🔌 New connection from {addr}")
-        self.refresh_client_list()
-
-    def refresh_client_list(self):
-        self.clients_list.clear()
-        with self.network.clients_lock:
-            for name in self.network.client_names:
-                self.clients_list.addItem(name)
 
     def display_message(self, msg):
         self.chat_display.append(msg)
 
     def notify_typing(self):
-        self.typing_label.setText(f"{self.username} is typing...")
-        with self.network.clients_lock:
-            for conn in self.network.client_names.values():
-                try:
-                    conn.send(f"#writing#{self.username}".encode())
-                except:
-                    pass
+        now = time.monotonic()
+        if now - self.last_typing_sent < TYPING_RESEND:
+            return
+        self.last_typing_sent = now
+        self.network.server_typing(self.username)
 
     def change_username(self):
         self.username = self.username_input.text()
-        with self.network.clients_lock:
-            for conn in self.network.client_names.values():
-                try:
-                    conn.send(f"#usern#{self.username}".encode())
-                except:
-                    pass
+        self.network.announce(MsgType.SERVER_NAME, self.username)
 
     def send_message(self):
         msg = self.message_input.text().strip()
         self.typing_label.setText("")
         if msg:
-            with self.network.clients_lock:
-                for conn in self.network.client_names.values():
-                    try:
-                        conn.send("#nowriting#".encode())
-                    except:
-                        pass
-
-                clean_msg = (
-                    msg.replace("#usern#", "")
-                    .replace("#writing#", "")
-                    .replace("#nowriting#", "")
-                )
-                for conn in self.network.client_names.values():
-                    conn.send(f"{clean_msg}\n".encode())
-            self.chat_display.append(f"{self.username}: {clean_msg}")
+            self.last_typing_sent = 0.0
+            self.network.server_stopped_typing()
+            self.network.send_to_all(msg)
+            self.chat_display.append(f"{self.username}: {msg}")
             self.message_input.clear()
             if msg.upper() == "STOP":
                 self.shutdown_server()
 
     def kick_client(self):
-        selected = self.clients_list.currentItem()
-        if not selected:
+        row = self.clients_list.currentIndex().row()
+        client = self.clients_model.client_at(row)
+        if client is None:
             return
-        target = selected.text()
-        with self.network.clients_lock:
-            for name, conn in list(self.network.client_names.items()):
-                if name == target:
-                    self.network.kick_client(name)
-                    self.comm.message_received.emit(f"⚠️ Client {target} was kicked.")
-                    break
-        self.refresh_client_list()
+        target = self.clients_model.names[client]
+        self.network.kick_client(client)
+        self.comm.message_received.emit(f"⚠️ Client {target} was kicked.")
 
     def shutdown_server(self):
         confirm = QMessageBox.question(
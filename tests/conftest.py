@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the server is an application, not an installed package; its modules import as core.*
+sys.path.insert(0, os.path.join(ROOT, "server"))
+# the wire protocol both apps share imports as common.*
+sys.path.insert(0, ROOT)
@@ -0,0 +1,36 @@
+import socket
+import threading
+import time
+
+from core.cluster import BusLink, BusOp
+from common.protocol import FrameDecoder
+
+
+def test_bus_send_does_not_wait_for_the_reader():
+    hub_end, worker_end = socket.socketpair()
+    link = BusLink(hub_end)
+    payload = "x" * 60000
+    started = time.monotonic()
+    # far more than the socket buffers hold, with nobody reading yet
+    for seq in range(1, 201):
+        link.send(BusOp.BROADCAST, "1", "", payload, seq=seq)
+    assert time.monotonic() - started < 1.0
+
+    seqs = []
+
+    def read():
+        decoder = FrameDecoder()
+        worker_end.settimeout(5)
+        while True:
+            data = worker_end.recv(65536)
+            if not data:
+                return
+            seqs.extend(frame.seq for frame in decoder.feed(data))
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    # close() sends everything queued before shutting the socket down
+    link.close()
+    reader.join(5)
+    worker_end.close()
+    assert seqs == list(range(1, 201))
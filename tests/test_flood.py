@@ -0,0 +1,32 @@
+from core.base import BaseChatServer, DEFAULT_ROOM
+from core.ratelimit import RateLimits, FloodGuard, ALLOW, DROP
+from common.protocol import MsgType, FLAG_DEFLATE, MAX_PAYLOAD, deflate, encode_frame, encode_payload
+
+from test_resume import FakeClient
+
+
+def test_dropped_frames_are_never_inflated():
+    limits = RateLimits(message_rate=1.0, message_burst=3.0, type_limits={}, kick_after=0)
+    server = BaseChatServer(idle_timeout=0, rate_limits=limits)
+    client = FakeClient()
+    server.register_client(client, ("127.0.0.1", 1))
+    server.handle_data(client, encode_frame(MsgType.HELLO))
+    chat = deflate(encode_payload(("x" * 1000, DEFAULT_ROOM)))
+    # inflating this one would raise: it expands past MAX_PAYLOAD
+    bomb = deflate(b"\0" * (MAX_PAYLOAD + 1))
+    frames = [encode_frame(MsgType.CHAT, payload=chat, flags=FLAG_DEFLATE)] * 2
+    frames.append(encode_frame(MsgType.CHAT, payload=bomb, flags=FLAG_DEFLATE))
+    assert server.handle_data(client, b"".join(frames))
+    assert server.stats.throttled_messages == 1
+    assert len(client.received(MsgType.CHAT)) == 2
+
+
+def test_rejected_message_spends_no_tokens():
+    limits = RateLimits(message_rate=0, byte_rate=10, byte_burst=100, type_limits={MsgType.CHAT: (1.0, 2.0)}, kick_after=0)
+    guard = FloodGuard(limits, 0.0)
+    # too big for the byte bucket: dropped, and the chat bucket keeps both its tokens
+    assert guard.admit(MsgType.CHAT, 500, 0.0) == DROP
+    assert guard.admit(MsgType.CHAT, 10, 0.0) == ALLOW
+    assert guard.admit(MsgType.CHAT, 10, 0.0) == ALLOW
+    assert guard.admit(MsgType.CHAT, 10, 0.0) == DROP
+    assert guard.bytes.tokens == 80
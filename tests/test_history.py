@@ -0,0 +1,187 @@
+import os
+
+from core.history import HistoryLog, RoomHistory, MAX_READ
+from common.protocol import MsgType
+
+
+def test_eviction_skips_pinned_logs(tmp_path):
+    history = RoomHistory(str(tmp_path), max_open=2)
+    try:
+        pinned = history.pin("a")
+        history.append("b", 1, MsgType.CHAT, b"x")
+        history.append("c", 2, MsgType.CHAT, b"y")
+        history.sync()
+        # opening c evicted b, the least recently used log that was not in use
+        assert list(history.logs) == ["a", "c"]
+        pinned.append(3, MsgType.CHAT, b"z")
+        history.unpin("a")
+        history.append("b", 4, MsgType.CHAT, b"w")
+        assert [record.seq for record in history.read_since("b", 0)] == [1, 4]
+        assert list(history.logs) == ["c", "b"]
+        assert [record.seq for record in history.read_since("a", 0)] == [3]
+    finally:
+        history.close()
+
+
+def test_append_never_opens_or_closes_a_log(tmp_path):
+    history = RoomHistory(str(tmp_path), max_open=2)
+    try:
+        history.append("a", 1, MsgType.CHAT, b"x")
+        # a's log is not open yet, so the record waits without touching the disk
+        assert not os.path.exists(tmp_path / "a")
+        assert list(history.backlog) == ["a"]
+        history.sync()
+        assert list(history.logs) == ["a"] and not history.backlog
+        history.read_since("b", 0)
+        history.read_since("c", 0)
+        # the evicted log stays open until the next sync closes it
+        evicted = history.closing["a"]
+        assert evicted.active.log is not None
+        history.sync()
+        assert not history.closing and evicted.active.log is None
+        history.append("a", 2, MsgType.CHAT, b"y")
+        assert [record.seq for record in history.read_since("a", 0)] == [1, 2]
+    finally:
+        history.close()
+    reopened = RoomHistory(str(tmp_path))
+    try:
+        assert reopened.last_seq == 2
+    finally:
+        reopened.close()
+
+
+def test_sync_leaves_the_log_appendable(tmp_path):
+    history = RoomHistory(str(tmp_path))
+    try:
+        history.append("a", 1, MsgType.CHAT, b"x")
+        history.sync()
+        history.append("a", 2, MsgType.CHAT, b"y")
+        history.sync()
+        assert [record.payload for record in history.read_since("a", 0)] == [b"x", b"y"]
+    finally:
+        history.close()
+
+
+def fill(log, first, last, payload=b"x" * 50):
+    for seq in range(first, last + 1):
+        log.append(seq, MsgType.CHAT, payload)
+
+
+def seqs(records):
+    return [record.seq for record in records]
+
+
+def segment_logs(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(".log"))
+
+
+def test_segments_roll_over_and_reopen(tmp_path):
+    log = HistoryLog(str(tmp_path), segment_bytes=300, index_interval=100)
+    fill(log, 1, 20)
+    log.close()
+    # 75-byte records, so a segment takes 4 before it is full
+    assert segment_logs(tmp_path) == [f"{base:020d}.log" for base in (1, 5, 9, 13, 17)]
+
+    log = HistoryLog(str(tmp_path), segment_bytes=300, index_interval=100)
+    try:
+        assert log.last_seq == 20
+        assert seqs(log.read_since(0)) == list(range(1, 21))
+        assert seqs(log.read_since(6)) == list(range(7, 21))
+        fill(log, 21, 21)
+        assert seqs(log.read_since(19)) == [20, 21]
+    finally:
+        log.close()
+
+
+def test_torn_tail_is_truncated_and_stale_index_dropped(tmp_path):
+    log = HistoryLog(str(tmp_path), index_interval=1)
+    fill(log, 1, 10)
+    # map the segment before the crash, as a reader would have
+    assert seqs(log.read_since(0)) == list(range(1, 11))
+    log.close()
+    path = tmp_path / segment_logs(tmp_path)[0]
+    size = os.path.getsize(path)
+    # tear the last record in half; the index still has an entry for it
+    with open(path, "r+b") as f:
+        f.truncate(size - 30)
+
+    log = HistoryLog(str(tmp_path), index_interval=1)
+    try:
+        assert log.last_seq == 9
+        assert seqs(log.read_since(0)) == list(range(1, 10))
+        assert list(log.active.index_seqs) == list(range(1, 10))
+        fill(log, 10, 12)
+        assert seqs(log.read_since(8)) == [9, 10, 11, 12]
+    finally:
+        log.close()
+
+
+def test_corrupt_record_ends_the_log(tmp_path):
+    log = HistoryLog(str(tmp_path), index_interval=1 << 20)
+    fill(log, 1, 5)
+    log.close()
+    path = tmp_path / segment_logs(tmp_path)[0]
+    with open(path, "r+b") as f:
+        # flip a payload byte of the fourth record so its crc no longer matches
+        f.seek(3 * 75 + 40)
+        f.write(b"y")
+
+    log = HistoryLog(str(tmp_path), index_interval=1 << 20)
+    try:
+        assert seqs(log.read_since(0)) == [1, 2, 3]
+        assert os.path.getsize(path) == 3 * 75
+    finally:
+        log.close()
+
+
+def test_retention_drops_whole_sealed_segments(tmp_path):
+    log = HistoryLog(str(tmp_path), segment_bytes=300, retention_bytes=700)
+    try:
+        fill(log, 1, 20)
+        log.enforce_retention()
+        # 1500 bytes in five 300-byte segments; the three oldest go to get under 700
+        assert segment_logs(tmp_path) == [f"{base:020d}.log" for base in (13, 17)]
+        assert seqs(log.read_since(0)) == list(range(13, 21))
+    finally:
+        log.close()
+
+
+def test_retention_by_age_keeps_the_active_segment(tmp_path):
+    log = HistoryLog(str(tmp_path), segment_bytes=300, retention_seconds=60)
+    try:
+        fill(log, 1, 10)
+        for segment in log.segments:
+            os.utime(segment.log_path, (0, 0))
+        log.enforce_retention()
+        assert seqs(log.read_since(0)) == [9, 10]
+    finally:
+        log.close()
+
+
+def test_read_limits(tmp_path):
+    log = HistoryLog(str(tmp_path), segment_bytes=300, index_interval=100)
+    try:
+        fill(log, 1, 20)
+        assert seqs(log.read_since(2, limit=5)) == [3, 4, 5, 6, 7]
+        assert seqs(log.read_since(0, limit=MAX_READ)) == list(range(1, 21))
+        assert log.read_since(20) == []
+        assert seqs(log.read_last(3)) == [18, 19, 20]
+        assert seqs(log.read_last(10, limit=4)) == [17, 18, 19, 20]
+        assert len(log.read_last(100)) == 20
+    finally:
+        log.close()
+
+
+def test_rooms_have_gaps_in_seq(tmp_path):
+    history = RoomHistory(str(tmp_path))
+    try:
+        for seq in range(1, 7):
+            history.append("a" if seq % 2 else "b", seq, MsgType.CHAT, b"x")
+        assert seqs(history.read_since("a", 0)) == [1, 3, 5]
+        assert history.read_seq("a", 3).seq == 3
+        assert history.read_seq("a", 4) is None
+    finally:
+        history.close()
+    reopened = RoomHistory(str(tmp_path))
+    assert reopened.last_seq == 6
+    reopened.close()
@@ -0,0 +1,47 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from core.network import ChatServer
+from common.protocol import MsgType, FrameDecoder, encode_frame
+
+
+def read_until_closed(sock):
+    decoder = FrameDecoder()
+    frames = []
+    sock.settimeout(5)
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return frames
+        frames += decoder.feed(data)
+
+
+@pytest.mark.parametrize("attempt", range(10))
+def test_kicked_thread_client_receives_bye(attempt):
+    server = ChatServer(host="127.0.0.1", port=0, idle_timeout=0, rate_limits=None)
+    connected = threading.Event()
+    clients = []
+
+    def on_new_connection(client, addr):
+        clients.append(client)
+        connected.set()
+
+    server.start_listening(on_new_connection)
+    try:
+        sock = socket.create_connection(server.server_socket.getsockname())
+        sock.sendall(encode_frame(MsgType.HELLO))
+        assert connected.wait(5)
+        # the HELLO must have been handled before the kick
+        deadline = time.monotonic() + 5
+        while clients[0].codec is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        server.kick_client(clients[0])
+        frames = read_until_closed(sock)
+        assert frames and frames[-1].type == MsgType.BYE
+        sock.close()
+    finally:
+        server.shutdown()
+        server.wait_closed(timeout=5)
@@ -0,0 +1,41 @@
+import argparse
+import json
+
+import pytest
+
+import headless
+from core.options import SERVER_DEFAULTS, add_server_arguments, given, server_options
+
+
+def panel_options(argv):
+    parser = argparse.ArgumentParser()
+    add_server_arguments(parser)
+    return server_options(parser, given(parser.parse_args(argv)))
+
+
+def test_panel_and_headless_share_defaults():
+    _, server = headless.parse_args([])
+    panel = panel_options([])
+    assert vars(server.pop("rate_limits")) == vars(panel.pop("rate_limits"))
+    assert server == panel
+    assert server["engine"] == SERVER_DEFAULTS["engine"]
+    # transfers open a second port; they are off unless asked for
+    assert server["file_dir"] is None
+
+
+def test_command_line_wins_over_config(tmp_path):
+    config = tmp_path / "server.json"
+    config.write_text(json.dumps({"engine": "asyncio", "port": 6000, "metrics_port": 0}))
+    options, server = headless.parse_args(["--config", str(config), "--port", "7000"])
+    assert (server["engine"], server["port"], options["metrics_port"]) == ("asyncio", 7000, 0)
+
+
+@pytest.mark.parametrize("argv", [["--relay-port", "5002"], ["--peer", "10.0.0.2:5002"], ["--peer", "b", "--relay-secret", ""]])
+def test_relay_without_secret_is_refused(argv):
+    with pytest.raises(SystemExit):
+        panel_options(argv)
+
+
+def test_relay_with_secret():
+    server = panel_options(["--peer", "b:6000", "--relay-secret", "s3cret"])
+    assert server["peers"] == [("b", 6000)]
@@ -0,0 +1,76 @@
+import pytest
+
+from common.protocol import (
+    MsgType, FrameDecoder, FrameCodec, DeflateCodec, DeflatedFrame, LegacyCodec, ProtocolError, HEADER, MAGIC, VERSION,
+    FLAG_DEFLATE, COMPRESS_THRESHOLD, encode_frame, deflate, detect_codec,
+)
+
+
+def decode(decoder, data):
+    return [(frame.type, frame.seq, bytes(frame.payload)) for frame in decoder.feed(data)]
+
+
+def test_frames_coalesced_in_one_read():
+    data = encode_frame(MsgType.CHAT, ("hi", "general")) + encode_frame(MsgType.PING, seq=7)
+    assert decode(FrameDecoder(), data) == [(MsgType.CHAT, None, b"hi\x1fgeneral"), (MsgType.PING, 7, b"")]
+
+
+def test_frame_split_at_every_byte():
+    data = encode_frame(MsgType.CHAT, ("hello",), seq=42) + encode_frame(MsgType.TYPING, ("general", "bob"))
+    decoder = FrameDecoder()
+    frames = []
+    for i in range(len(data)):
+        frames += decode(decoder, data[i:i + 1])
+    assert frames == [(MsgType.CHAT, 42, b"hello"), (MsgType.TYPING, None, b"general\x1fbob")]
+
+
+def test_partial_frame_waits_for_the_rest():
+    data = encode_frame(MsgType.CHAT, ("x" * 100,))
+    decoder = FrameDecoder()
+    assert decode(decoder, data[:HEADER.size + 10]) == []
+    assert decode(decoder, data[HEADER.size + 10:]) == [(MsgType.CHAT, None, b"x" * 100)]
+
+
+def test_oversized_frame_is_refused_from_its_header():
+    decoder = FrameDecoder(max_payload=16)
+    # the header alone is enough to refuse it; the payload never has to arrive
+    with pytest.raises(ProtocolError):
+        decoder.feed(HEADER.pack(MAGIC, VERSION, MsgType.CHAT, 0, 17))
+
+
+def test_bad_magic_is_refused():
+    with pytest.raises(ProtocolError):
+        FrameDecoder().feed(b"#usern#bob")
+
+
+def test_legacy_detection():
+    assert isinstance(detect_codec(b"#usern#bob"), LegacyCodec)
+    assert isinstance(detect_codec(b"hello"), LegacyCodec)
+    assert isinstance(detect_codec(encode_frame(MsgType.HELLO)), FrameCodec)
+
+
+def test_deflate_round_trip():
+    text = "Traceback (most recent call last):\n" + "  File \"app.py\", line 1, in <module>\n" * 20
+    codec = DeflateCodec()
+    data = codec.encode(MsgType.CHAT, ("bob", text, "general"), seq=9)
+    assert data[3] & FLAG_DEFLATE
+    assert len(data) < len(text)
+    frame, = FrameDecoder().feed(data)
+    assert (frame.type, frame.seq, frame.fields()) == (MsgType.CHAT, 9, ["bob", text, "general"])
+    # the server's codec leaves it packed until the frame has been admitted
+    packed, = DeflateCodec().decode(data)
+    assert isinstance(packed, DeflatedFrame)
+    assert len(packed.payload) == len(data) - HEADER.size - 4
+    assert packed.inflated() == frame
+
+
+def test_deflate_leaves_short_payloads_plain():
+    data = DeflateCodec().encode(MsgType.CHAT, ("bob", "hi", "general"))
+    assert not data[3] & FLAG_DEFLATE
+    assert len("bob hi general") < COMPRESS_THRESHOLD
+
+
+def test_deflate_bomb_is_refused():
+    payload = deflate(b"a" * 4096)
+    with pytest.raises(ProtocolError):
+        FrameDecoder(max_payload=1024).feed(encode_frame(MsgType.CHAT, payload=payload, flags=FLAG_DEFLATE))
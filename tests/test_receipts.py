@@ -0,0 +1,12 @@
+from core.base import BaseChatServer, DEFAULT_ROOM
+from common.protocol import MsgType
+
+
+def test_relayed_messages_get_no_receipts():
+    server = BaseChatServer(idle_timeout=0, rate_limits=None)
+    server.deliver_relayed("node-b", int(MsgType.CHAT), True, DEFAULT_ROOM, ("alice", "from afar", DEFAULT_ROOM))
+    assert server.last_seq == 1
+    assert DEFAULT_ROOM not in server.receipts.rooms
+
+    server.broadcast(MsgType.CHAT, ("alice", "from here", DEFAULT_ROOM), record=True, room=DEFAULT_ROOM)
+    assert list(server.receipts.rooms[DEFAULT_ROOM].messages) == [(2, "alice")]
@@ -0,0 +1,71 @@
+from core.base import BaseChatServer, DEFAULT_ROOM
+from common.protocol import MsgType, RESUMABLE, FrameDecoder, encode_frame
+from core.sessions import ReplayBuffer
+
+
+class FakeClient:
+    def __init__(self):
+        self.decoder = FrameDecoder()
+        self.frames = []
+
+    def send(self, data, msg_type=None):
+        self.frames += self.decoder.feed(data)
+        return True
+
+    def received(self, msg_type):
+        return [frame for frame in self.frames if frame.type == msg_type]
+
+
+def connect(server, port):
+    client = FakeClient()
+    server.register_client(client, ("127.0.0.1", port))
+    server.handle_data(client, encode_frame(MsgType.HELLO, (RESUMABLE,)))
+    return client
+
+
+def resume_after(tmp_path, missed):
+    server = BaseChatServer(history_dir=str(tmp_path / "history"), idle_timeout=0, rate_limits=None)
+    try:
+        client = connect(server, 1)
+        token = client.received(MsgType.SESSION)[0].fields()[0]
+        server._forget_client(client)
+        for i in range(missed):
+            server.broadcast(MsgType.CHAT, ("bob", f"m{i}", DEFAULT_ROOM), record=True, room=DEFAULT_ROOM)
+        again = connect(server, 2)
+        server.handle_data(again, encode_frame(MsgType.RESUME, (token, "0")))
+        return [frame.seq for frame in again.received(MsgType.CHAT)], again.received(MsgType.RESUME)[-1].fields()
+    finally:
+        server.history.close()
+
+
+def test_resume_from_replay_buffer(tmp_path):
+    seqs, status = resume_after(tmp_path, 300)
+    assert seqs == list(range(1, 301))
+    assert status == ["resumed", "300"]
+
+
+def test_resume_past_replay_buffer_sends_newest_and_says_partial(tmp_path):
+    seqs, status = resume_after(tmp_path, 800)
+    assert seqs == list(range(289, 801))
+    assert status == ["partial", "512"]
+
+
+def test_replay_buffer_floor_rises_as_entries_fall_out():
+    buffer = ReplayBuffer(limit=3)
+    for seq in range(1, 6):
+        buffer.append("a", seq, MsgType.CHAT, ("x",))
+    assert buffer.since("a", 2) == ([(3, MsgType.CHAT, ("x",)), (4, MsgType.CHAT, ("x",)), (5, MsgType.CHAT, ("x",))], True)
+    assert buffer.since("a", 1)[1] is False
+
+
+def test_evicted_room_is_incomplete():
+    buffer = ReplayBuffer(max_rooms=2)
+    buffer.append("a", 1, MsgType.CHAT, ("x",))
+    buffer.append("b", 2, MsgType.CHAT, ("x",))
+    buffer.append("c", 3, MsgType.CHAT, ("x",))
+    assert buffer.since("a", 0) == ([], False)
+    assert buffer.since("a", 1) == ([], True)
+    # rebuilt after the eviction, "a" still cannot vouch for what came before
+    buffer.append("a", 4, MsgType.CHAT, ("x",))
+    assert buffer.since("a", 0)[1] is False
+    assert buffer.since("a", 3) == ([(4, MsgType.CHAT, ("x",))], True)
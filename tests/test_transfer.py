@@ -0,0 +1,39 @@
+import os
+import socket
+
+import pytest
+
+from core.transfer import TransferTable, TransferServer, TransferRefused, MAX_OPEN_PAYLOAD
+from common.protocol import HEADER, MAGIC, VERSION, StreamOp, FrameDecoder
+
+
+def test_oversized_open_is_refused_unread(tmp_path):
+    server = TransferServer(TransferTable(str(tmp_path)), "127.0.0.1")
+    server.start()
+    try:
+        with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+            # only the header is sent: the server must not wait for the payload it announces
+            sock.sendall(HEADER.pack(MAGIC, VERSION, StreamOp.OPEN, 0, MAX_OPEN_PAYLOAD + 1))
+            frames = []
+            decoder = FrameDecoder()
+            while not frames:
+                data = sock.recv(65536)
+                assert data
+                frames += decoder.feed(data)
+            assert frames[0].type == StreamOp.FAIL
+    finally:
+        server.stop()
+
+
+def test_offers_past_the_spool_limits_are_refused(tmp_path):
+    table = TransferTable(str(tmp_path), spool_limit=100, max_per_sender=2)
+    table.offer("alice", "bob", "a.txt", 40)
+    with pytest.raises(TransferRefused):
+        table.offer("carol", "bob", "big.txt", 61)
+    table.offer("alice", "bob", "b.txt", 10)
+    with pytest.raises(TransferRefused):
+        table.offer("alice", "bob", "c.txt", 1)
+    # refusals leave nothing behind, and a withdrawn offer gives its room back
+    assert len(table) == 2 and len(os.listdir(tmp_path)) == 2
+    table.cancel("1")
+    table.offer("carol", "bob", "big.txt", 90)
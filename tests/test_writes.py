@@ -0,0 +1,103 @@
+from core.async_network import ClientProtocol
+from core.base import BaseChatServer
+from core.network import SocketClient, SocketWriter
+from core.outbound import OutboundQueue
+from common.protocol import MsgType, FrameCodec, LegacyCodec
+from core.stats import ServerStats
+
+
+class RecordingSocket:
+    def __init__(self):
+        self.writes = []
+
+    def send(self, data):
+        self.writes.append(bytes(data))
+        return len(data)
+
+    def sendmsg(self, buffers):
+        self.writes.append(b"".join(buffers))
+        return len(self.writes[-1])
+
+
+class RecordingTransport:
+    """Sends everything right away, like a transport whose socket always has room."""
+
+    def __init__(self):
+        self.writes = []
+        self.limits = None
+
+    def is_closing(self):
+        return False
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.limits = (high, low)
+
+    def writelines(self, buffers):
+        self.writes.append(b"".join(buffers))
+
+
+class QueueingClient:
+    def __init__(self):
+        self.outbound = OutboundQueue()
+
+    def send(self, data, msg_type=None):
+        return self.outbound.push(data, msg_type)
+
+
+class FakeServer:
+    def __init__(self):
+        self.stats = ServerStats()
+        self.probe = None
+
+    def new_outbound_queue(self):
+        return OutboundQueue()
+
+
+def socket_writes(codec):
+    writer = SocketWriter(ServerStats())
+    client = SocketClient(RecordingSocket(), ("127.0.0.1", 1), OutboundQueue(), writer)
+    client.codec = codec
+    for text in ("one", "two", "three"):
+        client.outbound.push(codec.encode(MsgType.SERVER_CHAT, (text,)))
+    writer.flush(client)
+    writer.selector.close()
+    return client.sock.writes
+
+
+def protocol_writes(codec):
+    client = ClientProtocol(FakeServer())
+    client.transport = RecordingTransport()
+    client.codec = codec
+    for text in ("one", "two", "three"):
+        client.outbound.push(codec.encode(MsgType.SERVER_CHAT, (text,)))
+    client.flush()
+    return client.transport.writes
+
+
+def test_socket_writer_coalesces_framed_clients():
+    assert len(socket_writes(FrameCodec())) == 1
+
+
+def test_socket_writer_sends_legacy_messages_one_at_a_time():
+    writes = socket_writes(LegacyCodec())
+    assert writes == [LegacyCodec.encode(MsgType.SERVER_CHAT, (text,)) for text in ("one", "two", "three")]
+
+
+def test_protocol_coalesces_framed_clients():
+    assert len(protocol_writes(FrameCodec())) == 1
+
+
+def test_protocol_sends_legacy_messages_one_at_a_time():
+    assert len(protocol_writes(LegacyCodec())) == 3
+
+
+def test_fan_out_only_counts_encoding():
+    server = BaseChatServer(idle_timeout=0, rate_limits=None)
+    client = QueueingClient()
+    server.register_client(client, ("127.0.0.1", 1))
+    client.codec = FrameCodec()
+    # the writer side is left alone, so its thread stays the only one bumping it
+    server.broadcast(MsgType.SERVER_CHAT, ("hello",))
+    stats = server.stats
+    assert stats.bytes_encoded == len(FrameCodec.encode(MsgType.SERVER_CHAT, ("hello",)))
+    assert (stats.bytes_copied, stats.write_calls, stats.bytes_written) == (0, 0, 0)